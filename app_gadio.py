@@ -1,13 +1,14 @@
 import os
+import threading
 import uuid
-import sys
-import subprocess
 from typing import Tuple
 
 import gradio as gr
 from PIL import Image
 from rembg import remove
 
+from tsr.service import TSRJob, TSRService
+
 # ---------- Paths & folders ----------
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -18,8 +19,8 @@ TRIPOSR_OUT_DIR = os.path.join(STATIC_DIR, "triposr")
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs(TRIPOSR_OUT_DIR, exist_ok=True)
 
-# Folder where run.py (TripoSR entry point) is located
-TRIPOSR_DIR = BASE_DIR
+# Number of warm TripoSR workers kept in this process (each holds one model)
+TRIPOSR_NUM_WORKERS = int(os.environ.get("TRIPOSR_NUM_WORKERS", "1"))
 
 # Pillow LANCZOS compatibility (newer versions use Image.Resampling.LANCZOS)
 try:
@@ -28,8 +29,25 @@ except AttributeError:  # older Pillow
     RESAMPLE_LANCZOS = Image.LANCZOS
 
 
+# Lazy-started TripoSR service (global)
+_triposr_service = None
+_triposr_lock = threading.Lock()
+
+
 # ---------- Utility functions ----------
 
+def get_triposr_service() -> TSRService:
+    """
+    Start the in-process TripoSR worker pool on first use and keep it warm.
+    """
+    global _triposr_service
+    with _triposr_lock:
+        if _triposr_service is None:
+            print(f"Starting {TRIPOSR_NUM_WORKERS} TripoSR worker(s)...")
+            _triposr_service = TSRService(num_workers=TRIPOSR_NUM_WORKERS)
+        return _triposr_service
+
+
 def remove_bg_pipeline(
     bg_img: Image.Image,
     fg_img: Image.Image,
@@ -146,22 +164,14 @@ def blend_pipeline(
 
 def run_triposr_on_fg(fg_img: Image.Image) -> str:
     """
-    Save fg_img, run TripoSR via run.py, return path to a 3D model
-    (OBJ / GLB / GLTF) for gr.Model3D.
+    Save fg_img, run TripoSR on the warm in-process workers, return path to
+    a 3D model (OBJ / GLB / GLTF) for gr.Model3D.
     """
     if fg_img is None:
         raise gr.Error(
             "You must run 'Remove BG & init' first so we have a foreground without background."
         )
 
-    # Ensure run.py exists
-    run_py_path = os.path.join(TRIPOSR_DIR, "run.py")
-    if not os.path.isfile(run_py_path):
-        raise gr.Error(
-            f"Could not find 'run.py' for TripoSR in {TRIPOSR_DIR}. "
-            "Please verify that TripoSR is correctly installed and that run.py is present."
-        )
-
     # Save foreground (no BG) as PNG
     fg_id = uuid.uuid4().hex
     fg_path = os.path.join(UPLOAD_DIR, f"{fg_id}_triposr_src.png")
@@ -172,50 +182,28 @@ def run_triposr_on_fg(fg_img: Image.Image) -> str:
     out_dir = os.path.join(TRIPOSR_OUT_DIR, run_id)
     os.makedirs(out_dir, exist_ok=True)
 
-    cmd = [
-        sys.executable,
-        "run.py",
-        fg_path,
-        "--output-dir",
-        out_dir,
-        "--bake-texture",
-        "--texture-resolution",
-        "1024",
-    ]
-
-    print("Running TripoSR with command:", " ".join(cmd))
+    job = TSRJob(
+        image=fg_path,
+        output_dir=out_dir,
+        bake_texture=True,
+        texture_resolution=1024,
+    )
+
+    print("Running TripoSR on:", fg_path)
     print("Output directory will be:", out_dir)
 
     try:
-        subprocess.run(cmd, cwd=TRIPOSR_DIR, check=True)
-    except FileNotFoundError as e:
-        raise gr.Error(
-            f"Failed to run TripoSR. Python executable or run.py not found: {e}"
-        )
-    except subprocess.CalledProcessError as e:
-        raise gr.Error(f"TripoSR process exited with an error: {e}")
+        outputs = get_triposr_service().run(job)
     except Exception as e:
         raise gr.Error(f"Unexpected error when running TripoSR: {e}")
 
-    # List everything TripoSR produced (for debugging)
-    for root, _, files in os.walk(out_dir):
-        print("Files in", root, ":", files)
-
-    # Accept any common 3D format that Gradio supports
-    exts = (".obj", ".glb", ".gltf")
-    model_path = None
-    for root, _, files in os.walk(out_dir):
-        for fname in files:
-            if fname.lower().endswith(exts):
-                model_path = os.path.join(root, fname)
-                break
-        if model_path:
-            break
+    print("TripoSR outputs:", outputs)
 
+    model_path = outputs.get("mesh")
     if not model_path:
         raise gr.Error(
-            "TripoSR finished but no 3D model (.obj / .glb / .gltf) "
-            "was found in the output folder. Check the terminal logs above."
+            "TripoSR finished but no 3D model was exported. "
+            "Check the terminal logs above."
         )
 
     print("Returning 3D model to Gradio:", model_path)
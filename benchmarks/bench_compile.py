@@ -0,0 +1,68 @@
+"""
+Latency of compiled (torch.compile) inference against eager on CPU.
+
+Reports the one-off warmup (compilation, or loading kernels from the cache on
+later runs) and the forward pass and mesh extraction latency of both models.
+
+    python -m benchmarks.bench_compile examples/chair.png --cache-dir /tmp/tsr-inductor
+"""
+import argparse
+import copy
+import logging
+import time
+
+import torch
+
+from .common import add_model_arguments, get_image_paths, load_images, load_model, measure
+
+
+def benchmark(model, image, args):
+    with torch.no_grad():
+        scene_codes = model([image], device="cpu")
+    return {
+        "forward": measure(lambda: model([image], device="cpu"), repeats=args.repeats),
+        "extract_mesh": measure(
+            lambda: model.extract_mesh(scene_codes, True, resolution=args.mc_resolution),
+            repeats=args.repeats,
+        ),
+    }
+
+
+def main():
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(message)s", level=logging.INFO
+    )
+    parser = argparse.ArgumentParser()
+    add_model_arguments(parser)
+    parser.add_argument("--mc-resolution", default=256, type=int)
+    parser.add_argument("--mode", default="default", type=str)
+    parser.add_argument("--cache-dir", default=None, type=str)
+    parser.add_argument("--repeats", default=3, type=int)
+    args = parser.parse_args()
+    args.device = "cpu"
+
+    image = load_images(get_image_paths(args.image))[0]
+    model = load_model(args)
+    compiled_model = copy.deepcopy(model)
+    compiled_model.enable_compile(mode=args.mode, cache_dir=args.cache_dir)
+
+    logging.info("Compiling ...")
+    start = time.perf_counter()
+    compiled_model.warmup("cpu")
+    print(f"warmup: {(time.perf_counter() - start) * 1000.0:.1f} ms")
+
+    logging.info("Benchmarking eager model ...")
+    eager_timings = benchmark(model, image, args)
+    logging.info("Benchmarking compiled model ...")
+    compiled_timings = benchmark(compiled_model, image, args)
+
+    print(f"{'stage':<15} {'eager (ms)':>11} {'compiled (ms)':>14} {'speedup':>8}")
+    for stage in eager_timings:
+        print(
+            f"{stage:<15} {eager_timings[stage]:>11.1f} {compiled_timings[stage]:>14.1f} "
+            f"{eager_timings[stage] / compiled_timings[stage]:>7.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
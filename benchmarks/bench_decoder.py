@@ -0,0 +1,99 @@
+"""
+Throughput of the fused inference decoder (FusedNeRFMLP) against the NeRFMLP
+module, in points per second, for the outputs needed by rendering (density and
+features), mesh extraction (density) and texture baking (features).
+
+Uses a randomly initialized decoder of the TripoSR size, so it needs no
+checkpoint. Exits with an error if the outputs differ by more than --atol.
+
+    python -m benchmarks.bench_decoder --n-points 1000000 --threads 1 4
+"""
+import argparse
+import sys
+
+import torch
+
+from tsr.models.network_utils import FusedNeRFMLP, NeRFMLP
+from tsr.utils import Workspace
+
+from .common import measure
+
+OUTPUTS = {
+    "both": ["density", "features"],
+    "density": ["density"],
+    "features": ["features"],
+}
+
+
+def run_chunks(decode, x, chunk_size):
+    for start in range(0, x.shape[0], chunk_size):
+        decode(x[start : start + chunk_size])
+
+
+def check(decoder, fused, x, outputs, args) -> bool:
+    workspace = Workspace()
+    with torch.no_grad():
+        expected = decoder(x[: args.chunk_size])
+        actual = fused(x[: args.chunk_size], outputs=OUTPUTS[outputs], workspace=workspace)
+        diff = max((actual[k] - expected[k]).abs().max().item() for k in actual)
+        module_ms = measure(
+            lambda: run_chunks(decoder, x, args.chunk_size), repeats=args.repeats
+        )
+        fused_ms = measure(
+            lambda: run_chunks(
+                lambda c: fused(c, outputs=OUTPUTS[outputs], workspace=workspace),
+                x,
+                args.chunk_size,
+            ),
+            repeats=args.repeats,
+        )
+    print(
+        f"threads {fused.num_threads}  {outputs:<8} max abs diff {diff:.2e}  "
+        f"module {x.shape[0] / module_ms / 1e3:.2f} Mpts/s  "
+        f"fused {x.shape[0] / fused_ms / 1e3:.2f} Mpts/s  "
+        f"speedup {module_ms / fused_ms:.2f}x"
+    )
+    return diff <= args.atol
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n-points", default=262144, type=int)
+    parser.add_argument("--in-channels", default=120, type=int)
+    parser.add_argument("--n-neurons", default=64, type=int)
+    parser.add_argument("--n-hidden-layers", default=9, type=int)
+    parser.add_argument("--chunk-size", default=8192, type=int)
+    parser.add_argument("--threads", default=[1], type=int, nargs="+")
+    parser.add_argument("--repeats", default=5, type=int)
+    parser.add_argument("--atol", default=1e-5, type=float)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    decoder = NeRFMLP(
+        {
+            "in_channels": args.in_channels,
+            "n_neurons": args.n_neurons,
+            "n_hidden_layers": args.n_hidden_layers,
+            "activation": "silu",
+            "bias_init": None,
+        }
+    )
+    decoder.eval()
+    x = torch.randn(args.n_points, args.in_channels)
+
+    results = []
+    for num_threads in args.threads:
+        fused = FusedNeRFMLP(
+            decoder,
+            num_threads=num_threads,
+            min_rows_per_thread=args.chunk_size // max(num_threads, 1),
+        )
+        results += [check(decoder, fused, x, outputs, args) for outputs in OUTPUTS]
+        fused.close()
+    if not all(results):
+        print(f"Fused outputs differ by more than {args.atol:.0e}.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Latency of dynamic int8 quantization against the fp32 model on CPU.
+
+Measures the forward pass, mesh extraction and (optionally) texture baking for
+the same input with both models and prints the speedup of each stage.
+
+    python -m benchmarks.bench_quantize examples/chair.png --bake-texture
+"""
+import argparse
+import copy
+import logging
+
+import torch
+
+from .common import add_model_arguments, get_image_paths, load_images, load_model, measure
+
+
+def benchmark(model, image, args):
+    with torch.no_grad():
+        scene_codes = model([image], device="cpu")
+    mesh = model.extract_mesh(scene_codes, not args.bake_texture, resolution=args.mc_resolution)[0]
+
+    timings = {
+        "forward": measure(lambda: model([image], device="cpu"), repeats=args.repeats),
+        "extract_mesh": measure(
+            lambda: model.extract_mesh(
+                scene_codes, not args.bake_texture, resolution=args.mc_resolution
+            ),
+            repeats=args.repeats,
+        ),
+    }
+    if args.bake_texture:
+        from tsr.bake_texture import bake_texture
+
+        timings["bake_texture"] = measure(
+            lambda: bake_texture(mesh, model, scene_codes[0], args.texture_resolution),
+            repeats=args.repeats,
+        )
+    return timings
+
+
+def main():
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(message)s", level=logging.INFO
+    )
+    parser = argparse.ArgumentParser()
+    add_model_arguments(parser)
+    parser.add_argument("--mc-resolution", default=256, type=int)
+    parser.add_argument("--bake-texture", action="store_true")
+    parser.add_argument("--texture-resolution", default=1024, type=int)
+    parser.add_argument("--repeats", default=3, type=int)
+    args = parser.parse_args()
+    args.device = "cpu"
+
+    image = load_images(get_image_paths(args.image))[0]
+    model = load_model(args)
+    quantized_model = copy.deepcopy(model)
+    quantized_model.quantize("int8")
+
+    logging.info("Benchmarking fp32 model ...")
+    fp32_timings = benchmark(model, image, args)
+    logging.info("Benchmarking int8 model ...")
+    int8_timings = benchmark(quantized_model, image, args)
+
+    print(f"{'stage':<15} {'fp32 (ms)':>10} {'int8 (ms)':>10} {'speedup':>8}")
+    for stage in fp32_timings:
+        print(
+            f"{stage:<15} {fp32_timings[stage]:>10.1f} {int8_timings[stage]:>10.1f} "
+            f"{fp32_timings[stage] / int8_timings[stage]:>7.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+Cold start time of the CLI and service workers, broken down by import and by
+model construction step.
+
+Every repeat runs in a fresh interpreter. The import section times the modules
+that building a TSR model needs, then the optional feature modules (background
+removal, texture baking, video export) that run.py only imports on demand. The
+construction section follows the steps of TSR.from_pretrained.
+
+    python -m benchmarks.bench_startup --repeats 5
+"""
+import argparse
+import importlib
+import json
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+MODEL_IMPORTS = ["torch", "transformers.models.vit.modeling_vit", "tsr.system"]
+OPTIONAL_IMPORTS = ["rembg", "xatlas", "trimesh", "imageio", "moderngl"]
+
+
+def child(args):
+    timings = {}
+    for name in MODEL_IMPORTS + OPTIONAL_IMPORTS:
+        start = time.perf_counter()
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            continue
+        timings[f"import {name}"] = (time.perf_counter() - start) * 1000.0
+
+    import torch
+    from omegaconf import OmegaConf
+
+    from tsr.system import TSR
+    from tsr.utils import get_pretrained_file, init_empty_weights, load_state_dict_mmap
+
+    def step(name, fn):
+        start = time.perf_counter()
+        result = fn()
+        timings[name] = (time.perf_counter() - start) * 1000.0
+        return result
+
+    config_path, weight_path = step(
+        "resolve files",
+        lambda: (
+            get_pretrained_file(args.pretrained_model_name_or_path, "config.yaml"),
+            get_pretrained_file(args.pretrained_model_name_or_path, "model.ckpt"),
+        ),
+    )
+
+    def load_config():
+        cfg = OmegaConf.load(config_path)
+        OmegaConf.resolve(cfg)
+        return cfg
+
+    cfg = step("load config", load_config)
+
+    def build():
+        with init_empty_weights():
+            return TSR(cfg)
+
+    model = step("build modules", build)
+    state_dict = step("map weights", lambda: load_state_dict_mmap(weight_path))
+    step("assign weights", lambda: model.load_state_dict(state_dict, assign=True))
+    step("precompute prefix", model.precompute_backbone_prefix)
+    device = args.device if torch.cuda.is_available() else "cpu"
+    step(f"move to {device}", lambda: model.to(device))
+    print(json.dumps(timings))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", default="cpu", type=str)
+    parser.add_argument(
+        "--pretrained-model-name-or-path", default="stabilityai/TripoSR", type=str
+    )
+    parser.add_argument("--repeats", default=3, type=int)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args)
+        return
+
+    runs = []
+    for _ in range(args.repeats):
+        start = time.perf_counter()
+        output = subprocess.run(
+            [
+                sys.executable,
+                "-m",
+                "benchmarks.bench_startup",
+                "--child",
+                "--device",
+                args.device,
+                "--pretrained-model-name-or-path",
+                args.pretrained_model_name_or_path,
+            ],
+            check=True,
+            stdout=subprocess.PIPE,
+            text=True,
+        ).stdout
+        timings = json.loads(output.strip().splitlines()[-1])
+        timings["process total"] = (time.perf_counter() - start) * 1000.0
+        runs.append(timings)
+
+    print(f"{'step':<50} {'median (ms)':>12}")
+    for name in runs[0]:
+        print(f"{name:<50} {np.median([run[name] for run in runs]):>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Throughput of the fused triplane sampler (TriplaneSampler) against the previous
+grid_sample based sampling of query_triplane, in points per second, for the
+feature reductions used by the renderer.
+
+Uses random triplanes of the TripoSR size, so it needs no checkpoint. Exits with
+an error if the sampled features differ by more than --atol.
+
+    python -m benchmarks.bench_triplane_sampler --n-points 1000000
+"""
+import argparse
+import sys
+
+import torch
+import torch.nn.functional as F
+from einops import rearrange, reduce
+
+from tsr.models.triplane_sampler import TriplaneSampler
+
+from .common import measure
+
+
+def grid_sample_features(triplane, positions, reduction):
+    # the sampling of query_triplane before TriplaneSampler
+    indices2D = torch.stack(
+        (positions[..., [0, 1]], positions[..., [0, 2]], positions[..., [1, 2]]),
+        dim=-3,
+    )
+    out = F.grid_sample(
+        rearrange(triplane, "Np Cp Hp Wp -> Np Cp Hp Wp", Np=3),
+        rearrange(indices2D, "Np N Nd -> Np () N Nd", Np=3),
+        align_corners=False,
+        mode="bilinear",
+    )
+    if reduction == "concat":
+        return rearrange(out, "Np Cp () N -> N (Np Cp)", Np=3)
+    return reduce(out, "Np Cp () N -> N Cp", Np=3, reduction=reduction)
+
+
+def run_chunks(sample, positions, chunk_size):
+    for start in range(0, positions.shape[0], chunk_size):
+        sample(positions[start : start + chunk_size])
+
+
+def check(reduction: str, args) -> bool:
+    torch.manual_seed(0)
+    triplane = torch.randn(
+        3, args.n_channels, args.plane_size, args.plane_size, device=args.device
+    )
+    # include points outside the planes, where grid_sample pads with zeros
+    positions = torch.rand(args.n_points, 3, device=args.device) * 2.1 - 1.05
+    sampler = TriplaneSampler(triplane, reduction=reduction)
+
+    with torch.no_grad():
+        expected = grid_sample_features(triplane, positions, reduction)
+        diff = (sampler(positions) - expected).abs().max().item()
+        grid_sample_ms = measure(
+            lambda: run_chunks(
+                lambda x: grid_sample_features(triplane, x, reduction),
+                positions,
+                args.chunk_size,
+            ),
+            repeats=args.repeats,
+        )
+        fused_ms = measure(
+            lambda: run_chunks(sampler, positions, args.chunk_size),
+            repeats=args.repeats,
+        )
+    print(
+        f"{reduction:<8} max abs diff {diff:.2e}  "
+        f"grid_sample {args.n_points / grid_sample_ms / 1e3:.2f} Mpts/s  "
+        f"fused {args.n_points / fused_ms / 1e3:.2f} Mpts/s  "
+        f"speedup {grid_sample_ms / fused_ms:.2f}x"
+    )
+    return diff <= args.atol
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", default="cpu", type=str)
+    parser.add_argument("--n-points", default=1048576, type=int)
+    parser.add_argument("--n-channels", default=40, type=int)
+    parser.add_argument("--plane-size", default=64, type=int)
+    parser.add_argument("--chunk-size", default=8192, type=int)
+    parser.add_argument("--repeats", default=5, type=int)
+    parser.add_argument("--atol", default=1e-5, type=float)
+    args = parser.parse_args()
+    if not torch.cuda.is_available():
+        args.device = "cpu"
+
+    results = [check(reduction, args) for reduction in ["concat", "mean", "sum"]]
+    if not all(results):
+        print(f"Sampled features differ by more than {args.atol:.0e}.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+import argparse
+import glob
+import os
+import time
+from typing import Callable, List
+
+import numpy as np
+import torch
+from PIL import Image
+
+from tsr.system import TSR
+
+EXAMPLES_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "examples")
+
+
+def add_model_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--device",
+        default="cpu",
+        type=str,
+        help="Device to use. If no CUDA-compatible device is found, will fallback to 'cpu'. Default: 'cpu'",
+    )
+    parser.add_argument(
+        "--pretrained-model-name-or-path",
+        default="stabilityai/TripoSR",
+        type=str,
+        help="Path to the pretrained model. Could be either a huggingface model id is or a local path. Default: 'stabilityai/TripoSR'",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        default=8192,
+        type=int,
+        help="Evaluation chunk size for surface extraction and rendering. Default: 8192",
+    )
+    parser.add_argument(
+        "image",
+        type=str,
+        nargs="*",
+        help="Path to preprocessed input image(s). Default: the images in examples/",
+    )
+
+
+def get_device(args: argparse.Namespace) -> str:
+    if not torch.cuda.is_available():
+        return "cpu"
+    return args.device
+
+
+def load_model(args: argparse.Namespace) -> TSR:
+    model = TSR.from_pretrained(
+        args.pretrained_model_name_or_path,
+        config_name="config.yaml",
+        weight_name="model.ckpt",
+    )
+    model.renderer.set_chunk_size(args.chunk_size)
+    model.to(get_device(args))
+    return model
+
+
+def get_image_paths(paths: List[str]) -> List[str]:
+    if len(paths) == 0:
+        paths = sorted(glob.glob(os.path.join(EXAMPLES_DIR, "*.png")))
+    return paths
+
+
+def load_images(paths: List[str]) -> List[Image.Image]:
+    """
+    Load already preprocessed images (like the ones in examples/), compositing
+    transparent pixels onto the gray background the model expects.
+    """
+    images = []
+    for path in paths:
+        image = Image.open(path)
+        if image.mode == "RGBA":
+            image = np.array(image).astype(np.float32) / 255.0
+            image = image[:, :, :3] * image[:, :, 3:4] + (1 - image[:, :, 3:4]) * 0.5
+            image = Image.fromarray((image * 255.0).astype(np.uint8))
+        images.append(image.convert("RGB"))
+    return images
+
+
+def measure(fn: Callable, repeats: int = 3, warmup: int = 1) -> float:
+    """Median wall time of `fn()` in milliseconds."""
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeats):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        fn()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        times.append((time.perf_counter() - start) * 1000.0)
+    return float(np.median(times))
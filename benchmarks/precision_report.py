@@ -0,0 +1,129 @@
+"""
+Accuracy report of a reduced-precision policy against fp32 on the bundled examples.
+
+For every image the scene codes, the extracted mesh and a short turntable are
+computed once in fp32 and once with the requested policy. The report lists the
+symmetric Chamfer distance between the two meshes, the PSNR of the reduced
+precision renders against the fp32 renders, and the forward latency of both.
+
+    python -m benchmarks.precision_report --precision bf16 --override decoder=fp32
+"""
+import argparse
+import logging
+import os
+
+import numpy as np
+import torch
+
+from .common import (
+    add_model_arguments,
+    get_device,
+    get_image_paths,
+    load_images,
+    load_model,
+    measure,
+)
+
+
+def chamfer_distance(mesh_a, mesh_b, n_points: int, chunk_size: int = 4096) -> float:
+    if len(mesh_a.faces) == 0 or len(mesh_b.faces) == 0:
+        return float("nan")
+    points_a = torch.from_numpy(np.asarray(mesh_a.sample(n_points))).float()
+    points_b = torch.from_numpy(np.asarray(mesh_b.sample(n_points))).float()
+
+    def nearest(x, y):
+        return torch.cat([torch.cdist(xc, y).amin(dim=-1) for xc in x.split(chunk_size)])
+
+    return (nearest(points_a, points_b).mean() + nearest(points_b, points_a).mean()).item()
+
+
+def psnr(images_a: torch.Tensor, images_b: torch.Tensor) -> float:
+    mse = ((images_a - images_b) ** 2).mean().item()
+    if mse == 0:
+        return float("inf")
+    return 10.0 * np.log10(1.0 / mse)
+
+
+def evaluate(model, image, device, args):
+    with torch.no_grad():
+        scene_codes = model([image], device=device)
+    mesh = model.extract_mesh(scene_codes, True, resolution=args.mc_resolution)[0]
+    renders = model.render(
+        scene_codes,
+        n_views=args.n_views,
+        height=args.render_resolution,
+        width=args.render_resolution,
+        return_type="pt",
+    )[0]
+    forward_time = measure(
+        lambda: model([image], device=device), repeats=args.repeats, warmup=0
+    )
+    return mesh, torch.stack(renders).float().cpu(), forward_time
+
+
+def main():
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(message)s", level=logging.INFO
+    )
+    parser = argparse.ArgumentParser()
+    add_model_arguments(parser)
+    parser.add_argument(
+        "--precision",
+        default="bf16",
+        type=str,
+        choices=["bf16", "fp16"],
+        help="Precision to compare against fp32. Default: 'bf16'",
+    )
+    parser.add_argument(
+        "--override",
+        default=[],
+        type=str,
+        action="append",
+        help="Per-stage precision override as stage=precision, e.g. decoder=fp32. Can be repeated.",
+    )
+    parser.add_argument("--mc-resolution", default=256, type=int)
+    parser.add_argument("--render-resolution", default=256, type=int)
+    parser.add_argument("--n-views", default=4, type=int)
+    parser.add_argument("--n-points", default=100000, type=int)
+    parser.add_argument("--repeats", default=3, type=int)
+    args = parser.parse_args()
+
+    overrides = dict(override.split("=", 1) for override in args.override)
+    device = get_device(args)
+    model = load_model(args)
+    paths = get_image_paths(args.image)
+    images = load_images(paths)
+
+    rows = []
+    for path, image in zip(paths, images):
+        logging.info(f"Evaluating {path} ...")
+        model.set_precision("fp32")
+        mesh_ref, renders_ref, time_ref = evaluate(model, image, device, args)
+        model.set_precision(args.precision, overrides)
+        mesh, renders, time_policy = evaluate(model, image, device, args)
+        rows.append(
+            (
+                os.path.basename(path),
+                chamfer_distance(mesh_ref, mesh, args.n_points),
+                psnr(renders_ref, renders),
+                time_ref,
+                time_policy,
+            )
+        )
+
+    print(
+        f"{'image':<20} {'chamfer':>10} {'psnr (dB)':>10} {'fp32 (ms)':>10} {args.precision + ' (ms)':>10}"
+    )
+    for name, chamfer, psnr_value, time_ref, time_policy in rows:
+        print(
+            f"{name:<20} {chamfer:>10.6f} {psnr_value:>10.2f} {time_ref:>10.1f} {time_policy:>10.1f}"
+        )
+    print(
+        f"{'mean':<20} {np.nanmean([r[1] for r in rows]):>10.6f} "
+        f"{np.mean([r[2] for r in rows]):>10.2f} "
+        f"{np.mean([r[3] for r in rows]):>10.1f} {np.mean([r[4] for r in rows]):>10.1f}"
+    )
+
+
+if __name__ == "__main__":
+    main()
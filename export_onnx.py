@@ -0,0 +1,91 @@
+import argparse
+import glob
+import logging
+import os
+import sys
+
+import numpy as np
+import torch
+from PIL import Image
+
+from tsr.onnx_backend import OnnxTriplaneEngine, export_onnx
+from tsr.system import TSR
+
+logging.basicConfig(
+    format="%(asctime)s - %(levelname)s - %(message)s", level=logging.INFO
+)
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--pretrained-model-name-or-path",
+    default="stabilityai/TripoSR",
+    type=str,
+    help="Path to the pretrained model. Could be either a huggingface model id is or a local path. Default: 'stabilityai/TripoSR'",
+)
+parser.add_argument(
+    "--output",
+    default="triposr.onnx",
+    type=str,
+    help="Path of the exported image-to-triplane graph. Default: 'triposr.onnx'",
+)
+parser.add_argument(
+    "--opset",
+    default=17,
+    type=int,
+    help="ONNX opset version. Default: 17",
+)
+parser.add_argument(
+    "--check",
+    action="store_true",
+    help="If specified, run the exported graph in onnxruntime on preprocessed images and compare the triplanes with the eager PyTorch model. Exits with an error if they differ by more than --atol. Default: false",
+)
+parser.add_argument(
+    "--atol",
+    default=1e-3,
+    type=float,
+    help="Largest absolute difference accepted by --check. Default: 1e-3",
+)
+parser.add_argument(
+    "image",
+    type=str,
+    nargs="*",
+    help="Preprocessed images used by --check. Default: the images in examples/",
+)
+args = parser.parse_args()
+
+model = TSR.from_pretrained(
+    args.pretrained_model_name_or_path,
+    config_name="config.yaml",
+    weight_name="model.ckpt",
+)
+logging.info(f"Exporting to {args.output} ...")
+export_onnx(model, args.output, opset_version=args.opset)
+logging.info("Exported.")
+
+if not args.check:
+    sys.exit(0)
+
+image_paths = args.image or sorted(
+    glob.glob(os.path.join(os.path.dirname(__file__), "examples", "*.png"))
+)
+engine = OnnxTriplaneEngine(args.output)
+max_diff = 0.0
+# two images per run to also exercise the dynamic batch dimension
+for start in range(0, len(image_paths), 2):
+    images = []
+    for image_path in image_paths[start : start + 2]:
+        image = np.array(Image.open(image_path).convert("RGBA")).astype(np.float32) / 255.0
+        image = image[:, :, :3] * image[:, :, 3:4] + (1 - image[:, :, 3:4]) * 0.5
+        images.append(image)
+    rgb_cond = model.image_processor(images, model.cfg.cond_image_size)[:, None]
+    with torch.no_grad():
+        expected = model.get_scene_codes(rgb_cond)
+    actual = engine(rgb_cond)
+    diff = (actual - expected).abs().max().item()
+    logging.info(f"{image_paths[start : start + 2]}: max abs difference {diff:.2e}")
+    max_diff = max(max_diff, diff)
+
+if max_diff > args.atol:
+    logging.error(f"ONNX output differs by {max_diff:.2e} > {args.atol:.2e}.")
+    sys.exit(1)
+logging.info(f"ONNX output matches the eager model (max abs difference {max_diff:.2e}).")
@@ -11,7 +11,12 @@ from PIL import Image
 from functools import partial
 
 from tsr.system import TSR
-from tsr.utils import remove_background, resize_foreground, to_gradio_3d_orientation
+from tsr.utils import (
+    get_available_memory,
+    remove_background,
+    resize_foreground,
+    to_gradio_3d_orientation,
+)
 
 import argparse
 
@@ -177,7 +182,17 @@ if __name__ == '__main__':
     parser.add_argument("--listen", action='store_true', help="launch gradio with 0.0.0.0 as server name, allowing to respond to network requests")
     parser.add_argument("--share", action='store_true', help="use share=True for gradio and make the UI accessible through their site")
     parser.add_argument("--queuesize", type=int, default=1, help="launch gradio queue max_size")
+    parser.add_argument("--chunk-size", type=str, default="8192", help="evaluation chunk size for surface extraction, 'auto' to pick the fastest one that fits in the available memory of the device")
+    parser.add_argument("--scene-code-cache", action='store_true', help="reuse the scene codes when the same image is generated again, e.g. with another marching cubes resolution")
     args = parser.parse_args()
+    if args.scene_code_cache:
+        model.enable_scene_code_cache()
+    if args.chunk_size == "auto":
+        model.renderer.set_chunk_size(
+            model.get_auto_chunk_size(get_available_memory(device), device)
+        )
+    else:
+        model.renderer.set_chunk_size(int(args.chunk_size))
     interface.queue(max_size=args.queuesize)
     interface.launch(
         auth=(args.username, args.password) if (args.username and args.password) else None,
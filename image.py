@@ -4,8 +4,6 @@ from rembg import remove
 from PIL import Image
 import os
 import uuid
-import subprocess
-import sys
 import base64
 import io
 import threading
@@ -15,6 +13,8 @@ import traceback
 from diffusers import StableDiffusionXLPipeline
 import torch
 
+from tsr.service import TSRJob, TSRService
+
 app = Flask(__name__, static_folder="static", template_folder="templates")
 
 # Folders
@@ -26,8 +26,8 @@ TRIPOSR_OUT_DIR = os.path.join(STATIC_DIR, "triposr")
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs(TRIPOSR_OUT_DIR, exist_ok=True)
 
-# Path to TripoSR repo (we assume image.py lives there with run.py)
-TRIPOSR_DIR = BASE_DIR
+# Number of warm TripoSR workers kept in this process (each holds one model)
+TRIPOSR_NUM_WORKERS = int(os.environ.get("TRIPOSR_NUM_WORKERS", "1"))
 
 ALLOWED_EXT = {"png", "jpg", "jpeg", "webp", "bmp"}
 
@@ -84,6 +84,27 @@ def get_local_pipe():
             raise
 
 
+# Lazy-started TripoSR service (global)
+_triposr_service = None
+_triposr_lock = threading.Lock()
+
+
+def get_triposr_service():
+    """
+    Lazily start the in-process TripoSR worker pool once.
+    The models stay loaded for the lifetime of the server.
+    """
+    global _triposr_service
+    if _triposr_service is not None:
+        return _triposr_service
+
+    with _triposr_lock:
+        if _triposr_service is None:
+            print(f"[TripoSR] Starting {TRIPOSR_NUM_WORKERS} worker(s)...")
+            _triposr_service = TSRService(num_workers=TRIPOSR_NUM_WORKERS)
+        return _triposr_service
+
+
 def allowed_file(name: str) -> bool:
     return "." in name and name.rsplit(".", 1)[1].lower() in ALLOWED_EXT
 
@@ -282,43 +303,22 @@ def run_triposr(image_path: str):
     out_dir = os.path.join(TRIPOSR_OUT_DIR, run_id)
     os.makedirs(out_dir, exist_ok=True)
 
-    cmd = [
-        sys.executable,
-        "run.py",
-        image_path,
-        "--output-dir",
-        out_dir,
-        "--bake-texture",
-        "--texture-resolution",
-        "1024",
-    ]
+    job = TSRJob(
+        image=image_path,
+        output_dir=out_dir,
+        bake_texture=True,
+        texture_resolution=1024,
+    )
 
     try:
-        subprocess.run(cmd, cwd=TRIPOSR_DIR, check=True)
+        outputs = get_triposr_service().run(job)
     except Exception as e:
         print("[TripoSR ERROR]", e)
         return None, None, None
 
-    model_path = None
-    render_path = None
-    texture_path = None
-
-    # search recursively inside out_dir
-    for root, dirs, files in os.walk(out_dir):
-        for fname in files:
-            lower = fname.lower()
-            full = os.path.join(root, fname)
-
-            if lower.endswith((".obj", ".ply", ".glb", ".gltf")) and model_path is None:
-                model_path = full
-
-            if lower.endswith((".png", ".jpg", ".jpeg", ".webp")):
-                if "input" in lower and render_path is None:
-                    render_path = full
-                elif any(k in lower for k in ["tex", "texture", "albedo", "baked"]) and texture_path is None:
-                    texture_path = full
-                elif render_path is None:
-                    render_path = full
+    model_path = outputs.get("mesh")
+    render_path = outputs.get("input")
+    texture_path = outputs.get("texture")
 
     # fallback: if we didn't find a special texture, just reuse render
     if texture_path is None:
@@ -1,17 +1,22 @@
 import argparse
+import copy
 import logging
+import multiprocessing
 import os
+import queue
 import time
 
 import numpy as np
-import rembg
 import torch
-import xatlas
 from PIL import Image
 
 from tsr.system import TSR
-from tsr.utils import remove_background, resize_foreground, save_video
-from tsr.bake_texture import bake_texture
+from tsr.utils import (
+    get_available_memory,
+    remove_background,
+    resize_foreground,
+    VideoWriter,
+)
 
 
 class Timer:
@@ -59,9 +64,122 @@ parser.add_argument(
 )
 parser.add_argument(
     "--chunk-size",
-    default=8192,
+    default="8192",
+    type=str,
+    help="Evaluation chunk size for surface extraction and rendering. Smaller chunk size reduces VRAM usage but increases computation time. 0 for no chunking, 'auto' to pick the fastest one within --memory-budget. Default: 8192",
+)
+parser.add_argument(
+    "--batch-size",
+    default=1,
+    type=int,
+    help="Number of images to reconstruct in one forward pass. 0 to pick the largest batch size that fits --memory-budget. Default: 1",
+)
+parser.add_argument(
+    "--workers",
+    default=1,
+    type=int,
+    help="Number of processes that reconstruct the images in parallel. Each one loads the model once and takes images from a shared queue. With more than one worker, --batch-size 0 means 1. Default: 1",
+)
+parser.add_argument(
+    "--threads-per-worker",
+    default=None,
+    type=int,
+    help="Number of intra-op threads of each worker process when --workers is more than 1. Default: the number of CPU cores divided by --workers",
+)
+parser.add_argument(
+    "--memory-budget",
+    default=None,
+    type=int,
+    help="Memory budget in MB used to pick the batch size when --batch-size is 0 and the chunk size when --chunk-size is auto. Default: the currently available memory of the device divided by --workers",
+)
+parser.add_argument(
+    "--backbone-memory-budget",
+    default=None,
     type=int,
-    help="Evaluation chunk size for surface extraction and rendering. Smaller chunk size reduces VRAM usage but increases computation time. 0 for no chunking. Default: 8192",
+    help="Activation memory budget in MB of the backbone transformer. Attention is sliced or tiled and the feed-forward layers chunked to stay within it, which also lets --batch-size 0 pick larger batches. Default: unbounded",
+)
+parser.add_argument(
+    "--backend",
+    default="torch",
+    type=str,
+    choices=["torch", "onnx"],
+    help="Engine that computes the triplanes from the images. 'onnx' runs an exported graph in onnxruntime (see --onnx-path). Default: 'torch'",
+)
+parser.add_argument(
+    "--onnx-path",
+    default="triposr.onnx",
+    type=str,
+    help="ONNX graph used by --backend onnx, exported from the model on first use if it does not exist. Default: 'triposr.onnx'",
+)
+parser.add_argument(
+    "--compile",
+    action="store_true",
+    help="If specified, compile the backbone and the decoder with torch.compile and warm them up before processing images. Default: false",
+)
+parser.add_argument(
+    "--compile-cache-dir",
+    default=None,
+    type=str,
+    help="Directory in which compiled kernels are cached across runs when --compile is set. Default: the torch inductor cache directory",
+)
+parser.add_argument(
+    "--fold-decoder-input",
+    action="store_true",
+    help="If specified, apply the first decoder layer to the triplanes once per scene instead of to every sampled point. Faster when the decoder is not wider than the triplane features. Default: false",
+)
+parser.add_argument(
+    "--occupancy-grid-resolution",
+    default=0,
+    type=int,
+    help="Resolution of the per-scene occupancy grid used by --render to skip samples in empty space. Faster, but samples whose density stays below a small threshold are dropped, so the frames differ slightly. 0 to query every sample. Default: 0",
+)
+parser.add_argument(
+    "--ray-block-size",
+    default=0,
+    type=int,
+    help="Number of samples per ray that --render decodes at a time, terminating the rays that are already opaque before the next block. Faster, but the frames differ slightly. 0 to decode all samples of a ray at once. Default: 0",
+)
+parser.add_argument(
+    "--fused-decoder",
+    action="store_true",
+    help="If specified, decode with the inference-only fused decoder, which packs the weights once and reuses its buffers across chunks. Not compatible with --quantize and --compile. Default: false",
+)
+parser.add_argument(
+    "--fused-decoder-threads",
+    default=1,
+    type=int,
+    help="Number of threads the fused decoder splits large chunks across. Default: 1",
+)
+parser.add_argument(
+    "--fuse-qkv",
+    action="store_true",
+    help="If specified, fuse the attention query/key/value projections of the backbone into single GEMMs at load time. Default: false",
+)
+parser.add_argument(
+    "--precision",
+    default="fp32",
+    type=str,
+    choices=["fp32", "bf16"],
+    help="Autocast precision of the image tokenizer, backbone, post processor and decoder. Density activation and marching cubes stay in fp32. Default: 'fp32'",
+)
+parser.add_argument(
+    "--quantize",
+    default=None,
+    type=str,
+    choices=["int8"],
+    help="Apply dynamic quantization to the backbone and decoder linear layers (CPU only). Default: None",
+)
+parser.add_argument(
+    "--quantized-model-path",
+    default=None,
+    type=str,
+    help="Where to load the quantized model from, or save it to if it does not exist yet. Only used with --quantize. Default: None",
+)
+parser.add_argument(
+    "--scene-code-cache-dir",
+    default=None,
+    type=str,
+    help="If specified, cache scene codes in this directory and reuse them for images that were already reconstructed by the same model. Default: None",
 )
 parser.add_argument(
     "--mc-resolution",
@@ -107,36 +225,94 @@ parser.add_argument(
 parser.add_argument(
     "--render",
     action="store_true",
-    help="If specified, save a NeRF-rendered video. Default: false",
+    help="If specified, save a rendered video. Default: false",
+)
+parser.add_argument(
+    "--render-mode",
+    default="nerf",
+    type=str,
+    choices=["nerf", "mesh"],
+    help="How --render renders the turntable: 'nerf' volume-renders the scene, 'mesh' rasterizes the extracted (vertex-colored or baked-texture) mesh from the same cameras, which is much faster. Default: 'nerf'",
 )
-args = parser.parse_args()
 
-output_dir = args.output_dir
-os.makedirs(output_dir, exist_ok=True)
 
-device = args.device
-if not torch.cuda.is_available():
-    device = "cpu"
+def get_memory_budget(args, device):
+    if args.memory_budget is not None:
+        return args.memory_budget * 1024**2
+    # the workers share the device
+    return get_available_memory(device) // max(args.workers, 1)
 
-timer.start("Initializing model")
-model = TSR.from_pretrained(
-    args.pretrained_model_name_or_path,
-    config_name="config.yaml",
-    weight_name="model.ckpt",
-)
-model.renderer.set_chunk_size(args.chunk_size)
-model.to(device)
-timer.end("Initializing model")
 
-timer.start("Processing images")
-images = []
+def load_model(args, device, compile=True):
+    timer.start("Initializing model")
+    if (
+        args.quantize is not None
+        and args.quantized_model_path is not None
+        and os.path.exists(args.quantized_model_path)
+    ):
+        model = TSR.from_quantized(args.quantized_model_path)
+    else:
+        model = TSR.from_pretrained(
+            args.pretrained_model_name_or_path,
+            config_name="config.yaml",
+            weight_name="model.ckpt",
+            fuse_qkv_projections=args.fuse_qkv,
+        )
+        if args.quantize is not None:
+            model.quantize(args.quantize)
+            if args.quantized_model_path is not None:
+                model.save_quantized(args.quantized_model_path)
+    model.renderer.set_fold_decoder_input(args.fold_decoder_input)
+    model.renderer.set_occupancy_grid_resolution(args.occupancy_grid_resolution)
+    model.renderer.set_ray_block_size(args.ray_block_size)
+    model.set_precision(args.precision)
+    if args.backbone_memory_budget is not None:
+        model.backbone.set_memory_budget(args.backbone_memory_budget * 1024**2)
+    model.to(device)
+    if args.fused_decoder:
+        model.enable_fused_decoder(num_threads=args.fused_decoder_threads)
+    if args.scene_code_cache_dir is not None:
+        model.enable_scene_code_cache(cache_dir=args.scene_code_cache_dir)
+    model.set_backend(args.backend, onnx_path=args.onnx_path)
+    timer.end("Initializing model")
 
-if args.no_remove_bg:
-    rembg_session = None
-else:
-    rembg_session = rembg.new_session()
+    memory_budget = get_memory_budget(args, device)
+    if args.chunk_size == "auto":
+        timer.start("Tuning chunk size")
+        chunk_size = model.get_auto_chunk_size(memory_budget, device)
+        timer.end("Tuning chunk size")
+        logging.info(
+            f"Using chunk size {chunk_size} for a memory budget of {memory_budget / 1024**2:.0f}MB."
+        )
+    else:
+        chunk_size = int(args.chunk_size)
+    model.renderer.set_chunk_size(chunk_size)
+    mesh_memory = model.estimate_extract_mesh_memory(args.mc_resolution)
+    if mesh_memory > memory_budget:
+        logging.warning(
+            f"Extracting meshes at resolution {args.mc_resolution} needs about "
+            f"{mesh_memory / 1024**2:.0f}MB, more than the memory budget of "
+            f"{memory_budget / 1024**2:.0f}MB."
+        )
 
-for i, image_path in enumerate(args.image):
+    if args.compile and compile:
+        timer.start("Compiling model")
+        model.enable_compile(cache_dir=args.compile_cache_dir)
+        model.warmup(device)
+        timer.end("Compiling model")
+    return model
+
+
+def get_rembg_session(args):
+    if args.no_remove_bg:
+        return None
+    import rembg
+
+    return rembg.new_session()
+
+
+def preprocess_image(args, i, image_path, rembg_session):
+    output_dir = args.output_dir
     if args.no_remove_bg:
         image = np.array(Image.open(image_path).convert("RGB"))
     else:
@@ -148,25 +324,39 @@ for i, image_path in enumerate(args.image):
         if not os.path.exists(os.path.join(output_dir, str(i))):
             os.makedirs(os.path.join(output_dir, str(i)))
         image.save(os.path.join(output_dir, str(i), f"input.png"))
-    images.append(image)
-timer.end("Processing images")
+    return image
 
-for i, image in enumerate(images):
-    logging.info(f"Running image {i + 1}/{len(images)} ...")
 
-    timer.start("Running model")
-    with torch.no_grad():
-        scene_codes = model([image], device=device)
-    timer.end("Running model")
+def save_render(args, i, render_images):
+    # encodes and saves the frames while the next ones render
+    output_dir = args.output_dir
+    with VideoWriter(
+        os.path.join(output_dir, str(i), f"render.mp4"),
+        fps=30,
+        frame_path=os.path.join(output_dir, str(i), "render_{:03d}.png"),
+    ) as writer:
+        for render_image in render_images:
+            writer.write(render_image)
+
+
+def save_outputs(args, model, i, scene_codes):
+    output_dir = args.output_dir
+    os.makedirs(os.path.join(output_dir, str(i)), exist_ok=True)
 
-    if args.render:
+    if args.render and args.render_mode == "nerf":
         timer.start("Rendering")
-        render_images = model.render(scene_codes, n_views=30, return_type="pil")
-        for ri, render_image in enumerate(render_images[0]):
-            render_image.save(os.path.join(output_dir, str(i), f"render_{ri:03d}.png"))
-        save_video(
-            render_images[0], os.path.join(output_dir, str(i), f"render.mp4"), fps=30
+        # as many views in one ray stream as the memory budget allows
+        views_per_step = model.get_max_views_per_step(
+            get_memory_budget(args, scene_codes.device), 30
         )
+        render_images = (
+            frame
+            for frames in model.render_iter(
+                scene_codes, n_views=30, return_type="pil", views_per_step=views_per_step
+            )
+            for frame in frames[0]
+        )
+        save_render(args, i, render_images)
         timer.end("Rendering")
 
     timer.start("Extracting mesh")
@@ -175,6 +365,10 @@ for i, image in enumerate(images):
 
     out_mesh_path = os.path.join(output_dir, str(i), f"mesh.{args.model_save_format}")
     if args.bake_texture:
+        import xatlas
+
+        from tsr.bake_texture import bake_texture
+
         out_texture_path = os.path.join(output_dir, str(i), "texture.png")
 
         timer.start("Baking texture")
@@ -186,6 +380,171 @@ for i, image in enumerate(images):
         Image.fromarray((bake_output["colors"] * 255.0).astype(np.uint8)).transpose(Image.FLIP_TOP_BOTTOM).save(out_texture_path)
         timer.end("Exporting mesh and texture")
     else:
+        bake_output = None
         timer.start("Exporting mesh")
         meshes[0].export(out_mesh_path)
         timer.end("Exporting mesh")
+
+    if args.render and args.render_mode == "mesh":
+        from tsr.mesh_renderer import iter_mesh_turntable
+
+        timer.start("Rendering")
+        render_images = iter_mesh_turntable(meshes[0], n_views=30, texture=bake_output)
+        save_render(args, i, render_images)
+        timer.end("Rendering")
+
+
+def run_batch(args, model, device, indices, images):
+    timer.start("Running model")
+    with torch.no_grad():
+        batch_scene_codes = model(images, device=device)
+    timer.end("Running model")
+
+    for j, i in enumerate(indices):
+        save_outputs(args, model, i, batch_scene_codes[j : j + 1])
+
+
+def run(args, device):
+    model = load_model(args, device)
+
+    timer.start("Processing images")
+    rembg_session = get_rembg_session(args)
+    images = [
+        preprocess_image(args, i, image_path, rembg_session)
+        for i, image_path in enumerate(args.image)
+    ]
+    timer.end("Processing images")
+
+    if args.batch_size > 0:
+        batch_size = args.batch_size
+    else:
+        memory_budget = get_memory_budget(args, device)
+        batch_size = model.get_max_batch_size(memory_budget, len(images))
+        logging.info(
+            f"Using batch size {batch_size} for a memory budget of {memory_budget / 1024**2:.0f}MB."
+        )
+
+    for batch_start in range(0, len(images), batch_size):
+        batch_images = images[batch_start : batch_start + batch_size]
+        logging.info(
+            f"Running images {batch_start + 1}-{batch_start + len(batch_images)}/{len(images)} ..."
+        )
+        run_batch(
+            args,
+            model,
+            device,
+            list(range(batch_start, batch_start + len(batch_images))),
+            batch_images,
+        )
+
+
+def worker(args, device, num_threads, jobs):
+    logging.basicConfig(
+        format="%(asctime)s - %(processName)s - %(levelname)s - %(message)s",
+        level=logging.INFO,
+        force=True,
+    )
+    torch.set_num_threads(num_threads)
+    model = load_model(args, device)
+    rembg_session = get_rembg_session(args)
+    batch_size = max(args.batch_size, 1)
+
+    done = False
+    while not done:
+        # block for the first image of a batch, then take whatever else is queued
+        batch = [jobs.get()]
+        while len(batch) < batch_size and batch[-1] is not None:
+            try:
+                batch.append(jobs.get_nowait())
+            except queue.Empty:
+                break
+        if batch[-1] is None:
+            batch.pop()
+            done = True
+        if len(batch) == 0:
+            continue
+
+        indices = [i for i, _ in batch]
+        logging.info(f"Running images {[i + 1 for i in indices]}/{len(args.image)} ...")
+        timer.start("Processing images")
+        images = [
+            preprocess_image(args, i, image_path, rembg_session)
+            for i, image_path in batch
+        ]
+        timer.end("Processing images")
+        run_batch(args, model, device, indices, images)
+
+
+def prepare_workers(args, device, num_threads):
+    # quantizing and saving the model, exporting the ONNX graph and tuning the chunk size are
+    # done once here rather than by every worker, which would race on the files
+    needs_quantized_model = (
+        args.quantize is not None
+        and args.quantized_model_path is not None
+        and not os.path.exists(args.quantized_model_path)
+    )
+    needs_onnx = args.backend == "onnx" and not os.path.exists(args.onnx_path)
+    if not (needs_quantized_model or needs_onnx or args.chunk_size == "auto"):
+        return args
+
+    # tune with the threads of a worker
+    torch.set_num_threads(num_threads)
+    model = load_model(args, device, compile=False)
+    args = copy.copy(args)
+    args.chunk_size = str(model.renderer.chunk_size)
+    del model
+    return args
+
+
+def run_workers(args, device):
+    num_threads = args.threads_per_worker or max(
+        1, (os.cpu_count() or 1) // args.workers
+    )
+    args = prepare_workers(args, device, num_threads)
+    # CUDA and the OpenMP thread pools do not survive fork
+    context = multiprocessing.get_context("spawn")
+    jobs = context.Queue()
+    for i, image_path in enumerate(args.image):
+        jobs.put((i, image_path))
+    for _ in range(args.workers):
+        jobs.put(None)
+
+    processes = [
+        context.Process(
+            target=worker,
+            args=(args, device, num_threads, jobs),
+            name=f"tsr-worker-{w}",
+        )
+        for w in range(args.workers)
+    ]
+    logging.info(
+        f"Starting {args.workers} workers with {num_threads} threads each ..."
+    )
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    failed = [process.name for process in processes if process.exitcode != 0]
+    if len(failed) > 0:
+        raise RuntimeError(f"Workers {failed} failed.")
+
+
+def main():
+    args = parser.parse_args()
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    device = args.device
+    if not torch.cuda.is_available():
+        device = "cpu"
+    if args.quantize is not None:
+        # dynamically quantized layers only run on CPU
+        device = "cpu"
+
+    if args.workers > 1:
+        run_workers(args, device)
+    else:
+        run(args, device)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+import json
+
+import pytest
+import torch
+from omegaconf import OmegaConf
+
+from tsr.models.nerf_renderer import TriplaneNeRFRenderer
+from tsr.models.network_utils import NeRFMLP
+from tsr.system import TSR
+from tsr.utils import get_spherical_cameras
+
+
+@pytest.fixture
+def renderer():
+    return TriplaneNeRFRenderer(
+        {
+            "radius": 0.87,
+            "feature_reduction": "concat",
+            "density_activation": "exp",
+            "density_bias": -5.0,
+            "num_samples_per_ray": 64,
+        }
+    )
+
+
+@pytest.fixture
+def decoder():
+    torch.manual_seed(0)
+    return NeRFMLP(
+        {"in_channels": 24, "n_neurons": 16, "n_hidden_layers": 2, "activation": "silu"}
+    )
+
+
+@pytest.fixture
+def triplane():
+    # features concentrated around the center of the planes, so that with the density
+    # bias of the renderer the scene is surrounded by empty space
+    torch.manual_seed(0)
+    x = torch.linspace(-1, 1, 16)
+    mask = torch.exp(-(x[:, None] ** 2 + x[None] ** 2) / 0.1)
+    return torch.randn(3, 8, 16, 16) * 4.0 * mask
+
+
+@pytest.fixture
+def rays():
+    return get_spherical_cameras(2, 0.0, 1.9, 40.0, 24, 24)
+
+
+@pytest.fixture(scope="session")
+def tiny_model_config(tmp_path_factory):
+    # a randomly initialized TSR small enough to run every path in a fraction of a second
+    vit_dir = tmp_path_factory.mktemp("vit")
+    with open(vit_dir / "config.json", "w") as f:
+        json.dump(
+            {
+                "architectures": ["ViTModel"],
+                "model_type": "vit",
+                "hidden_size": 32,
+                "intermediate_size": 64,
+                "num_attention_heads": 4,
+                "num_hidden_layers": 2,
+                "image_size": 64,
+                "patch_size": 16,
+                "num_channels": 3,
+                "qkv_bias": True,
+                "hidden_act": "gelu",
+                "hidden_dropout_prob": 0.0,
+                "attention_probs_dropout_prob": 0.0,
+            },
+            f,
+        )
+    return {
+        "cond_image_size": 64,
+        "image_tokenizer_cls": "tsr.models.tokenizers.image.DINOSingleImageTokenizer",
+        "image_tokenizer": {"pretrained_model_name_or_path": str(vit_dir)},
+        "tokenizer_cls": "tsr.models.tokenizers.triplane.Triplane1DTokenizer",
+        "tokenizer": {"plane_size": 8, "num_channels": 32},
+        "backbone_cls": "tsr.models.transformer.transformer_1d.Transformer1D",
+        "backbone": {
+            "in_channels": 32,
+            "num_attention_heads": 4,
+            "attention_head_dim": 8,
+            "num_layers": 2,
+            "cross_attention_dim": 32,
+        },
+        "post_processor_cls": "tsr.models.network_utils.TriplaneUpsampleNetwork",
+        "post_processor": {"in_channels": 32, "out_channels": 8},
+        "decoder_cls": "tsr.models.network_utils.NeRFMLP",
+        "decoder": {
+            "in_channels": 24,
+            "n_neurons": 16,
+            "n_hidden_layers": 3,
+            "activation": "silu",
+        },
+        "renderer_cls": "tsr.models.nerf_renderer.TriplaneNeRFRenderer",
+        "renderer": {
+            "radius": 0.87,
+            "feature_reduction": "concat",
+            "density_activation": "exp",
+            "density_bias": -1.0,
+            "num_samples_per_ray": 16,
+        },
+    }
+
+
+@pytest.fixture
+def tiny_model(tiny_model_config):
+    # set up as TSR.from_pretrained does after loading the weights
+    torch.manual_seed(0)
+    model = TSR(OmegaConf.create(tiny_model_config))
+    model.precompute_backbone_prefix()
+    return model.eval()
+
+
+@pytest.fixture
+def rgb_cond(tiny_model_config):
+    torch.manual_seed(0)
+    size = tiny_model_config["cond_image_size"]
+    return torch.rand(2, 1, size, size, 3)
@@ -0,0 +1,34 @@
+import torch
+
+from tsr.models.transformer.attention import Attention
+
+
+def get_scene_codes(model, rgb_cond):
+    with torch.no_grad():
+        return model.get_scene_codes(rgb_cond)
+
+
+def test_fused_projections_match(tiny_model, rgb_cond):
+    expected = get_scene_codes(tiny_model, rgb_cond)
+    n_parameters = sum(p.numel() for p in tiny_model.parameters())
+
+    tiny_model.fuse_qkv_projections()
+    attention_layers = [
+        m for m in tiny_model.backbone.modules() if isinstance(m, Attention)
+    ]
+    for attn in attention_layers:
+        assert attn.fused_projections
+        assert not hasattr(attn, "to_k") and not hasattr(attn, "to_v")
+    # the fused layers replace the separate ones
+    assert sum(p.numel() for p in tiny_model.parameters()) == n_parameters
+    assert torch.allclose(get_scene_codes(tiny_model, rgb_cond), expected, atol=1e-5)
+
+    # the tiled processors of the smallest budget read the fused layers as well
+    tiny_model.backbone.set_memory_budget(1)
+    assert torch.allclose(get_scene_codes(tiny_model, rgb_cond), expected, atol=1e-5)
+    tiny_model.backbone.set_memory_budget(None)
+
+    tiny_model.backbone.unfuse_qkv_projections()
+    for attn in attention_layers:
+        assert not attn.fused_projections and hasattr(attn, "to_q")
+    assert torch.allclose(get_scene_codes(tiny_model, rgb_cond), expected, atol=1e-5)
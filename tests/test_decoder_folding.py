@@ -0,0 +1,68 @@
+import pytest
+import torch
+import torch.nn.functional as F
+from einops import rearrange, reduce
+
+from tsr.models.nerf_renderer import TriplaneNeRFRenderer
+from tsr.models.network_utils import NeRFMLP
+from tsr.utils import scale_tensor
+
+
+def grid_sample_query(renderer, decoder, positions, triplane):
+    # the sampling and decoding of query_triplane before the fused sampler and folding
+    radius = renderer.cfg.radius
+    positions = scale_tensor(positions, (-radius, radius), (-1, 1))
+    indices2D = torch.stack(
+        (positions[..., [0, 1]], positions[..., [0, 2]], positions[..., [1, 2]]),
+        dim=-3,
+    )
+    out = F.grid_sample(
+        triplane,
+        rearrange(indices2D, "Np N Nd -> Np () N Nd", Np=3),
+        align_corners=False,
+        mode="bilinear",
+    )
+    if renderer.cfg.feature_reduction == "concat":
+        out = rearrange(out, "Np Cp () N -> N (Np Cp)", Np=3)
+    else:
+        out = reduce(out, "Np Cp () N -> N Cp", Np=3, reduction="mean")
+    return decoder(out)
+
+
+@pytest.mark.parametrize("feature_reduction", ["concat", "mean"])
+@pytest.mark.parametrize("chunk_size", [0, 1000])
+def test_folded_matches_grid_sample(feature_reduction, chunk_size):
+    torch.manual_seed(0)
+    renderer = TriplaneNeRFRenderer(
+        {
+            "radius": 0.87,
+            "feature_reduction": feature_reduction,
+            "density_activation": "exp",
+        }
+    )
+    renderer.set_chunk_size(chunk_size)
+    n_channels = 8
+    decoder = NeRFMLP(
+        {
+            "in_channels": 3 * n_channels if feature_reduction == "concat" else n_channels,
+            "n_neurons": 16,
+            "n_hidden_layers": 3,
+            "activation": "silu",
+        }
+    )
+    triplane = torch.randn(3, n_channels, 16, 16)
+    # include points outside the planes, where grid_sample pads with zeros
+    positions = (torch.rand(4096, 3) * 2.2 - 1.1) * renderer.cfg.radius
+
+    with torch.no_grad():
+        expected = grid_sample_query(renderer, decoder, positions, triplane)
+        renderer.set_fold_decoder_input(False)
+        unfolded = renderer.query_triplane(decoder, positions, triplane)
+        renderer.set_fold_decoder_input(True)
+        prepared = renderer.prepare_triplane(decoder, triplane)
+        assert prepared.first_linear is decoder.first_linear
+        folded = renderer.query_triplane(decoder, positions, prepared)
+
+    for k in ["density", "features"]:
+        assert torch.allclose(unfolded[k], expected[k], atol=1e-5, rtol=1e-4)
+        assert torch.allclose(folded[k], expected[k], atol=1e-5, rtol=1e-4)
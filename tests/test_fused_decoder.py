@@ -0,0 +1,45 @@
+import pytest
+import torch
+
+from tsr.models.network_utils import FusedNeRFMLP, NeRFMLP
+
+
+@pytest.mark.parametrize("num_threads", [1, 2])
+def test_fused_decoder_matches_mlp(decoder, num_threads):
+    x = torch.randn(1000, decoder.cfg.in_channels)
+    fused = FusedNeRFMLP(decoder, num_threads=num_threads, min_rows_per_thread=100)
+    with torch.no_grad():
+        expected = decoder(x)
+        actual = fused(x)
+        for k in ["density", "features"]:
+            assert torch.allclose(actual[k], expected[k], atol=1e-5, rtol=1e-4)
+
+        # only the requested outputs, from the output of the first linear layer
+        actual = fused(decoder.first_linear(x), outputs=["density"], from_first_linear=True)
+        assert list(actual.keys()) == ["density"]
+        assert torch.allclose(actual["density"], expected["density"], atol=1e-5, rtol=1e-4)
+    fused.close()
+
+
+def test_fused_decoder_follows_weight_updates(decoder):
+    x = torch.randn(100, decoder.cfg.in_channels)
+    fused = FusedNeRFMLP(decoder)
+    torch.manual_seed(1)
+    other = NeRFMLP(decoder.cfg)
+    with torch.no_grad():
+        fused(x)
+        # updated in place, the storage of the weights does not change
+        decoder.load_state_dict(other.state_dict())
+        expected = other(x)
+        actual = fused(x)
+    for k in ["density", "features"]:
+        assert torch.allclose(actual[k], expected[k], atol=1e-5, rtol=1e-4)
+
+
+def test_fused_decoder_render_matches(renderer, decoder, triplane, rays):
+    with torch.no_grad():
+        expected = renderer(decoder, triplane, *rays)
+        renderer.set_chunk_size(1000)
+        renderer.set_fused_decoder(FusedNeRFMLP(decoder))
+        actual = renderer(decoder, triplane, *rays)
+    assert torch.allclose(actual, expected, atol=1e-5, rtol=1e-4)
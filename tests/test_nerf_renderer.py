@@ -0,0 +1,79 @@
+import torch
+
+
+def render(renderer, decoder, triplane, rays):
+    with torch.no_grad():
+        return renderer(decoder, triplane, *rays)
+
+
+def test_occupancy_grid_matches_exact(renderer, decoder, triplane, rays):
+    expected = render(renderer, decoder, triplane, rays)
+    renderer.set_occupancy_grid_resolution(16)
+    renderer.reset_stats()
+    actual = render(renderer, decoder, triplane, rays)
+
+    assert renderer.stats["samples_skipped_empty"] > 0
+    # a dropped sample has a density below the threshold over an interval of at most the
+    # length of the ray, normalized to 1
+    assert torch.allclose(
+        actual, expected, atol=renderer.cfg.occupancy_threshold, rtol=0
+    )
+
+
+def test_early_termination_matches_composite(renderer):
+    torch.manual_seed(0)
+    n_rays, n_samples = 256, 64
+    # half of the rays turn opaque along the way, the others stay translucent
+    density = torch.rand(n_rays, n_samples, 1) * 40.0
+    density[n_rays // 2 :] *= 0.05
+    color = torch.rand(n_rays, n_samples, 3)
+    deltas = torch.full((n_samples,), 1.0 / n_samples)
+
+    expected_rgb, expected_opacity, _ = renderer._composite(
+        {"density_act": density, "color": color}, deltas, torch.ones(n_rays)
+    )
+
+    # the positions of a block are its samples, which the queries return as is
+    def get_positions(t, rays=slice(None)):
+        samples = t[0].long()
+        return {
+            "density_act": density[rays][:, samples],
+            "color": color[rays][:, samples],
+        }
+
+    renderer._query_samples = lambda decoder, triplane, samples, *args: samples
+    renderer.set_ray_block_size(8)
+    rgb, opacity = renderer._march_blocks(
+        None,
+        None,
+        get_positions,
+        torch.arange(n_samples, dtype=torch.float32),
+        deltas,
+        None,
+        None,
+        n_rays,
+    )
+
+    assert renderer.stats["samples_skipped_terminated"] > 0
+    # a terminated ray misses at most its remaining transmittance
+    eps = renderer.cfg.transmittance_eps
+    assert torch.allclose(rgb, expected_rgb, atol=eps, rtol=0)
+    assert torch.allclose(opacity, expected_opacity, atol=eps, rtol=0)
+
+
+def test_early_termination_matches_exact(renderer, decoder, triplane, rays):
+    expected = render(renderer, decoder, triplane, rays)
+    renderer.set_ray_block_size(8)
+    actual = render(renderer, decoder, triplane, rays)
+    assert torch.allclose(
+        actual, expected, atol=renderer.cfg.transmittance_eps, rtol=1e-5
+    )
+
+
+def test_prepared_triplane_matches(renderer, decoder, triplane, rays):
+    expected = render(renderer, decoder, triplane, rays)
+    with torch.no_grad():
+        prepared = renderer.prepare_triplane(decoder, triplane)
+        # reused across renders of the same scene
+        for _ in range(2):
+            assert torch.equal(renderer(decoder, prepared, *rays), expected)
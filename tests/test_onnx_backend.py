@@ -0,0 +1,24 @@
+import pytest
+import torch
+
+from tsr.onnx_backend import OnnxTriplaneEngine, export_onnx
+
+pytest.importorskip("onnx")
+pytest.importorskip("onnxruntime")
+
+
+@pytest.mark.parametrize("prefix", [True, False])
+def test_onnx_matches_eager(tiny_model, rgb_cond, tmp_path, prefix):
+    if not prefix:
+        tiny_model.backbone.clear_prefix()
+    path = str(tmp_path / "model.onnx")
+    # exported at batch size 1
+    export_onnx(tiny_model, path)
+    engine = OnnxTriplaneEngine(path)
+
+    for batch_size in [1, 2]:
+        with torch.no_grad():
+            expected = tiny_model.get_scene_codes(rgb_cond[:batch_size])
+        actual = engine(rgb_cond[:batch_size])
+        assert actual.shape == expected.shape
+        assert torch.allclose(actual, expected, atol=1e-5, rtol=1e-4)
@@ -0,0 +1,27 @@
+import torch
+
+
+def test_render_batch_matches_single_scenes(tiny_model, rgb_cond):
+    tiny_model.renderer.set_fold_decoder_input(True)
+    with torch.no_grad():
+        scene_codes = tiny_model.get_scene_codes(rgb_cond)
+    kwargs = dict(n_views=3, height=16, width=16, return_type="pt")
+    images = tiny_model.render(scene_codes, **kwargs)
+    # one step per view, with the triplanes prepared once per scene
+    frames = [
+        [
+            frame
+            for step in tiny_model.render_iter(scene_codes[i : i + 1], **kwargs)
+            for frame in step[0]
+        ]
+        for i in range(scene_codes.shape[0])
+    ]
+    for i in range(scene_codes.shape[0]):
+        for actual, expected in zip(images[i], frames[i]):
+            assert torch.allclose(actual, expected, atol=1e-5, rtol=1e-4)
+
+
+def test_render_no_views(tiny_model, rgb_cond):
+    with torch.no_grad():
+        scene_codes = tiny_model.get_scene_codes(rgb_cond)
+    assert tiny_model.render(scene_codes, n_views=0, height=16, width=16) == [[], []]
@@ -0,0 +1,52 @@
+import pytest
+import torch
+import torch.nn.functional as F
+from einops import rearrange, reduce
+
+from tsr.models.triplane_sampler import TriplaneSampler
+from tsr.utils import Workspace
+
+
+def grid_sample_features(triplane, positions, reduction):
+    # the sampling of query_triplane before TriplaneSampler
+    indices2D = torch.stack(
+        (positions[..., [0, 1]], positions[..., [0, 2]], positions[..., [1, 2]]),
+        dim=-3,
+    )
+    out = F.grid_sample(
+        triplane,
+        rearrange(indices2D, "Np N Nd -> Np () N Nd", Np=3),
+        align_corners=False,
+        mode="bilinear",
+    )
+    if reduction == "concat":
+        return rearrange(out, "Np Cp () N -> N (Np Cp)", Np=3)
+    return reduce(out, "Np Cp () N -> N Cp", Np=3, reduction=reduction)
+
+
+@pytest.mark.parametrize("reduction", ["concat", "sum", "mean"])
+@pytest.mark.parametrize("use_workspace", [False, True])
+def test_sampler_matches_grid_sample(reduction, use_workspace):
+    torch.manual_seed(0)
+    triplanes = torch.randn(2, 3, 8, 16, 16)
+    # include points outside the planes, where grid_sample pads with zeros
+    positions = torch.rand(1000, 3) * 2.2 - 1.1
+    scene_index = torch.randint(0, 2, (1000,))
+    workspace = Workspace() if use_workspace else None
+
+    sampler = TriplaneSampler(triplanes[0], reduction=reduction)
+    actual = sampler(positions, workspace=workspace)
+    expected = grid_sample_features(triplanes[0], positions, reduction)
+    assert torch.allclose(actual, expected, atol=1e-5, rtol=1e-4)
+
+    # the same sampler for several batches of points of a batch of scenes
+    sampler = TriplaneSampler(triplanes, reduction=reduction)
+    for batch in torch.split(torch.arange(1000), 300):
+        actual = sampler(positions[batch], scene_index[batch], workspace=workspace)
+        expected = torch.stack(
+            [
+                grid_sample_features(triplanes[i], positions[batch], reduction)
+                for i in range(2)
+            ]
+        )[scene_index[batch], torch.arange(batch.shape[0])]
+        assert torch.allclose(actual, expected, atol=1e-5, rtol=1e-4)
@@ -0,0 +1,37 @@
+import os
+
+import torch
+
+from tsr.utils import load_state_dict_mmap
+
+
+def save_legacy_checkpoint(path):
+    state_dict = {"weight": torch.randn(4, 4), "bias": torch.randn(4)}
+    torch.save(state_dict, path, _use_new_zipfile_serialization=False)
+    return state_dict
+
+
+def test_load_legacy_checkpoint_mmap(tmp_path, monkeypatch):
+    weight_dir = tmp_path / "weights"
+    weight_dir.mkdir()
+    weight_path = str(weight_dir / "model.ckpt")
+    expected = save_legacy_checkpoint(weight_path)
+    monkeypatch.setenv("TSR_CACHE_DIR", str(tmp_path / "cache"))
+
+    for _ in range(2):
+        state_dict = load_state_dict_mmap(weight_path)
+        assert all(torch.equal(state_dict[k], expected[k]) for k in expected)
+    # converted once into the cache directory, nothing is written next to the checkpoint
+    assert os.listdir(weight_dir) == ["model.ckpt"]
+    assert len(os.listdir(tmp_path / "cache" / "mmap")) == 1
+
+
+def test_load_legacy_checkpoint_unwritable_cache(tmp_path, monkeypatch):
+    weight_path = str(tmp_path / "model.ckpt")
+    expected = save_legacy_checkpoint(weight_path)
+    # a file where the cache directory should be
+    (tmp_path / "cache").write_text("")
+    monkeypatch.setenv("TSR_CACHE_DIR", str(tmp_path / "cache"))
+
+    state_dict = load_state_dict_mmap(weight_path)
+    assert all(torch.equal(state_dict[k], expected[k]) for k in expected)
@@ -141,6 +141,7 @@ def positions_to_colors(model, scene_code, positions_texture, texture_resolution
             model.decoder,
             positions,
             scene_code,
+            keys=["color"],
         )
     rgb_f = queried_grid["color"].numpy().reshape(-1, 3)
     rgba_f = np.insert(rgb_f, 3, positions_texture.reshape(-1, 4)[:, -1], axis=1)
@@ -0,0 +1,197 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+import numpy as np
+import torch
+
+from .utils import get_spherical_cameras, rays_intersect_bbox
+
+
+class SceneCodeCache:
+    """
+    Two-tier cache of scene codes keyed by a hash of the preprocessed
+    conditioning image and the identity of the model that produced them.
+
+    The memory tier is an LRU of at most `max_items` entries. If `cache_dir` is
+    given, every entry is also written there as an `.npy` file in `disk_dtype`,
+    which is memory-mapped back without a copy on a memory miss. A `disk_dtype` of
+    torch.float16 halves the files but is lossy: scene codes read back from disk are
+    rounded, so their meshes can differ slightly from the ones of the fp32 codes.
+    Entries keep the dtype they were stored in; callers convert them to fp32 on
+    their device.
+    """
+
+    def __init__(
+        self,
+        max_items: int = 32,
+        cache_dir: Optional[str] = None,
+        disk_dtype: torch.dtype = torch.float32,
+    ) -> None:
+        self.max_items = max_items
+        self.cache_dir = cache_dir
+        self.disk_dtype = disk_dtype
+        self.memory: "OrderedDict[str, torch.Tensor]" = OrderedDict()
+        self.lock = threading.Lock()
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def __getstate__(self) -> dict:
+        # locks can't be copied or pickled, the copy gets its own
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def make_key(rgb_cond: torch.Tensor, identity: str) -> str:
+        rgb_cond = rgb_cond.detach().to("cpu", torch.float32).contiguous()
+        h = hashlib.sha256(identity.encode())
+        h.update(str(tuple(rgb_cond.shape)).encode())
+        h.update(rgb_cond.numpy().tobytes())
+        return h.hexdigest()
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.npy")
+
+    def get(self, key: str) -> Optional[torch.Tensor]:
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                return self.memory[key]
+
+        if self.cache_dir is None or not os.path.exists(self._disk_path(key)):
+            return None
+        # copy-on-write mapping, so that the tensor is writable without reading the file
+        scene_code = torch.from_numpy(np.load(self._disk_path(key), mmap_mode="c"))
+        self._put_memory(key, scene_code)
+        return scene_code
+
+    def put(self, key: str, scene_code: torch.Tensor) -> None:
+        scene_code = scene_code.detach().clone()
+        self._put_memory(key, scene_code)
+
+        if self.cache_dir is not None:
+            # write to a temporary file first so that concurrent readers never see a partial file
+            tmp_path = self._disk_path(key) + f".{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                np.save(f, scene_code.to("cpu", self.disk_dtype).numpy())
+            os.replace(tmp_path, self._disk_path(key))
+
+    def _put_memory(self, key: str, scene_code: torch.Tensor) -> None:
+        if self.max_items <= 0:
+            return
+        with self.lock:
+            self.memory[key] = scene_code
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.max_items:
+                self.memory.popitem(last=False)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.memory.clear()
+
+
+@dataclass
+class CameraRays:
+    """
+    Rays of the spherical cameras of `get_spherical_cameras`, compacted to the M rays that
+    hit the bounding box, with their intersections. `valid_index` gives the position of every
+    kept ray in the flattened (n_views, height, width) images; the rays of view i are
+    `view_offsets[i]:view_offsets[i + 1]`.
+    """
+
+    shape: Tuple[int, int, int]
+    valid_index: torch.LongTensor  # (M,)
+    view_offsets: List[int]  # (n_views + 1,)
+    rays_o: torch.FloatTensor  # (M, 3)
+    rays_d: torch.FloatTensor  # (M, 3)
+    t_near: torch.FloatTensor  # (M, 1)
+    t_far: torch.FloatTensor  # (M, 1)
+
+
+class CameraRaysCache:
+    """
+    LRU of at most `max_items` sets of spherical camera rays, keyed by the camera
+    parameters, the bounding box radius and the device, so that renders with the same
+    cameras skip building the rays and intersecting them with the bounding box.
+    """
+
+    def __init__(self, max_items: int = 8) -> None:
+        self.max_items = max_items
+        self.memory: "OrderedDict[tuple, CameraRays]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __getstate__(self) -> dict:
+        # locks can't be copied or pickled, the copy gets its own
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def get(
+        self,
+        n_views: int,
+        elevation_deg: float,
+        camera_distance: float,
+        fovy_deg: float,
+        height: int,
+        width: int,
+        radius: float,
+        device: torch.device,
+    ) -> CameraRays:
+        key = (
+            n_views,
+            float(elevation_deg),
+            float(camera_distance),
+            float(fovy_deg),
+            height,
+            width,
+            float(radius),
+            str(device),
+        )
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                return self.memory[key]
+
+        rays_o, rays_d = get_spherical_cameras(
+            n_views, elevation_deg, camera_distance, fovy_deg, height, width
+        )
+        rays_o, rays_d = rays_o.to(device).reshape(-1, 3), rays_d.to(device).reshape(-1, 3)
+        t_near, t_far, rays_valid = rays_intersect_bbox(rays_o, rays_d, radius)
+        valid_index = rays_valid.nonzero()[:, 0]
+        view_offsets = torch.searchsorted(
+            valid_index,
+            torch.arange(n_views + 1, device=valid_index.device) * (height * width),
+        )
+        rays = CameraRays(
+            shape=(n_views, height, width),
+            valid_index=valid_index,
+            view_offsets=view_offsets.tolist(),
+            rays_o=rays_o[valid_index].contiguous(),
+            rays_d=rays_d[valid_index].contiguous(),
+            t_near=t_near[valid_index].contiguous(),
+            t_far=t_far[valid_index].contiguous(),
+        )
+
+        if self.max_items > 0:
+            with self.lock:
+                self.memory[key] = rays
+                self.memory.move_to_end(key)
+                while len(self.memory) > self.max_items:
+                    self.memory.popitem(last=False)
+        return rays
+
+    def clear(self) -> None:
+        with self.lock:
+            self.memory.clear()
@@ -0,0 +1,181 @@
+import math
+from typing import Dict, Iterator, List, Optional
+
+import moderngl
+import numpy as np
+import trimesh
+from PIL import Image
+
+from .utils import get_spherical_camera_poses
+
+VERTEX_COLOR_PROGRAM = {
+    "vertex_shader": """
+        #version 330
+        uniform mat4 u_mvp;
+        in vec3 in_pos;
+        in vec3 in_color;
+        out vec3 v_color;
+        void main() {
+            v_color = in_color;
+            gl_Position = u_mvp * vec4(in_pos, 1.0);
+        }
+    """,
+    "fragment_shader": """
+        #version 330
+        in vec3 v_color;
+        out vec4 o_col;
+        void main() {
+            o_col = vec4(v_color, 1.0);
+        }
+    """,
+}
+
+TEXTURE_PROGRAM = {
+    "vertex_shader": """
+        #version 330
+        uniform mat4 u_mvp;
+        in vec3 in_pos;
+        in vec2 in_uv;
+        out vec2 v_uv;
+        void main() {
+            v_uv = in_uv;
+            gl_Position = u_mvp * vec4(in_pos, 1.0);
+        }
+    """,
+    "fragment_shader": """
+        #version 330
+        uniform sampler2D u_texture;
+        in vec2 v_uv;
+        out vec4 o_col;
+        void main() {
+            o_col = vec4(texture(u_texture, v_uv).rgb, 1.0);
+        }
+    """,
+}
+
+
+def create_context() -> moderngl.Context:
+    try:
+        return moderngl.create_context(standalone=True)
+    except Exception:
+        # no X display, e.g. on a headless server
+        return moderngl.create_context(standalone=True, backend="egl")
+
+
+def get_projection_matrix(
+    fovy_deg: float, aspect: float, near: float = 0.01, far: float = 100.0
+) -> np.ndarray:
+    f = 1.0 / math.tan(math.radians(fovy_deg) / 2.0)
+    return np.array(
+        [
+            [f / aspect, 0.0, 0.0, 0.0],
+            [0.0, f, 0.0, 0.0],
+            [0.0, 0.0, (far + near) / (near - far), 2.0 * far * near / (near - far)],
+            [0.0, 0.0, -1.0, 0.0],
+        ],
+        dtype=np.float32,
+    )
+
+
+def render_mesh_turntable(
+    mesh: trimesh.Trimesh,
+    n_views: int,
+    elevation_deg: float = 0.0,
+    camera_distance: float = 1.9,
+    fovy_deg: float = 40.0,
+    height: int = 256,
+    width: int = 256,
+    texture: Optional[Dict[str, np.ndarray]] = None,
+    samples: int = 4,
+) -> List[Image.Image]:
+    """
+    Rasterize `mesh` from the cameras of `TSR.render`, unlit on a white background like the
+    volume renders. The colors come from the vertex colors of the mesh, or from `texture`, the
+    output of `bake_texture`. `samples` is the number of MSAA samples per pixel.
+    """
+    return list(
+        iter_mesh_turntable(
+            mesh,
+            n_views,
+            elevation_deg=elevation_deg,
+            camera_distance=camera_distance,
+            fovy_deg=fovy_deg,
+            height=height,
+            width=width,
+            texture=texture,
+            samples=samples,
+        )
+    )
+
+
+def iter_mesh_turntable(
+    mesh: trimesh.Trimesh,
+    n_views: int,
+    elevation_deg: float = 0.0,
+    camera_distance: float = 1.9,
+    fovy_deg: float = 40.0,
+    height: int = 256,
+    width: int = 256,
+    texture: Optional[Dict[str, np.ndarray]] = None,
+    samples: int = 4,
+) -> Iterator[Image.Image]:
+    """
+    Same as `render_mesh_turntable`, yielding the frames one by one as they are rendered.
+    """
+    ctx = create_context()
+    try:
+        if texture is not None:
+            prog = ctx.program(**TEXTURE_PROGRAM)
+            vertices = mesh.vertices[texture["vmapping"]]
+            indices = texture["indices"]
+            attributes = [("in_uv", "2f", texture["uvs"])]
+            resolution = texture["colors"].shape[0]
+            # the baked texture is stored in the row order OpenGL expects
+            gl_texture = ctx.texture(
+                (resolution, resolution),
+                4,
+                np.ascontiguousarray(texture["colors"], dtype="f4").tobytes(),
+                dtype="f4",
+            )
+            gl_texture.filter = (moderngl.LINEAR, moderngl.LINEAR)
+            gl_texture.use(0)
+            prog["u_texture"].value = 0
+        else:
+            prog = ctx.program(**VERTEX_COLOR_PROGRAM)
+            vertices = mesh.vertices
+            indices = mesh.faces
+            colors = mesh.visual.vertex_colors[:, :3].astype(np.float32) / 255.0
+            attributes = [("in_color", "3f", colors)]
+
+        content = [(ctx.buffer(np.ascontiguousarray(vertices, dtype="f4")), "3f", "in_pos")]
+        for name, layout, data in attributes:
+            content.append((ctx.buffer(np.ascontiguousarray(data, dtype="f4")), layout, name))
+        vao = ctx.vertex_array(
+            prog, content, ctx.buffer(np.ascontiguousarray(indices, dtype="i4"))
+        )
+
+        samples = min(samples, ctx.max_samples)
+        fbo = ctx.framebuffer(
+            color_attachments=[ctx.renderbuffer((width, height), 4, samples=samples)],
+            depth_attachment=ctx.depth_renderbuffer((width, height), samples=samples),
+        )
+        resolved = ctx.framebuffer(
+            color_attachments=[ctx.renderbuffer((width, height), 4)]
+        )
+        ctx.enable(moderngl.DEPTH_TEST)
+
+        projection = get_projection_matrix(fovy_deg, width / height)
+        c2w = get_spherical_camera_poses(n_views, elevation_deg, camera_distance).numpy()
+        for i in range(n_views):
+            mvp = projection @ np.linalg.inv(c2w[i])
+            # moderngl expects column-major matrices
+            prog["u_mvp"].write(mvp.T.astype("f4").tobytes())
+            fbo.use()
+            fbo.clear(1.0, 1.0, 1.0, 1.0)
+            vao.render()
+            ctx.copy_framebuffer(resolved, fbo)
+            image = np.frombuffer(resolved.read(components=3), dtype=np.uint8)
+            # OpenGL rows start at the bottom
+            yield Image.fromarray(image.reshape(height, width, 3)[::-1])
+    finally:
+        ctx.release()
@@ -1,17 +1,45 @@
 from dataclasses import dataclass
-from typing import Dict
+from typing import Callable, Dict, Optional, Sequence, Union
 
 import torch
 import torch.nn.functional as F
-from einops import rearrange, reduce
+from einops import rearrange, repeat
 
 from ..utils import (
     BaseModule,
+    Workspace,
     chunk_batch,
+    chunk_batch_into,
     get_activation,
     rays_intersect_bbox,
+    sample_pdf,
     scale_tensor,
 )
+from .network_utils import FusedNeRFMLP
+from .triplane_sampler import TriplaneSampler
+
+
+@dataclass
+class PreparedTriplane:
+    """
+    Triplanes of `TriplaneNeRFRenderer.prepare_triplane`, laid out for sampling and with
+    the first decoder layer applied to every texel if it is folded into them, for all the
+    queries of a scene.
+    """
+
+    sampler: TriplaneSampler
+    # the folded layer, None if the planes hold the raw features
+    first_linear: Optional[torch.nn.Linear]
+    # whether the triplanes were a batch (B, 3, Cp, Hp, Wp) of scenes
+    batched: bool
+
+    @property
+    def n_scenes(self) -> int:
+        return self.sampler.layout.shape[0]
+
+    @property
+    def device(self) -> torch.device:
+        return self.sampler.layout.device
 
 
 class TriplaneNeRFRenderer(BaseModule):
@@ -25,12 +53,36 @@ class TriplaneNeRFRenderer(BaseModule):
         color_activation: str = "sigmoid"
         num_samples_per_ray: int = 128
         randomized: bool = False
+        # empty-space skipping, 0 to query every sample. Approximate: samples in cells whose
+        # density stays below occupancy_threshold are dropped.
+        occupancy_grid_resolution: int = 0
+        occupancy_threshold: float = 0.01
+        occupancy_dilation: int = 1
+        # early ray termination, 0 to composite all samples of a ray at once. Approximate:
+        # rays are dropped once their transmittance falls below transmittance_eps.
+        ray_block_size: int = 0
+        transmittance_eps: float = 1e-4
+        # rays rendered per pass over all views and scenes, 0 to render all at once
+        ray_chunk_size: int = 262144
+        # coarse-to-fine sampling, 0 to sample uniformly. If set, num_samples_per_ray is the
+        # number of coarse samples and the rays are not terminated early.
+        num_importance_samples: int = 0
 
     cfg: Config
 
     def configure(self) -> None:
         assert self.cfg.feature_reduction in ["concat", "mean"]
         self.chunk_size = 0
+        self.decoder_dtype = torch.float32
+        self.pad_last_chunk = False
+        self.fused_decoder = None
+        self.fold_decoder_input = False
+        self.occupancy_grid_resolution = self.cfg.occupancy_grid_resolution
+        self.ray_block_size = self.cfg.ray_block_size
+        self.ray_chunk_size = self.cfg.ray_chunk_size
+        self.randomized = False
+        self.workspace = Workspace()
+        self.reset_stats()
 
     def set_chunk_size(self, chunk_size: int):
         assert (
@@ -38,138 +90,644 @@ class TriplaneNeRFRenderer(BaseModule):
         ), "chunk_size must be a non-negative integer (0 for no chunking)."
         self.chunk_size = chunk_size
 
+    def estimate_query_memory(
+        self,
+        decoder: torch.nn.Module,
+        n_points: int,
+        chunk_size: Optional[int] = None,
+        keys: Optional[Sequence[str]] = None,
+    ) -> int:
+        """
+        Rough estimate (in bytes) of the peak memory of query_triplane for `n_points`
+        positions and the outputs in `keys` (all by default), decoded `chunk_size` at a time
+        (the current chunk size by default), without the triplanes themselves.
+        """
+        if chunk_size is None:
+            chunk_size = self.chunk_size
+        if chunk_size <= 0:
+            chunk_size = n_points
+        if not self.pad_last_chunk:
+            chunk_size = min(chunk_size, n_points)
+
+        widths = [
+            (m.in_features, m.out_features)
+            for m in decoder.modules()
+            if hasattr(m, "in_features") and hasattr(m, "out_features")
+        ]
+        element_size = torch.finfo(self.decoder_dtype).bits // 8
+        # corner indices (int64) and weights of the three planes, and their temporaries
+        sampler = 12 * (8 + 4) + 12 * 4
+        # the sampled features stay alive while the decoder runs, the activations are
+        # computed in place so at most the input and the output of one layer coexist
+        decoder_memory = widths[0][0] * 4 + max(a + b for a, b in widths) * element_size
+        # the decoder outputs of a chunk, their activations and the temporaries of those
+        chunk_outputs = 3 * 4 * 4
+        # the scaled positions and the kept outputs
+        channels = {"density": 1, "features": 3, "density_act": 1, "color": 3}
+        if keys is None:
+            keys = list(channels.keys())
+        outputs = (3 + sum(channels[k] for k in keys)) * 4
+        return n_points * outputs + chunk_size * (sampler + decoder_memory + chunk_outputs)
+
+    def estimate_render_memory(
+        self, decoder: torch.nn.Module, n_rays: int, n_scenes: int = 1
+    ) -> int:
+        """
+        Rough estimate (in bytes) of the peak memory of `forward` for `n_rays` rays of
+        `n_scenes` scenes, assuming that all rays hit the bounding box and that no sample
+        is skipped, without the rays and the triplanes themselves.
+        """
+        occupancy = 0
+        if self.occupancy_grid_resolution > 0:
+            n_corners = n_scenes * (self.occupancy_grid_resolution + 1) ** 3
+            # the corners, and the occupancy of the corners and of the cells
+            occupancy = (
+                self.estimate_query_memory(decoder, n_corners, keys=["density_act"])
+                + n_corners * 6 * 4
+            )
+
+        rays = n_rays if self.ray_chunk_size <= 0 else min(n_rays, self.ray_chunk_size)
+        n_samples = self.cfg.num_samples_per_ray
+        if self.cfg.num_importance_samples > 0:
+            # coarse and fine samples are composited together, after a sorted copy
+            n_samples = 2 * (n_samples + self.cfg.num_importance_samples)
+        elif 0 < self.ray_block_size < n_samples:
+            n_samples = self.ray_block_size
+        # positions, occupancy lookup, scattered decoder outputs and compositing weights
+        per_sample = (3 + 1 + 3 + 4 + 6) * 4 + 3 * 8 + 1
+        # per ray: origin, direction, intersections, index, color, opacity and
+        # transmittance while rendering, and the colors of all rays
+        per_ray = 16 * 4 + 8
+        samples = rays * n_samples
+        return max(
+            occupancy,
+            samples * per_sample
+            + self.estimate_query_memory(decoder, samples, keys=["density_act", "color"])
+            + rays * per_ray
+            + n_rays * 3 * 4 * 2,
+        )
+
+    def set_decoder_dtype(self, dtype: torch.dtype):
+        self.decoder_dtype = dtype
+
+    def set_fused_decoder(self, fused_decoder: Optional[FusedNeRFMLP]):
+        # used in place of its MLP when that is the decoder queried in fp32
+        self.fused_decoder = fused_decoder
+
+    def set_pad_last_chunk(self, pad_last_chunk: bool):
+        # pad the last, shorter chunk to chunk_size so that the decoder always sees the same shape
+        self.pad_last_chunk = pad_last_chunk
+
+    def set_fold_decoder_input(self, fold_decoder_input: bool):
+        # only pays off when the first decoder layer is not wider than the sampled features,
+        # otherwise sampling the projected planes costs more than the GEMM it saves
+        self.fold_decoder_input = fold_decoder_input
+
+    def set_ray_block_size(self, ray_block_size: int):
+        assert (
+            ray_block_size >= 0
+        ), "ray_block_size must be a non-negative integer (0 to disable early termination)."
+        self.ray_block_size = ray_block_size
+
+    def set_ray_chunk_size(self, ray_chunk_size: int):
+        assert (
+            ray_chunk_size >= 0
+        ), "ray_chunk_size must be a non-negative integer (0 to render all rays at once)."
+        self.ray_chunk_size = ray_chunk_size
+
+    def reset_stats(self):
+        # sample counts of the renders since the last reset: all samples on rays hitting the
+        # bounding box, the ones actually decoded, and the ones skipped by empty-space skipping
+        # and by early ray termination
+        self.stats: Dict[str, int] = {
+            "samples": 0,
+            "samples_queried": 0,
+            "samples_skipped_empty": 0,
+            "samples_skipped_terminated": 0,
+        }
+
+    def set_occupancy_grid_resolution(self, resolution: int):
+        assert resolution >= 0, "resolution must be a non-negative integer (0 to disable)."
+        self.occupancy_grid_resolution = resolution
+
+    @torch.no_grad()
+    def build_occupancy_grid(
+        self, decoder: torch.nn.Module, triplane: Union[torch.Tensor, PreparedTriplane]
+    ) -> Optional[torch.Tensor]:
+        """
+        Coarse occupancy bitfield of shape (R, R, R) over the bounding box of one scene, with R
+        the occupancy grid resolution, or (B, R, R, R) for batched triplanes. The density is
+        evaluated at the cell corners; a cell is occupied if the density at any of its corners
+        exceeds `occupancy_threshold`, and the occupied cells are dilated by
+        `occupancy_dilation` cells to cover thin structures between corners. Returns None if
+        empty-space skipping is disabled.
+        """
+        resolution = self.occupancy_grid_resolution
+        if resolution <= 0:
+            return None
+        if not isinstance(triplane, PreparedTriplane):
+            triplane = self.prepare_triplane(decoder, triplane)
+        coords = torch.linspace(
+            -self.cfg.radius, self.cfg.radius, resolution + 1, device=triplane.device
+        )
+        corners = torch.stack(torch.meshgrid(coords, coords, coords, indexing="ij"), dim=-1)
+        if triplane.batched:
+            corners = corners.expand(triplane.n_scenes, *corners.shape)
+        density = self.query_triplane(decoder, corners, triplane, keys=["density_act"])[
+            "density_act"
+        ]
+        occupied = (density[..., 0] > self.cfg.occupancy_threshold).float()
+        occupied = F.max_pool3d(
+            occupied.view(-1, 1, *occupied.shape[-3:]), kernel_size=2, stride=1
+        )
+        if self.cfg.occupancy_dilation > 0:
+            occupied = F.max_pool3d(
+                occupied,
+                kernel_size=2 * self.cfg.occupancy_dilation + 1,
+                stride=1,
+                padding=self.cfg.occupancy_dilation,
+            )
+        occupied = occupied[:, 0] > 0
+        return occupied if triplane.batched else occupied[0]
+
+    def project_triplane(
+        self, linear: torch.nn.Linear, triplane: torch.Tensor
+    ) -> torch.Tensor:
+        """
+        Apply `linear`, the first layer of the decoder, to every texel of the planes, split
+        according to the feature reduction. Bilinear sampling commutes with the linear map, so
+        summing the samples of the projected planes and adding the bias gives the output of
+        the first decoder layer for the sampled features.
+        """
+        weight = linear.weight.to(triplane.dtype)
+        if self.cfg.feature_reduction == "concat":
+            weight = rearrange(weight, "Co (Np Cp) -> Np Co Cp", Np=3)
+        elif self.cfg.feature_reduction == "mean":
+            weight = repeat(weight / 3.0, "Co Cp -> Np Co Cp", Np=3)
+        else:
+            raise NotImplementedError
+        return torch.einsum("poc,...pchw->...pohw", weight, triplane)
+
+    def prepare_triplane(
+        self, decoder: torch.nn.Module, triplane: torch.Tensor
+    ) -> PreparedTriplane:
+        """
+        Prepare the triplanes of one scene (or a batch of scenes) for `query_triplane`,
+        `build_occupancy_grid` and `forward`, so that the work that only depends on the
+        scene (folding the first decoder layer and laying out the planes) is done once for
+        all its queries.
+        """
+        batched = triplane.ndim == 5
+        first_linear = (
+            getattr(decoder, "first_linear", None) if self.fold_decoder_input else None
+        )
+        if first_linear is not None:
+            # once per scene instead of once per point
+            triplane = self.project_triplane(first_linear, triplane)
+            # the first decoder layer is linear, so the projected planes are summed
+            sampler = TriplaneSampler(triplane, reduction="sum")
+        elif self.cfg.feature_reduction in ["concat", "mean"]:
+            sampler = TriplaneSampler(triplane, reduction=self.cfg.feature_reduction)
+        else:
+            raise NotImplementedError
+        return PreparedTriplane(sampler=sampler, first_linear=first_linear, batched=batched)
+
     def query_triplane(
         self,
         decoder: torch.nn.Module,
         positions: torch.Tensor,
-        triplane: torch.Tensor,
+        triplane: Union[torch.Tensor, PreparedTriplane],
+        scene_index: Optional[torch.Tensor] = None,
+        keys: Optional[Sequence[str]] = None,
     ) -> Dict[str, torch.Tensor]:
+        """
+        Decode the triplane features at `positions`. For batched triplanes of shape
+        (B, 3, Cp, Hp, Wp), `scene_index` gives the scene of every position; if omitted,
+        `positions` must have a leading batch dimension. `keys` selects the outputs among
+        density, features, density_act and color, all by default; the others are not kept
+        past the chunk they are computed in. `triplane` may come from `prepare_triplane`
+        with the same decoder.
+        """
+        if not isinstance(triplane, PreparedTriplane):
+            triplane = self.prepare_triplane(decoder, triplane)
+        first_linear = triplane.first_linear
+        sampler = triplane.sampler
+
         input_shape = positions.shape[:-1]
-        positions = positions.view(-1, 3)
+        positions = positions.reshape(-1, 3)
+        if triplane.batched:
+            if scene_index is None:
+                scene_index = torch.arange(triplane.n_scenes, device=positions.device)
+                scene_index = scene_index.view(-1, *[1] * (len(input_shape) - 1))
+                scene_index = scene_index.expand(input_shape)
+            scene_index = scene_index.reshape(-1)
 
         # positions in (-radius, radius)
-        # normalized to (-1, 1) for grid sample
+        # normalized to (-1, 1) for sampling the planes
         positions = scale_tensor(
             positions, (-self.cfg.radius, self.cfg.radius), (-1, 1)
         )
 
-        def _query_chunk(x):
-            indices2D: torch.Tensor = torch.stack(
-                (x[..., [0, 1]], x[..., [0, 2]], x[..., [1, 2]]),
-                dim=-3,
-            )
-            out: torch.Tensor = F.grid_sample(
-                rearrange(triplane, "Np Cp Hp Wp -> Np Cp Hp Wp", Np=3),
-                rearrange(indices2D, "Np N Nd -> Np () N Nd", Np=3),
-                align_corners=False,
-                mode="bilinear",
-            )
-            if self.cfg.feature_reduction == "concat":
-                out = rearrange(out, "Np Cp () N -> N (Np Cp)", Np=3)
-            elif self.cfg.feature_reduction == "mean":
-                out = reduce(out, "Np Cp () N -> N Cp", Np=3, reduction="mean")
-            else:
-                raise NotImplementedError
+        # the scratch buffers of the chunks are reused across calls, which only pays off
+        # and only bounds their size when chunking
+        workspace = self.workspace if self.chunk_size > 0 else None
 
-            net_out: Dict[str, torch.Tensor] = decoder(out)
+        fused_decoder = None
+        if (
+            self.fused_decoder is not None
+            and self.fused_decoder.mlp is decoder
+            and self.decoder_dtype == torch.float32
+        ):
+            fused_decoder = self.fused_decoder
+        # the decoder outputs the kept keys are computed from
+        decoder_outputs = [
+            name
+            for name, dependents in [
+                ("density", ["density", "density_act"]),
+                ("features", ["features", "color"]),
+            ]
+            if keys is None or any(k in keys for k in dependents)
+        ]
+
+        def _query_chunk(x, s=None):
+            n_points = x.shape[0]
+            if self.pad_last_chunk and 0 < n_points < self.chunk_size:
+                x = F.pad(x, (0, 0, 0, self.chunk_size - n_points))
+                if s is not None:
+                    s = F.pad(s, (0, self.chunk_size - n_points))
+
+            out = sampler(x, s, workspace=workspace)
+            if first_linear is not None and first_linear.bias is not None:
+                out.add_(first_linear.bias)
+
+            if fused_decoder is not None:
+                net_out: Dict[str, torch.Tensor] = fused_decoder(
+                    out,
+                    outputs=decoder_outputs,
+                    workspace=workspace,
+                    from_first_linear=first_linear is not None,
+                )
+            else:
+                with torch.autocast(
+                    device_type=out.device.type,
+                    dtype=self.decoder_dtype,
+                    enabled=self.decoder_dtype != torch.float32,
+                ):
+                    if first_linear is not None:
+                        net_out: Dict[str, torch.Tensor] = (
+                            decoder.forward_from_first_linear(out)
+                        )
+                    else:
+                        net_out: Dict[str, torch.Tensor] = decoder(out)
+            # activations and thresholding on the decoder output always run in fp32
+            net_out = {k: v[:n_points].float() for k, v in net_out.items()}
+            if "density" in net_out:
+                net_out["density_act"] = get_activation(self.cfg.density_activation)(
+                    net_out["density"] + self.cfg.density_bias
+                )
+            if "features" in net_out:
+                net_out["color"] = get_activation(self.cfg.color_activation)(
+                    net_out["features"]
+                )
             return net_out
 
         if self.chunk_size > 0:
-            net_out = chunk_batch(_query_chunk, self.chunk_size, positions)
+            # written chunk by chunk into the outputs
+            net_out = chunk_batch_into(
+                _query_chunk, self.chunk_size, positions, scene_index, keys=keys
+            )
         else:
-            net_out = _query_chunk(positions)
+            net_out = _query_chunk(positions, scene_index)
+            if keys is not None:
+                net_out = {k: net_out[k] for k in keys}
+
+        net_out = {k: v.view(*input_shape, -1) for k, v in net_out.items()}
+
+        return net_out
+
+    def _query_samples(
+        self,
+        decoder: torch.nn.Module,
+        triplane: PreparedTriplane,
+        xyz: torch.Tensor,
+        occupancy_grid: Optional[torch.Tensor],
+        scene_index: Optional[torch.Tensor] = None,
+    ) -> Dict[str, torch.Tensor]:
+        # scene_index: scene of every ray, for batched triplanes
+        if scene_index is not None:
+            scene_index = scene_index[:, None].expand(xyz.shape[:-1])
+        if occupancy_grid is None:
+            self.stats["samples_queried"] += xyz.shape[0] * xyz.shape[1]
+            return self.query_triplane(
+                decoder=decoder,
+                positions=xyz,
+                triplane=triplane,
+                scene_index=scene_index,
+                keys=["density_act", "color"],
+            )
 
-        net_out["density_act"] = get_activation(self.cfg.density_activation)(
-            net_out["density"] + self.cfg.density_bias
+        # only query the samples in occupied cells, the others get zero density
+        resolution = occupancy_grid.shape[-1]
+        grid_index = (
+            ((xyz + self.cfg.radius) / (2 * self.cfg.radius) * resolution)
+            .long()
+            .clamp_(0, resolution - 1)
         )
-        net_out["color"] = get_activation(self.cfg.color_activation)(
-            net_out["features"]
+        if scene_index is None:
+            occupied = occupancy_grid[
+                grid_index[..., 0], grid_index[..., 1], grid_index[..., 2]
+            ]
+        else:
+            occupied = occupancy_grid[
+                scene_index, grid_index[..., 0], grid_index[..., 1], grid_index[..., 2]
+            ]
+        n_occupied = int(occupied.sum().item())
+        self.stats["samples_queried"] += n_occupied
+        self.stats["samples_skipped_empty"] += occupied.numel() - n_occupied
+        if n_occupied == 0:
+            return {
+                "density_act": xyz.new_zeros(*occupied.shape, 1),
+                "color": xyz.new_zeros(*occupied.shape, 3),
+            }
+
+        occupied_out = self.query_triplane(
+            decoder=decoder,
+            positions=xyz[occupied],
+            triplane=triplane,
+            scene_index=None if scene_index is None else scene_index[occupied],
+            keys=["density_act", "color"],
         )
+        mlp_out = {}
+        for k, v in occupied_out.items():
+            mlp_out[k] = v.new_zeros(*occupied.shape, v.shape[-1])
+            mlp_out[k][occupied] = v
+        return mlp_out
 
-        net_out = {k: v.view(*input_shape, -1) for k, v in net_out.items()}
+    def _composite(
+        self,
+        mlp_out: Dict[str, torch.Tensor],
+        deltas: torch.Tensor,
+        transmittance: torch.Tensor,
+    ):
+        """
+        Alpha-composite consecutive samples of rays that enter with the given transmittance.
+        Returns the color and opacity they add and the transmittance behind the last sample.
+        """
+        weights, transmittance = self._weights(mlp_out, deltas, transmittance)
+        comp_rgb_ = (weights[..., None] * mlp_out["color"]).sum(dim=-2)  # (N_rays, 3)
+        opacity_ = weights.sum(dim=-1)  # (N_rays)
+        return comp_rgb_, opacity_, transmittance
 
-        return net_out
+    def _weights(
+        self,
+        mlp_out: Dict[str, torch.Tensor],
+        deltas: torch.Tensor,
+        transmittance: torch.Tensor,
+    ):
+        eps = 1e-10
+        alpha = 1 - torch.exp(
+            -deltas * mlp_out["density_act"][..., 0]
+        )  # (N_rays, N_samples)
+        accum_prod = torch.cumprod(1 - alpha + eps, dim=-1)
+        accum_prod = transmittance[:, None] * torch.cat(
+            [torch.ones_like(alpha[:, :1]), accum_prod[:, :-1]], dim=-1
+        )
+        weights = alpha * accum_prod  # (N_rays, N_samples)
+        return weights, accum_prod[:, -1] * (1 - alpha[:, -1] + eps)
+
+    def _march_blocks(
+        self,
+        decoder: torch.nn.Module,
+        triplane: PreparedTriplane,
+        get_positions: Callable,
+        t_mid: torch.Tensor,
+        deltas: torch.Tensor,
+        occupancy_grid: Optional[torch.Tensor],
+        scene_index: Optional[torch.Tensor],
+        n_rays: int,
+    ):
+        """
+        Render the samples in blocks of `ray_block_size` along the rays, dropping rays whose
+        transmittance fell below `transmittance_eps` before querying the next block.
+        """
+        n_samples = t_mid.shape[0]
+        comp_rgb_ = t_mid.new_zeros(n_rays, 3)
+        opacity_ = t_mid.new_zeros(n_rays)
+        transmittance = t_mid.new_ones(n_rays)
+        active = torch.arange(n_rays, device=t_mid.device)
+
+        for start in range(0, n_samples, self.ray_block_size):
+            end = min(start + self.ray_block_size, n_samples)
+            mlp_out = self._query_samples(
+                decoder,
+                triplane,
+                get_positions(t_mid[None, start:end], active),
+                occupancy_grid,
+                None if scene_index is None else scene_index[active],
+            )
+            block_rgb, block_opacity, block_transmittance = self._composite(
+                mlp_out,
+                deltas[start:end] if deltas.ndim == 1 else deltas[active, start:end],
+                transmittance[active],
+            )
+            comp_rgb_[active] += block_rgb
+            opacity_[active] += block_opacity
+            transmittance[active] = block_transmittance
+
+            still_active = block_transmittance > self.cfg.transmittance_eps
+            self.stats["samples_skipped_terminated"] += int(
+                (~still_active).sum().item()
+            ) * (n_samples - end)
+            active = active[still_active]
+            if active.numel() == 0:
+                break
+
+        return comp_rgb_, opacity_
 
     def _forward(
         self,
         decoder: torch.nn.Module,
-        triplane: torch.Tensor,
+        triplane: PreparedTriplane,
         rays_o: torch.Tensor,
         rays_d: torch.Tensor,
+        occupancy_grid: Optional[torch.Tensor] = None,
+        scene_index: Optional[torch.Tensor] = None,
+        t_near: Optional[torch.Tensor] = None,
+        t_far: Optional[torch.Tensor] = None,
         **kwargs,
     ):
-        rays_shape = rays_o.shape[:-1]
-        rays_o = rays_o.view(-1, 3)
-        rays_d = rays_d.view(-1, 3)
+        # rays_o, rays_d: (N_rays, 3), scene_index: (N_rays,) for batched triplanes
         n_rays = rays_o.shape[0]
 
-        t_near, t_far, rays_valid = rays_intersect_bbox(rays_o, rays_d, self.cfg.radius)
-        t_near, t_far = t_near[rays_valid], t_far[rays_valid]
+        if t_near is None:
+            t_near, t_far, rays_valid = rays_intersect_bbox(
+                rays_o, rays_d, self.cfg.radius
+            )
+            t_near, t_far = t_near[rays_valid], t_far[rays_valid]
+            rays_o, rays_d = rays_o[rays_valid], rays_d[rays_valid]
+            if scene_index is not None:
+                scene_index = scene_index[rays_valid]
+        else:
+            # precomputed intersections of rays that all hit the bounding box
+            rays_valid = None
+
+        def get_positions(t, rays=slice(None)):
+            z_vals = t_near[rays] * (1 - t) + t_far[rays] * t  # (N_rays, N_samples)
+            return (
+                rays_o[rays, None, :] + z_vals[..., None] * rays_d[rays, None, :]
+            )  # (N_rays, N_sample, 3)
 
         t_vals = torch.linspace(
-            0, 1, self.cfg.num_samples_per_ray + 1, device=triplane.device
+            0, 1, self.cfg.num_samples_per_ray + 1, device=rays_o.device
         )
         t_mid = (t_vals[:-1] + t_vals[1:]) / 2.0
-        z_vals = t_near * (1 - t_mid[None]) + t_far * t_mid[None]  # (N_rays, N_samples)
 
-        xyz = (
-            rays_o[:, None, :] + z_vals[..., None] * rays_d[..., None, :]
-        )  # (N_rays, N_sample, 3)
-
-        mlp_out = self.query_triplane(
-            decoder=decoder,
-            positions=xyz,
-            triplane=triplane,
-        )
-
-        eps = 1e-10
         # deltas = z_vals[:, 1:] - z_vals[:, :-1] # (N_rays, N_samples)
         deltas = t_vals[1:] - t_vals[:-1]  # (N_rays, N_samples)
-        alpha = 1 - torch.exp(
-            -deltas * mlp_out["density_act"][..., 0]
-        )  # (N_rays, N_samples)
-        accum_prod = torch.cat(
-            [
-                torch.ones_like(alpha[:, :1]),
-                torch.cumprod(1 - alpha[:, :-1] + eps, dim=-1),
-            ],
-            dim=-1,
-        )
-        weights = alpha * accum_prod  # (N_rays, N_samples)
-        comp_rgb_ = (weights[..., None] * mlp_out["color"]).sum(dim=-2)  # (N_rays, 3)
-        opacity_ = weights.sum(dim=-1)  # (N_rays)
+        self.stats["samples"] += rays_o.shape[0] * t_mid.shape[0]
+        if self.cfg.num_importance_samples > 0:
+            mlp_out = self._query_samples(
+                decoder, triplane, get_positions(t_mid[None]), occupancy_grid, scene_index
+            )
+            weights, _ = self._weights(mlp_out, deltas, torch.ones_like(t_near[:, 0]))
+            t_fine = sample_pdf(
+                t_vals, weights, self.cfg.num_importance_samples, self.randomized
+            )
+            fine_out = self._query_samples(
+                decoder, triplane, get_positions(t_fine), occupancy_grid, scene_index
+            )
+            self.stats["samples"] += t_fine.numel()
 
-        comp_rgb = torch.zeros(
-            n_rays, 3, dtype=comp_rgb_.dtype, device=comp_rgb_.device
-        )
-        opacity = torch.zeros(n_rays, dtype=opacity_.dtype, device=opacity_.device)
-        comp_rgb[rays_valid] = comp_rgb_
-        opacity[rays_valid] = opacity_
+            # composite the coarse and fine samples together in ray order,
+            # each sample standing for the interval between the midpoints to its neighbours
+            t_all, order = torch.sort(
+                torch.cat([t_mid.expand(t_fine.shape[0], -1), t_fine], dim=-1),
+                dim=-1,
+            )
+            mlp_out = {
+                k: torch.gather(
+                    torch.cat([mlp_out[k], fine_out[k]], dim=1),
+                    1,
+                    order[..., None].expand(-1, -1, mlp_out[k].shape[-1]),
+                )
+                for k in ["density_act", "color"]
+            }
+            bounds = torch.cat(
+                [
+                    torch.zeros_like(t_all[:, :1]),
+                    (t_all[:, :-1] + t_all[:, 1:]) / 2.0,
+                    torch.ones_like(t_all[:, :1]),
+                ],
+                dim=-1,
+            )
+            comp_rgb_, opacity_, _ = self._composite(
+                mlp_out, bounds[:, 1:] - bounds[:, :-1], torch.ones_like(t_all[:, 0])
+            )
+        elif 0 < self.ray_block_size < self.cfg.num_samples_per_ray:
+            # positions are generated per block, so the samples of all rays never coexist
+            comp_rgb_, opacity_ = self._march_blocks(
+                decoder,
+                triplane,
+                get_positions,
+                t_mid,
+                deltas,
+                occupancy_grid,
+                scene_index,
+                rays_o.shape[0],
+            )
+        else:
+            mlp_out = self._query_samples(
+                decoder, triplane, get_positions(t_mid[None]), occupancy_grid, scene_index
+            )
+            comp_rgb_, opacity_, _ = self._composite(
+                mlp_out, deltas, torch.ones_like(t_near[:, 0])
+            )
+
+        if rays_valid is None:
+            comp_rgb, opacity = comp_rgb_, opacity_
+        else:
+            comp_rgb = torch.zeros(
+                n_rays, 3, dtype=comp_rgb_.dtype, device=comp_rgb_.device
+            )
+            opacity = torch.zeros(n_rays, dtype=opacity_.dtype, device=opacity_.device)
+            comp_rgb[rays_valid] = comp_rgb_
+            opacity[rays_valid] = opacity_
 
         comp_rgb += 1 - opacity[..., None]
-        comp_rgb = comp_rgb.view(*rays_shape, 3)
 
         return comp_rgb
 
     def forward(
         self,
         decoder: torch.nn.Module,
-        triplane: torch.Tensor,
+        triplane: Union[torch.Tensor, PreparedTriplane],
         rays_o: torch.Tensor,
         rays_d: torch.Tensor,
+        occupancy_grid: Optional[torch.Tensor] = None,
+        t_near: Optional[torch.Tensor] = None,
+        t_far: Optional[torch.Tensor] = None,
     ) -> Dict[str, torch.Tensor]:
-        if triplane.ndim == 4:
-            comp_rgb = self._forward(decoder, triplane, rays_o, rays_d)
-        else:
-            comp_rgb = torch.stack(
-                [
-                    self._forward(decoder, triplane[i], rays_o[i], rays_d[i])
-                    for i in range(triplane.shape[0])
-                ],
-                dim=0,
+        """
+        Render the rays of one scene, or of several scenes for batched triplanes of shape
+        (B, 3, Cp, Hp, Wp) with rays of shape (B, ..., 3). The rays may span any number of
+        views; rays of all views and scenes are rendered together, `ray_chunk_size` at a time.
+
+        occupancy_grid: from build_occupancy_grid, (B, R, R, R) or a list of (R, R, R) grids for
+        batched triplanes. Built on the fly if not given, pass it to reuse it across renders
+        of the same scenes.
+
+        t_near, t_far: (..., 1) intersections of the rays with the bounding box, e.g. from a
+        CameraRaysCache. If given, all rays must hit the bounding box.
+
+        triplane may come from prepare_triplane with the same decoder, to reuse it across
+        renders of the same scenes.
+        """
+        rays_shape = rays_o.shape[:-1]
+        rays_o = rays_o.reshape(-1, 3)
+        rays_d = rays_d.reshape(-1, 3)
+        if t_near is not None:
+            t_near, t_far = t_near.reshape(-1, 1), t_far.reshape(-1, 1)
+        if not isinstance(triplane, PreparedTriplane):
+            # shared by the occupancy grid and all ray chunks and blocks
+            triplane = self.prepare_triplane(decoder, triplane)
+        scene_index = None
+        if triplane.batched:
+            n_scenes = triplane.n_scenes
+            scene_index = torch.arange(n_scenes, device=rays_o.device)
+            scene_index = scene_index.repeat_interleave(rays_o.shape[0] // n_scenes)
+            if isinstance(occupancy_grid, (list, tuple)):
+                occupancy_grid = (
+                    None
+                    if any(grid is None for grid in occupancy_grid)
+                    else torch.stack(list(occupancy_grid), dim=0)
+                )
+
+        if occupancy_grid is None:
+            occupancy_grid = self.build_occupancy_grid(decoder, triplane)
+
+        def _render_chunk(rays_o, rays_d, scene_index, t_near, t_far):
+            return self._forward(
+                decoder,
+                triplane,
+                rays_o,
+                rays_d,
+                occupancy_grid=occupancy_grid,
+                scene_index=scene_index,
+                t_near=t_near,
+                t_far=t_far,
             )
 
-        return comp_rgb
+        comp_rgb = chunk_batch(
+            _render_chunk,
+            self.ray_chunk_size,
+            rays_o,
+            rays_d,
+            scene_index,
+            t_near,
+            t_far,
+        )
+
+        return comp_rgb.view(*rays_shape, 3)
 
     def train(self, mode=True):
         self.randomized = mode and self.cfg.randomized
@@ -1,11 +1,14 @@
+import math
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import Optional
+from typing import Dict, List, Optional, Sequence, Tuple
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from einops import rearrange
 
-from ..utils import BaseModule
+from ..utils import BaseModule, Workspace
 
 
 class TriplaneUpsampleNetwork(BaseModule):
@@ -113,6 +116,12 @@ class NeRFMLP(BaseModule):
         else:
             raise NotImplementedError
 
+    @property
+    def first_linear(self) -> Optional[nn.Linear]:
+        # None if the first layer was replaced, e.g. by a quantized one
+        layer = self.layers[0]
+        return layer if type(layer) is nn.Linear else None
+
     def forward(self, x):
         inp_shape = x.shape[:-1]
         x = x.reshape(-1, x.shape[-1])
@@ -122,3 +131,172 @@ class NeRFMLP(BaseModule):
         out = {"density": features[..., 0:1], "features": features[..., 1:4]}
 
         return out
+
+    def forward_from_first_linear(self, x):
+        """
+        Same as `forward`, for inputs that already went through the first linear layer.
+        """
+        inp_shape = x.shape[:-1]
+        x = x.reshape(-1, x.shape[-1])
+
+        for layer in self.layers[1:]:
+            x = layer(x)
+        features = x.reshape(*inp_shape, -1)
+        out = {"density": features[..., 0:1], "features": features[..., 1:4]}
+
+        return out
+
+
+class FusedNeRFMLP:
+    """
+    Inference-only NeRFMLP. The weights are transposed and packed once, every layer is a
+    single addmm into the buffers of a workspace followed by an in-place activation, and
+    only the requested outputs ("density" and/or "features") are computed, so the last
+    layer shrinks to the columns they need. The outputs live in the workspace and are
+    valid until the next call with it.
+
+    With `num_threads` > 1, inputs of more than `min_rows_per_thread` rows are split across
+    a thread pool, every thread running the whole MLP on its rows; this pays off when the
+    intra-op parallelism of PyTorch is low, e.g. with several workers per machine. The
+    weights are packed again whenever those of the MLP change: when it moves to another
+    device, or when they are replaced or updated in place (e.g. by load_state_dict).
+    """
+
+    def __init__(
+        self, mlp: NeRFMLP, num_threads: int = 1, min_rows_per_thread: int = 4096
+    ) -> None:
+        assert all(
+            type(layer) in [nn.Linear, nn.ReLU, nn.SiLU] for layer in mlp.layers
+        ), "Only plain Linear layers can be fused, e.g. not quantized ones."
+        self.mlp = mlp
+        self.activation = mlp.cfg.activation
+        self.min_rows_per_thread = min_rows_per_thread
+        self.pool = ThreadPoolExecutor(num_threads) if num_threads > 1 else None
+        self.num_threads = num_threads
+        self.pack()
+
+    def pack(self) -> None:
+        linears = [layer for layer in self.mlp.layers if isinstance(layer, nn.Linear)]
+        self.weights: List[Tuple[torch.Tensor, Optional[torch.Tensor]]] = [
+            (
+                linear.weight.detach().t().contiguous(),
+                None if linear.bias is None else linear.bias.detach().clone(),
+            )
+            for linear in linears
+        ]
+        # the last layer split into the density and features columns
+        weight, bias = self.weights.pop()
+        self.heads: Dict[str, Tuple[torch.Tensor, Optional[torch.Tensor]]] = {
+            name: (
+                weight[:, columns].contiguous(),
+                None if bias is None else bias[columns].contiguous(),
+            )
+            for name, columns in [("density", slice(0, 1)), ("features", slice(1, 4))]
+        }
+        self.packed_from = self._weights_version()
+
+    def _weights_version(self) -> Tuple[Tuple[int, int], ...]:
+        # the storage and the version counter of every weight, which in-place updates bump
+        return tuple(
+            (param.data_ptr(), param._version)
+            for layer in self.mlp.layers
+            if isinstance(layer, nn.Linear)
+            for param in [layer.weight, layer.bias]
+            if param is not None
+        )
+
+    def _activate_(self, x: torch.Tensor) -> torch.Tensor:
+        if self.activation == "relu":
+            return x.relu_()
+        elif self.activation == "silu":
+            return F.silu(x, inplace=True)
+        else:
+            raise NotImplementedError
+
+    def _linear(
+        self,
+        x: torch.Tensor,
+        weight: torch.Tensor,
+        bias: Optional[torch.Tensor],
+        out: torch.Tensor,
+    ) -> torch.Tensor:
+        if bias is None:
+            return torch.mm(x, weight, out=out)
+        return torch.addmm(bias, x, weight, out=out)
+
+    def _run(
+        self,
+        x: torch.Tensor,
+        outputs: Sequence[str],
+        buffers: List[torch.Tensor],
+        out: Dict[str, torch.Tensor],
+        from_first_linear: bool,
+    ) -> None:
+        weights = self.weights
+        if from_first_linear:
+            x = self._activate_(x)
+            weights = weights[1:]
+        for i, (weight, bias) in enumerate(weights):
+            # alternate between two buffers, the input of a layer is never its output
+            x = self._activate_(self._linear(x, weight, bias, buffers[i % 2]))
+        for name in outputs:
+            self._linear(x, *self.heads[name], out[name])
+
+    def __call__(
+        self,
+        x: torch.Tensor,
+        outputs: Sequence[str] = ("density", "features"),
+        workspace: Optional[Workspace] = None,
+        from_first_linear: bool = False,
+    ) -> Dict[str, torch.Tensor]:
+        """
+        x: (N, C) decoder inputs, or the outputs of the first linear layer if
+        `from_first_linear`, which are then activated in place.
+        """
+        if self._weights_version() != self.packed_from:
+            self.pack()
+        if workspace is None:
+            workspace = Workspace()
+        n_rows = x.shape[0]
+        n_neurons = self.weights[-1][0].shape[-1]
+        buffers = [
+            workspace.get(f"decoder_hidden_{i}", (n_rows, n_neurons), x.dtype, x.device)
+            for i in range(2)
+        ]
+        out = {
+            name: workspace.get(
+                f"decoder_{name}",
+                (n_rows, self.heads[name][0].shape[-1]),
+                x.dtype,
+                x.device,
+            )
+            for name in outputs
+        }
+
+        n_threads = 1
+        if self.pool is not None:
+            n_threads = min(self.num_threads, n_rows // self.min_rows_per_thread)
+        if n_threads <= 1:
+            self._run(x, outputs, buffers, out, from_first_linear)
+            return out
+
+        # contiguous row blocks of the inputs, buffers and outputs for every thread
+        rows_per_thread = math.ceil(n_rows / n_threads)
+        futures = [
+            self.pool.submit(
+                self._run,
+                x[start : start + rows_per_thread],
+                outputs,
+                [buffer[start : start + rows_per_thread] for buffer in buffers],
+                {k: v[start : start + rows_per_thread] for k, v in out.items()},
+                from_first_linear,
+            )
+            for start in range(0, n_rows, rows_per_thread)
+        ]
+        for future in futures:
+            future.result()
+        return out
+
+    def close(self) -> None:
+        if self.pool is not None:
+            self.pool.shutdown()
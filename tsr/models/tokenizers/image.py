@@ -1,12 +1,19 @@
+import os
 from dataclasses import dataclass
 
 import torch
 import torch.nn as nn
 from einops import rearrange
-from huggingface_hub import hf_hub_download
 from transformers.models.vit.modeling_vit import ViTModel
 
-from ...utils import BaseModule
+from ...utils import BaseModule, get_pretrained_file
+
+# configs shipped with the package, so building the model needs no network access
+BUNDLED_CONFIGS = {
+    "facebook/dino-vitb16": os.path.join(
+        os.path.dirname(__file__), "..", "..", "configs", "dino-vitb16", "config.json"
+    ),
+}
 
 
 class DINOSingleImageTokenizer(BaseModule):
@@ -18,14 +25,12 @@ class DINOSingleImageTokenizer(BaseModule):
     cfg: Config
 
     def configure(self) -> None:
-        self.model: ViTModel = ViTModel(
-            ViTModel.config_class.from_pretrained(
-                hf_hub_download(
-                    repo_id=self.cfg.pretrained_model_name_or_path,
-                    filename="config.json",
-                )
+        config_path = BUNDLED_CONFIGS.get(self.cfg.pretrained_model_name_or_path)
+        if config_path is None:
+            config_path = get_pretrained_file(
+                self.cfg.pretrained_model_name_or_path, "config.json"
             )
-        )
+        self.model: ViTModel = ViTModel(ViTModel.config_class.from_pretrained(config_path))
 
         if self.cfg.enable_gradient_checkpointing:
             self.model.encoder.gradient_checkpointing = True
@@ -41,6 +46,20 @@ class DINOSingleImageTokenizer(BaseModule):
             persistent=False,
         )
 
+    def num_tokens(self, image_size: int) -> int:
+        return (image_size // self.model.config.patch_size) ** 2 + 1
+
+    def estimate_peak_memory(
+        self, batch_size: int, image_size: int, dtype: torch.dtype = torch.float32
+    ) -> int:
+        config = self.model.config
+        element_size = torch.finfo(dtype).bits // 8
+        n_tokens = self.num_tokens(image_size)
+        hidden_states = 6 * batch_size * n_tokens * config.hidden_size
+        attention = 2 * batch_size * config.num_attention_heads * n_tokens**2
+        feed_forward = 2 * batch_size * n_tokens * config.intermediate_size
+        return (hidden_states + max(attention, feed_forward)) * element_size
+
     def forward(self, images: torch.FloatTensor, **kwargs) -> torch.FloatTensor:
         packed = False
         if images.ndim == 4:
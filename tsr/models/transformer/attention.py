@@ -36,7 +36,7 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-from typing import Optional
+from typing import List, Optional
 
 import torch
 import torch.nn.functional as F
@@ -124,6 +124,8 @@ class Attention(nn.Module):
         self.cross_attention_dim = (
             cross_attention_dim if cross_attention_dim is not None else query_dim
         )
+        # the dimensions alone do not tell, the key/value inputs can be as wide as the queries
+        self.is_cross_attention = cross_attention_dim is not None
         self.upcast_attention = upcast_attention
         self.upcast_softmax = upcast_softmax
         self.rescale_output_factor = rescale_output_factor
@@ -214,13 +216,15 @@ class Attention(nn.Module):
         # torch.nn.functional.scaled_dot_product_attention for native Flash/memory_efficient_attention
         # but only if it has the default `scale` argument. TODO remove scale_qk check when we move to torch 2.1
         if processor is None:
-            processor = (
-                AttnProcessor2_0()
-                if hasattr(F, "scaled_dot_product_attention") and self.scale_qk
-                else AttnProcessor()
-            )
+            processor = self.get_default_processor()
         self.set_processor(processor)
 
+    def get_default_processor(self) -> "AttnProcessor":
+        # the processor picked when none is given, for the current projections
+        if hasattr(F, "scaled_dot_product_attention") and self.scale_qk:
+            return AttnProcessor2_0()
+        return AttnProcessor()
+
     def set_processor(self, processor: "AttnProcessor") -> None:
         self.processor = processor
 
@@ -446,11 +450,46 @@ class Attention(nn.Module):
 
         return encoder_hidden_states
 
+    def project_qkv(
+        self,
+        hidden_states: torch.Tensor,
+        encoder_hidden_states: Optional[torch.Tensor] = None,
+    ):
+        r"""
+        Compute the query, key and value projections, using the fused projection layers if
+        `fuse_projections` was called.
+
+        Returns:
+            `Tuple[torch.Tensor]`: query, key and value, each of shape `[batch_size, seq_len, inner_dim]`.
+        """
+        if encoder_hidden_states is None and hasattr(self, "to_qkv"):
+            return self.to_qkv(hidden_states).chunk(3, dim=-1)
+
+        if encoder_hidden_states is None:
+            encoder_hidden_states = hidden_states
+        elif self.norm_cross:
+            encoder_hidden_states = self.norm_encoder_hidden_states(
+                encoder_hidden_states
+            )
+
+        query = self.to_q(hidden_states)
+        if hasattr(self, "to_kv"):
+            key, value = self.to_kv(encoder_hidden_states).chunk(2, dim=-1)
+        else:
+            key = self.to_k(encoder_hidden_states)
+            value = self.to_v(encoder_hidden_states)
+        return query, key, value
+
     @torch.no_grad()
     def fuse_projections(self, fuse=True):
-        is_cross_attention = self.cross_attention_dim != self.query_dim
+        """
+        Replace the query/key/value projections by one linear layer (key/value for
+        cross-attention), releasing the layers it replaces.
+        """
+        is_cross_attention = self.is_cross_attention
         device = self.to_q.weight.data.device
         dtype = self.to_q.weight.data.dtype
+        has_bias = self.to_q.bias is not None
 
         if not is_cross_attention:
             # fetch weight matrices.
@@ -462,9 +501,16 @@ class Attention(nn.Module):
 
             # create a new single projection layer and copy over the weights.
             self.to_qkv = self.linear_cls(
-                in_features, out_features, bias=False, device=device, dtype=dtype
+                in_features, out_features, bias=has_bias, device=device, dtype=dtype
             )
             self.to_qkv.weight.copy_(concatenated_weights)
+            if has_bias:
+                self.to_qkv.bias.copy_(
+                    torch.cat(
+                        [self.to_q.bias.data, self.to_k.bias.data, self.to_v.bias.data]
+                    )
+                )
+            del self.to_q, self.to_k, self.to_v
 
         else:
             concatenated_weights = torch.cat(
@@ -474,12 +520,45 @@ class Attention(nn.Module):
             out_features = concatenated_weights.shape[0]
 
             self.to_kv = self.linear_cls(
-                in_features, out_features, bias=False, device=device, dtype=dtype
+                in_features, out_features, bias=has_bias, device=device, dtype=dtype
             )
             self.to_kv.weight.copy_(concatenated_weights)
+            if has_bias:
+                self.to_kv.bias.copy_(
+                    torch.cat([self.to_k.bias.data, self.to_v.bias.data])
+                )
+            del self.to_k, self.to_v
 
         self.fused_projections = fuse
 
+    @torch.no_grad()
+    def _split_linear(self, linear: nn.Module, n: int) -> List[nn.Module]:
+        biases = [None] * n if linear.bias is None else linear.bias.chunk(n)
+        layers = []
+        for weight, bias in zip(linear.weight.chunk(n), biases):
+            layer = self.linear_cls(
+                weight.shape[1],
+                weight.shape[0],
+                bias=bias is not None,
+                device=weight.device,
+                dtype=weight.dtype,
+            )
+            layer.weight.copy_(weight)
+            if bias is not None:
+                layer.bias.copy_(bias)
+            layers.append(layer)
+        return layers
+
+    def unfuse_projections(self):
+        # rebuild the separate projections from the fused ones
+        if hasattr(self, "to_qkv"):
+            self.to_q, self.to_k, self.to_v = self._split_linear(self.to_qkv, 3)
+            del self.to_qkv
+        if hasattr(self, "to_kv"):
+            self.to_k, self.to_v = self._split_linear(self.to_kv, 2)
+            del self.to_kv
+        self.fused_projections = False
+
 
 class AttnProcessor:
     r"""
@@ -517,17 +596,7 @@ class AttnProcessor:
                 1, 2
             )
 
-        query = attn.to_q(hidden_states)
-
-        if encoder_hidden_states is None:
-            encoder_hidden_states = hidden_states
-        elif attn.norm_cross:
-            encoder_hidden_states = attn.norm_encoder_hidden_states(
-                encoder_hidden_states
-            )
-
-        key = attn.to_k(encoder_hidden_states)
-        value = attn.to_v(encoder_hidden_states)
+        query, key, value = attn.project_qkv(hidden_states, encoder_hidden_states)
 
         query = attn.head_to_batch_dim(query)
         key = attn.head_to_batch_dim(key)
@@ -604,17 +673,7 @@ class AttnProcessor2_0:
                 1, 2
             )
 
-        query = attn.to_q(hidden_states)
-
-        if encoder_hidden_states is None:
-            encoder_hidden_states = hidden_states
-        elif attn.norm_cross:
-            encoder_hidden_states = attn.norm_encoder_hidden_states(
-                encoder_hidden_states
-            )
-
-        key = attn.to_k(encoder_hidden_states)
-        value = attn.to_v(encoder_hidden_states)
+        query, key, value = attn.project_qkv(hidden_states, encoder_hidden_states)
 
         inner_dim = key.shape[-1]
         head_dim = inner_dim // attn.heads
@@ -651,3 +710,230 @@ class AttnProcessor2_0:
         hidden_states = hidden_states / attn.rescale_output_factor
 
         return hidden_states
+
+
+class SlicedAttnProcessor:
+    r"""
+    Processor for implementing sliced attention. The attention scores are computed for `slice_size` of the
+    `batch_size * heads` attention problems at a time, so only a `slice_size x query_len x key_len` score tensor
+    is alive at once.
+
+    Args:
+        slice_size (`int`):
+            The number of `batch_size * heads` attention problems computed per step. It does not have to divide
+            `batch_size * heads`, the last slice holds the remainder.
+    """
+
+    def __init__(self, slice_size: int):
+        self.slice_size = slice_size
+
+    def __call__(
+        self,
+        attn: Attention,
+        hidden_states: torch.FloatTensor,
+        encoder_hidden_states: Optional[torch.FloatTensor] = None,
+        attention_mask: Optional[torch.FloatTensor] = None,
+    ) -> torch.FloatTensor:
+        residual = hidden_states
+
+        input_ndim = hidden_states.ndim
+
+        if input_ndim == 4:
+            batch_size, channel, height, width = hidden_states.shape
+            hidden_states = hidden_states.view(
+                batch_size, channel, height * width
+            ).transpose(1, 2)
+
+        batch_size, sequence_length, _ = (
+            hidden_states.shape
+            if encoder_hidden_states is None
+            else encoder_hidden_states.shape
+        )
+        attention_mask = attn.prepare_attention_mask(
+            attention_mask, sequence_length, batch_size
+        )
+
+        if attn.group_norm is not None:
+            hidden_states = attn.group_norm(hidden_states.transpose(1, 2)).transpose(
+                1, 2
+            )
+
+        query, key, value = attn.project_qkv(hidden_states, encoder_hidden_states)
+        dim = query.shape[-1]
+
+        query = attn.head_to_batch_dim(query)
+        key = attn.head_to_batch_dim(key)
+        value = attn.head_to_batch_dim(value)
+
+        batch_size_attention, query_tokens, _ = query.shape
+        hidden_states = torch.empty(
+            (batch_size_attention, query_tokens, dim // attn.heads),
+            device=query.device,
+            dtype=query.dtype,
+        )
+
+        for start_idx in range(0, batch_size_attention, self.slice_size):
+            end_idx = start_idx + self.slice_size
+
+            query_slice = query[start_idx:end_idx]
+            key_slice = key[start_idx:end_idx]
+            attn_mask_slice = (
+                attention_mask[start_idx:end_idx]
+                if attention_mask is not None
+                else None
+            )
+
+            attn_slice = attn.get_attention_scores(
+                query_slice, key_slice, attn_mask_slice
+            )
+            attn_slice = torch.bmm(attn_slice.to(value.dtype), value[start_idx:end_idx])
+            hidden_states[start_idx:end_idx] = attn_slice
+
+        hidden_states = attn.batch_to_head_dim(hidden_states)
+
+        # linear proj
+        hidden_states = attn.to_out[0](hidden_states)
+        # dropout
+        hidden_states = attn.to_out[1](hidden_states)
+
+        if input_ndim == 4:
+            hidden_states = hidden_states.transpose(-1, -2).reshape(
+                batch_size, channel, height, width
+            )
+
+        if attn.residual_connection:
+            hidden_states = hidden_states + residual
+
+        hidden_states = hidden_states / attn.rescale_output_factor
+
+        return hidden_states
+
+
+class TiledAttnProcessor:
+    r"""
+    Processor for implementing memory-efficient attention. Queries are processed in tiles of `query_chunk_size`
+    and, within a tile, keys and values in chunks of `key_chunk_size`, combined with an online softmax (running
+    maximum and normalizer), so the largest score tensor is `batch_size * heads x query_chunk_size x
+    key_chunk_size`. The softmax statistics and the output accumulator are kept in float32.
+
+    Args:
+        query_chunk_size (`int`): The number of queries processed together.
+        key_chunk_size (`int`, *optional*): The number of keys processed together. Defaults to all keys.
+    """
+
+    def __init__(self, query_chunk_size: int, key_chunk_size: Optional[int] = None):
+        self.query_chunk_size = query_chunk_size
+        self.key_chunk_size = key_chunk_size
+
+    def __call__(
+        self,
+        attn: Attention,
+        hidden_states: torch.FloatTensor,
+        encoder_hidden_states: Optional[torch.FloatTensor] = None,
+        attention_mask: Optional[torch.FloatTensor] = None,
+    ) -> torch.FloatTensor:
+        residual = hidden_states
+
+        input_ndim = hidden_states.ndim
+
+        if input_ndim == 4:
+            batch_size, channel, height, width = hidden_states.shape
+            hidden_states = hidden_states.view(
+                batch_size, channel, height * width
+            ).transpose(1, 2)
+
+        batch_size, sequence_length, _ = (
+            hidden_states.shape
+            if encoder_hidden_states is None
+            else encoder_hidden_states.shape
+        )
+        attention_mask = attn.prepare_attention_mask(
+            attention_mask, sequence_length, batch_size
+        )
+
+        if attn.group_norm is not None:
+            hidden_states = attn.group_norm(hidden_states.transpose(1, 2)).transpose(
+                1, 2
+            )
+
+        query, key, value = attn.project_qkv(hidden_states, encoder_hidden_states)
+
+        query = attn.head_to_batch_dim(query)
+        key = attn.head_to_batch_dim(key)
+        value = attn.head_to_batch_dim(value)
+
+        query_tokens, key_tokens = query.shape[1], key.shape[1]
+        key_chunk_size = self.key_chunk_size or key_tokens
+        hidden_states = torch.empty_like(query)
+
+        for q_start in range(0, query_tokens, self.query_chunk_size):
+            q_end = q_start + self.query_chunk_size
+            query_chunk = query[:, q_start:q_end]
+            if attn.upcast_attention:
+                query_chunk = query_chunk.float()
+
+            running_max, running_sum, output = None, None, None
+            for k_start in range(0, key_tokens, key_chunk_size):
+                k_end = k_start + key_chunk_size
+                key_chunk = key[:, k_start:k_end]
+                if attn.upcast_attention:
+                    key_chunk = key_chunk.float()
+
+                if attention_mask is None:
+                    scores = torch.bmm(query_chunk, key_chunk.transpose(-1, -2))
+                    scores = scores.float().mul_(attn.scale)
+                else:
+                    mask_chunk = attention_mask[..., k_start:k_end]
+                    if mask_chunk.shape[1] > 1:
+                        mask_chunk = mask_chunk[:, q_start:q_end]
+                    scores = torch.baddbmm(
+                        mask_chunk.to(query_chunk.dtype),
+                        query_chunk,
+                        key_chunk.transpose(-1, -2),
+                        alpha=attn.scale,
+                    ).float()
+
+                chunk_max = scores.amax(dim=-1, keepdim=True)
+                if running_max is None:
+                    running_max = chunk_max
+                else:
+                    new_max = torch.maximum(running_max, chunk_max)
+                    # rescale what was accumulated with the previous maximum
+                    correction = torch.exp(running_max - new_max)
+                    running_sum.mul_(correction)
+                    output.mul_(correction)
+                    running_max = new_max
+
+                probs = scores.sub_(running_max).exp_()
+                del scores
+                chunk_sum = probs.sum(dim=-1, keepdim=True)
+                chunk_output = torch.bmm(
+                    probs.to(value.dtype), value[:, k_start:k_end]
+                ).float()
+                del probs
+                if output is None:
+                    running_sum, output = chunk_sum, chunk_output
+                else:
+                    running_sum.add_(chunk_sum)
+                    output.add_(chunk_output)
+
+            hidden_states[:, q_start:q_end] = output.div_(running_sum)
+
+        hidden_states = attn.batch_to_head_dim(hidden_states)
+
+        # linear proj
+        hidden_states = attn.to_out[0](hidden_states)
+        # dropout
+        hidden_states = attn.to_out[1](hidden_states)
+
+        if input_ndim == 4:
+            hidden_states = hidden_states.transpose(-1, -2).reshape(
+                batch_size, channel, height, width
+            )
+
+        if attn.residual_connection:
+            hidden_states = hidden_states + residual
+
+        hidden_states = hidden_states / attn.rescale_output_factor
+
+        return hidden_states
@@ -154,6 +154,23 @@ class BasicTransformerBlock(nn.Module):
         encoder_attention_mask: Optional[torch.FloatTensor] = None,
     ) -> torch.FloatTensor:
         # Notice that normalization is always applied before the real computation in the following blocks.
+        hidden_states = self.forward_self_attention(
+            hidden_states,
+            attention_mask=attention_mask,
+            encoder_hidden_states=encoder_hidden_states,
+        )
+        return self.forward_after_self_attention(
+            hidden_states,
+            encoder_hidden_states=encoder_hidden_states,
+            encoder_attention_mask=encoder_attention_mask,
+        )
+
+    def forward_self_attention(
+        self,
+        hidden_states: torch.FloatTensor,
+        attention_mask: Optional[torch.FloatTensor] = None,
+        encoder_hidden_states: Optional[torch.FloatTensor] = None,
+    ) -> torch.FloatTensor:
         # 0. Self-Attention
         norm_hidden_states = self.norm1(hidden_states)
 
@@ -165,8 +182,14 @@ class BasicTransformerBlock(nn.Module):
             attention_mask=attention_mask,
         )
 
-        hidden_states = attn_output + hidden_states
+        return attn_output + hidden_states
 
+    def forward_after_self_attention(
+        self,
+        hidden_states: torch.FloatTensor,
+        encoder_hidden_states: Optional[torch.FloatTensor] = None,
+        encoder_attention_mask: Optional[torch.FloatTensor] = None,
+    ) -> torch.FloatTensor:
         # 3. Cross-Attention
         if self.attn2 is not None:
             norm_hidden_states = self.norm2(hidden_states)
@@ -182,22 +205,13 @@ class BasicTransformerBlock(nn.Module):
         norm_hidden_states = self.norm3(hidden_states)
 
         if self._chunk_size is not None:
-            # "feed_forward_chunk_size" can be used to save memory
-            if norm_hidden_states.shape[self._chunk_dim] % self._chunk_size != 0:
-                raise ValueError(
-                    f"`hidden_states` dimension to be chunked: {norm_hidden_states.shape[self._chunk_dim]} has to be divisible by chunk size: {self._chunk_size}. Make sure to set an appropriate `chunk_size` when calling `unet.enable_forward_chunking`."
-                )
-
-            num_chunks = norm_hidden_states.shape[self._chunk_dim] // self._chunk_size
-            ff_output = torch.cat(
-                [
-                    self.ff(hid_slice)
-                    for hid_slice in norm_hidden_states.chunk(
-                        num_chunks, dim=self._chunk_dim
-                    )
-                ],
-                dim=self._chunk_dim,
-            )
+            # "feed_forward_chunk_size" can be used to save memory, the last chunk may be shorter
+            ff_output = torch.empty_like(norm_hidden_states)
+            for hid_slice, out_slice in zip(
+                norm_hidden_states.split(self._chunk_size, dim=self._chunk_dim),
+                ff_output.split(self._chunk_size, dim=self._chunk_dim),
+            ):
+                out_slice.copy_(self.ff(hid_slice))
         else:
             ff_output = self.ff(norm_hidden_states)
 
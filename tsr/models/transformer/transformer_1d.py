@@ -37,13 +37,18 @@
 # SOFTWARE.
 
 from dataclasses import dataclass
-from typing import Optional
+from typing import Any, Dict, Optional, Tuple
 
 import torch
 import torch.nn.functional as F
 from torch import nn
 
 from ...utils import BaseModule
+from .attention import (
+    Attention,
+    SlicedAttnProcessor,
+    TiledAttnProcessor,
+)
 from .basic_transformer_block import BasicTransformerBlock
 
 
@@ -66,6 +71,7 @@ class Transformer1D(BaseModule):
         norm_type: str = "layer_norm"
         norm_elementwise_affine: bool = True
         gradient_checkpointing: bool = False
+        memory_budget: Optional[int] = None
 
     cfg: Config
 
@@ -119,6 +125,232 @@ class Transformer1D(BaseModule):
 
         self.gradient_checkpointing = self.cfg.gradient_checkpointing
 
+        self.memory_budget: Optional[int] = None
+        self._memory_plan_key: Optional[Tuple] = None
+        # without a budget the layers keep the kernels they were built with
+        if self.cfg.memory_budget is not None:
+            self.set_memory_budget(self.cfg.memory_budget)
+
+        # image-independent part of the forward pass, see precompute_prefix()
+        self.register_buffer("prefix_residual", None, persistent=False)
+        self.register_buffer("prefix_hidden_states", None, persistent=False)
+
+    @property
+    def has_prefix(self) -> bool:
+        return self.prefix_hidden_states is not None
+
+    @torch.no_grad()
+    def precompute_prefix(self, hidden_states: torch.Tensor) -> None:
+        """
+        Run everything that only depends on `hidden_states` (the input norm and projection
+        and the self-attention of the first block) once, for inputs that are the same for
+        every sample, e.g. learned query tokens. `forward_from_prefix` then reuses it.
+
+        Args:
+            hidden_states (`torch.FloatTensor` of shape `(1, channel, seq_len)`):
+                The constant input tokens.
+        """
+        if self.cfg.only_cross_attention:
+            raise ValueError("The first block does not start with self-attention.")
+        batch, _, seq_len = hidden_states.shape
+        assert batch == 1, "The constant input has to be a single sequence."
+        self.prefix_residual = hidden_states.detach().clone()
+        self._prepare_memory_plan(1, seq_len, None, hidden_states.dtype)
+
+        hidden_states = self.norm(hidden_states)
+        inner_dim = hidden_states.shape[1]
+        hidden_states = hidden_states.permute(0, 2, 1).reshape(
+            batch, seq_len, inner_dim
+        )
+        hidden_states = self.proj_in(hidden_states)
+        self.prefix_hidden_states = self.transformer_blocks[0].forward_self_attention(
+            hidden_states
+        )
+
+    def clear_prefix(self) -> None:
+        self.prefix_residual = None
+        self.prefix_hidden_states = None
+
+    def forward_from_prefix(self, encoder_hidden_states: torch.Tensor) -> torch.Tensor:
+        """
+        Same as `forward(hidden_states, encoder_hidden_states)` where `hidden_states` are
+        the constant tokens given to `precompute_prefix`, repeated for every sample of
+        `encoder_hidden_states`.
+        """
+        assert self.has_prefix, "Call precompute_prefix() first."
+        # the batch size is always read from the input, so that traced graphs (e.g. ONNX
+        # exports) keep it dynamic
+        batch_size = encoder_hidden_states.shape[0]
+        seq_len = self.prefix_hidden_states.shape[1]
+        self._prepare_memory_plan(
+            batch_size, seq_len, encoder_hidden_states, self.prefix_hidden_states.dtype
+        )
+
+        # a broadcast view, the first block writes its output to a new tensor
+        hidden_states = self.prefix_hidden_states.expand(batch_size, -1, -1)
+        hidden_states = self.transformer_blocks[0].forward_after_self_attention(
+            hidden_states, encoder_hidden_states=encoder_hidden_states
+        )
+        for block in self.transformer_blocks[1:]:
+            hidden_states = block(
+                hidden_states, encoder_hidden_states=encoder_hidden_states
+            )
+
+        # (B, seq_len, C) -> (B, C, seq_len)
+        hidden_states = self.proj_out(hidden_states).permute(0, 2, 1).contiguous()
+
+        return hidden_states + self.prefix_residual
+
+    def fuse_qkv_projections(self) -> None:
+        """
+        Fuse the query/key/value projections of every self-attention layer (key/value for
+        cross-attention) into one linear layer each. The attention processors read them
+        through `Attention.project_qkv`.
+        """
+        for module in self.modules():
+            if isinstance(module, Attention):
+                module.fuse_projections(fuse=True)
+
+    def unfuse_qkv_projections(self) -> None:
+        for module in self.modules():
+            if isinstance(module, Attention):
+                module.unfuse_projections()
+
+    def set_memory_budget(self, memory_budget: Optional[int]) -> None:
+        """
+        Bound the activation memory (in bytes) of a forward pass. Before each forward pass the
+        attention layers switch to head-sliced or query-tiled attention and the feed-forward
+        layers to chunked evaluation as needed to stay within `memory_budget`, see
+        `plan_memory`. `None` restores the default, unbounded kernels.
+        """
+        self.memory_budget = memory_budget
+        self._memory_plan_key = None
+        if memory_budget is None:
+            self._apply_memory_plan(
+                {"self_attention": None, "cross_attention": None, "ff_chunk_size": None}
+            )
+
+    def plan_memory(
+        self,
+        batch_size: int,
+        seq_len: int,
+        encoder_seq_len: Optional[int] = None,
+        dtype: torch.dtype = torch.float32,
+    ) -> Dict[str, Any]:
+        """
+        Pick the attention and feed-forward kernels for one forward pass within the memory budget.
+
+        Returns:
+            `dict`: `self_attention` and `cross_attention` are `None` (full attention),
+            `("sliced", slice_size)` or `("tiled", query_chunk_size, key_chunk_size)`,
+            `ff_chunk_size` is `None` or the number of tokens per feed-forward chunk and `peak`
+            is the estimated peak number of bytes.
+        """
+        element_size = torch.finfo(dtype).bits // 8
+        heads = self.num_attention_heads
+        inner_dim = heads * self.attention_head_dim
+
+        # residual stream, normalized copy, query/key/value and attention output
+        hidden_states = 6 * batch_size * seq_len * inner_dim * element_size
+        available = (
+            None if self.memory_budget is None else self.memory_budget - hidden_states
+        )
+
+        def plan_attention(key_len: int):
+            # attention scores and probabilities of all heads
+            per_head = 2 * seq_len * key_len * element_size
+            if available is None or batch_size * heads * per_head <= available:
+                return None, batch_size * heads * per_head
+            if per_head <= available:
+                slice_size = available // per_head
+                return ("sliced", slice_size), slice_size * per_head
+            # fp32 scores and probabilities of a key chunk plus the fp32 accumulators, per query
+            key_chunk_size = min(key_len, 1024)
+            per_query = (
+                batch_size * heads * 2 * (key_chunk_size + self.attention_head_dim) * 4
+            )
+            query_chunk_size = min(seq_len, max(1, available // per_query))
+            return (
+                ("tiled", query_chunk_size, key_chunk_size),
+                query_chunk_size * per_query,
+            )
+
+        self_attention, self_attention_memory = plan_attention(seq_len)
+        cross_attention, cross_attention_memory = None, 0
+        if encoder_seq_len is not None:
+            cross_attention, cross_attention_memory = plan_attention(encoder_seq_len)
+
+        # GEGLU projection (2 x 4 x inner_dim), gate activation and gated product
+        per_token = 16 * batch_size * inner_dim * element_size
+        ff_chunk_size = None
+        feed_forward_memory = seq_len * per_token
+        if available is not None and feed_forward_memory > available:
+            ff_chunk_size = min(seq_len, max(1, available // per_token))
+            feed_forward_memory = ff_chunk_size * per_token
+
+        return {
+            "self_attention": self_attention,
+            "cross_attention": cross_attention,
+            "ff_chunk_size": ff_chunk_size,
+            "peak": hidden_states
+            + max(self_attention_memory, cross_attention_memory, feed_forward_memory),
+        }
+
+    def _apply_memory_plan(self, plan: Dict[str, Any]) -> None:
+        def make_processor(attn: Attention, attention_plan):
+            if attention_plan is None:
+                return attn.get_default_processor()
+            if attention_plan[0] == "sliced":
+                return SlicedAttnProcessor(attention_plan[1])
+            return TiledAttnProcessor(*attention_plan[1:])
+
+        for block in self.transformer_blocks:
+            block.attn1.set_processor(make_processor(block.attn1, plan["self_attention"]))
+            if block.attn2 is not None:
+                block.attn2.set_processor(
+                    make_processor(block.attn2, plan["cross_attention"])
+                )
+            block.set_chunk_feed_forward(plan["ff_chunk_size"], 1)
+
+    def _prepare_memory_plan(
+        self,
+        batch_size: int,
+        seq_len: int,
+        encoder_hidden_states: Optional[torch.Tensor],
+        dtype: torch.dtype,
+    ) -> None:
+        if self.memory_budget is None:
+            return
+        encoder_seq_len = (
+            None if encoder_hidden_states is None else encoder_hidden_states.shape[1]
+        )
+        key = (batch_size, seq_len, encoder_seq_len, dtype)
+        if key != self._memory_plan_key:
+            self._apply_memory_plan(self.plan_memory(*key))
+            self._memory_plan_key = key
+
+    def estimate_peak_memory(
+        self,
+        batch_size: int,
+        seq_len: int,
+        encoder_seq_len: Optional[int] = None,
+        dtype: torch.dtype = torch.float32,
+    ) -> int:
+        """
+        Rough estimate (in bytes) of the activation memory needed by one forward pass,
+        taking the memory budget into account.
+
+        Args:
+            batch_size (`int`): Number of sequences processed together.
+            seq_len (`int`): Number of tokens per sequence.
+            encoder_seq_len (`int`, *optional*): Number of tokens in `encoder_hidden_states`.
+            dtype (`torch.dtype`, *optional*, defaults to `torch.float32`): Activation dtype.
+
+        Returns:
+            `int`: The estimated peak number of bytes.
+        """
+        return self.plan_memory(batch_size, seq_len, encoder_seq_len, dtype)["peak"]
+
     def forward(
         self,
         hidden_states: torch.Tensor,
@@ -178,6 +410,9 @@ class Transformer1D(BaseModule):
 
         # 1. Input
         batch, _, seq_len = hidden_states.shape
+        self._prepare_memory_plan(
+            batch, seq_len, encoder_hidden_states, hidden_states.dtype
+        )
         residual = hidden_states
 
         hidden_states = self.norm(hidden_states)
@@ -0,0 +1,112 @@
+from typing import Optional
+
+import torch
+import torch.nn.functional as F
+
+from ..utils import Workspace
+
+# width and height coordinates of the xy, xz and yz planes
+PLANE_X = [0, 0, 1]
+PLANE_Y = [1, 2, 2]
+
+
+def layout_triplane(triplane: torch.Tensor) -> torch.Tensor:
+    """
+    Channels-last copy of triplanes (3, Cp, Hp, Wp) or (B, 3, Cp, Hp, Wp), of shape
+    (B, 3, Hp + 2, Wp + 2, Cp) with a border of one zero texel around every plane. The
+    border makes bilinear sampling of points outside the planes read zeros, as the zero
+    padding of grid_sample, without any bounds checks.
+    """
+    if triplane.ndim == 4:
+        triplane = triplane[None]
+    return F.pad(triplane, (1, 1, 1, 1)).permute(0, 1, 3, 4, 2).contiguous()
+
+
+class TriplaneSampler:
+    """
+    Bilinear sampling of triplanes laid out by `layout_triplane`, equivalent to
+    grid_sample with align_corners=False and zero padding. The four texels around every
+    point are gathered and weighted by a single embedding_bag, which returns the features
+    of the three planes concatenated ("concat") or summed ("sum") or averaged ("mean")
+    over the planes, without materializing the features of every corner. The planes must
+    be square. The layout is built once, on construction, for all the points sampled from
+    the planes.
+    """
+
+    def __init__(self, triplane: torch.Tensor, reduction: str = "concat") -> None:
+        assert reduction in ["concat", "sum", "mean"]
+        assert triplane.shape[-1] == triplane.shape[-2], "The planes must be square."
+        self.layout = layout_triplane(triplane)
+        self.table = self.layout.view(-1, self.layout.shape[-1])
+        self.reduction = reduction
+
+        n_planes, size = self.layout.shape[1], self.layout.shape[2]
+        device = triplane.device
+        # (N, 3) axis coordinates @ (3, 3) -> (N, 3) plane coordinates
+        self.select_x = torch.eye(3, device=device)[:, PLANE_X]
+        self.select_y = torch.eye(3, device=device)[:, PLANE_Y]
+        # texel row of the top-left corner in every plane
+        self.select_index = self.select_x + size * self.select_y
+        self.plane_offset = torch.arange(n_planes, device=device) * size * size
+
+    def __call__(
+        self,
+        positions: torch.Tensor,
+        scene_index: Optional[torch.Tensor] = None,
+        workspace: Optional[Workspace] = None,
+    ) -> torch.Tensor:
+        """
+        positions: (N, 3) in [-1, 1]; scene_index: (N,) scene of every point, for batched
+        triplanes. Returns the (N, C) sampled features, a new tensor. The corner indices and
+        weights are written into the buffers of `workspace` if given.
+        """
+        n_scenes, n_planes, size = self.layout.shape[:3]
+        n_points = positions.shape[0]
+
+        # texel coordinates in the padded planes, texel centers at integers. Clamping to
+        # the border keeps all four corners in the plane and reads zeros outside of it.
+        coords = ((positions.float() + 1) * ((size - 2) / 2) + 0.5).clamp_(0, size - 1)
+        corner = coords.floor().clamp_(max=size - 2)
+        frac = coords - corner
+
+        # row of the top-left texel of every plane, exact in fp32 for any realistic batch
+        top_left = (corner @ self.select_index).long() + self.plane_offset
+        if scene_index is not None:
+            top_left += (scene_index.long() * (n_planes * size * size))[:, None]
+        fx, fy = frac @ self.select_x, frac @ self.select_y
+        gx, gy = 1 - fx, 1 - fy
+
+        # (N, 3, 4) corners of every plane of a point, written column by column since
+        # broadcasting ops are much slower on CPU
+        if workspace is None:
+            index = top_left.new_empty(n_points, n_planes, 4)
+            weights = fx.new_empty(n_points, n_planes, 4)
+        else:
+            index = workspace.get(
+                "sampler_index", (n_points, n_planes, 4), top_left.dtype, top_left.device
+            )
+            weights = workspace.get(
+                "sampler_weights", (n_points, n_planes, 4), fx.dtype, fx.device
+            )
+        for k, (offset, wx, wy) in enumerate(
+            [(0, gx, gy), (1, fx, gy), (size, gx, fy), (size + 1, fx, fy)]
+        ):
+            torch.add(top_left, offset, out=index[..., k])
+            torch.mul(wx, wy, out=weights[..., k])
+        weights = weights.to(self.table.dtype)
+
+        if self.reduction == "concat":
+            # one bag per plane, the (N * 3, C) output is the concatenation
+            bags = n_points * n_planes
+        else:
+            # one bag per point
+            bags = n_points
+            if self.reduction == "mean":
+                weights = weights.div_(n_planes)
+        out = F.embedding_bag(
+            index.view(bags, -1),
+            self.table,
+            per_sample_weights=weights.view(bags, -1),
+            mode="sum",
+        )
+        return out.view(n_points, -1)
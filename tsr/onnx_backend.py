@@ -0,0 +1,89 @@
+import logging
+import os
+from typing import List, Optional
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+
+class ImageToTriplane(nn.Module):
+    """
+    The image-to-triplane part of a TSR model (image tokenizer, triplane tokenizer,
+    backbone and post processor) as a single module, for export.
+    """
+
+    def __init__(self, model) -> None:
+        super().__init__()
+        self.model = model
+
+    def forward(self, rgb_cond: torch.FloatTensor) -> torch.FloatTensor:
+        return self.model.get_scene_codes(rgb_cond)
+
+
+@torch.no_grad()
+def export_onnx(model, path: str, opset_version: int = 17) -> None:
+    """
+    Export the image-to-triplane graph of `model` to `path`. The graph takes `rgb_cond` of
+    shape (B, 1, H, W, 3) with values in [0, 1], as built by `TSR.image_processor`, and
+    returns the scene codes; the batch dimension is dynamic.
+    """
+    if model.quantization is not None:
+        raise ValueError("Quantized models cannot be exported to ONNX.")
+    if model.onnx_engine is not None:
+        raise ValueError("The model already runs on the ONNX backend.")
+
+    image_size = model.cfg.cond_image_size
+    device = next(model.parameters()).device
+    rgb_cond = torch.full((1, 1, image_size, image_size, 3), 0.5, device=device)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    # write to a temporary file first so that a failed export never leaves a partial graph
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    # export in eval mode without changing the mode of the model for its caller
+    was_training = model.training
+    try:
+        torch.onnx.export(
+            ImageToTriplane(model).eval(),
+            (rgb_cond,),
+            tmp_path,
+            input_names=["rgb_cond"],
+            output_names=["scene_codes"],
+            dynamic_axes={"rgb_cond": {0: "batch"}, "scene_codes": {0: "batch"}},
+            opset_version=opset_version,
+        )
+    finally:
+        model.train(was_training)
+    os.replace(tmp_path, path)
+
+
+class OnnxTriplaneEngine:
+    """
+    Runs an exported image-to-triplane graph in onnxruntime and returns the scene codes
+    as a torch tensor, so rendering and mesh extraction continue in PyTorch.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        providers: Optional[List[str]] = None,
+        num_threads: Optional[int] = None,
+    ) -> None:
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(
+            path,
+            sess_options=options,
+            providers=providers or ["CPUExecutionProvider"],
+        )
+        logging.info(f"Running {path} with {self.session.get_providers()}.")
+
+    def __call__(self, rgb_cond: torch.FloatTensor) -> torch.FloatTensor:
+        (scene_codes,) = self.session.run(
+            ["scene_codes"],
+            {"rgb_cond": np.ascontiguousarray(rgb_cond.detach().cpu().float().numpy())},
+        )
+        return torch.from_numpy(scene_codes).to(rgb_cond.device)
@@ -0,0 +1,261 @@
+import logging
+import os
+import queue
+import threading
+from concurrent.futures import Future
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, Union
+
+import numpy as np
+import PIL.Image
+import torch
+from PIL import Image
+
+from .system import TSR
+from .utils import (
+    VideoWriter,
+    get_available_memory,
+    remove_background,
+    resize_foreground,
+)
+
+
+@dataclass
+class TSRJob:
+    image: Union[str, PIL.Image.Image]
+    output_dir: str
+    remove_bg: bool = True
+    foreground_ratio: float = 0.85
+    mc_resolution: int = 256
+    model_save_format: str = "obj"
+    bake_texture: bool = False
+    texture_resolution: int = 2048
+    render: bool = False
+    n_render_views: int = 30
+
+
+class TSRWorker:
+    """
+    Holds one warm TSR instance and turns a TSRJob into the same files that
+    run.py writes for a single image (input.png, mesh.<fmt>, texture.png,
+    render_XXX.png, render.mp4).
+
+    If `memory_budget` (in bytes) is given, jobs whose predicted peak memory exceeds it
+    are rejected with a MemoryError before they run. A `chunk_size` of "auto" picks the
+    fastest chunk size within the memory budget, or the available memory of the device
+    if there is none.
+    A nonzero `occupancy_grid_resolution` skips empty space and a nonzero
+    `ray_block_size` terminates opaque rays early when rendering, which is faster but
+    approximate (see TriplaneNeRFRenderer). Renders stream `render_views_per_step` views
+    at a time into the video, one by default so that their memory does not grow with the
+    number of views.
+    """
+
+    def __init__(
+        self,
+        pretrained_model_name_or_path: str = "stabilityai/TripoSR",
+        device: str = "cuda:0",
+        chunk_size: Union[int, str] = 8192,
+        memory_budget: Optional[int] = None,
+        occupancy_grid_resolution: int = 0,
+        ray_block_size: int = 0,
+        render_views_per_step: int = 1,
+    ) -> None:
+        if not torch.cuda.is_available():
+            device = "cpu"
+        self.device = device
+        self.model = TSR.from_pretrained(
+            pretrained_model_name_or_path,
+            config_name="config.yaml",
+            weight_name="model.ckpt",
+        )
+        self.model.to(device)
+        self.memory_budget = memory_budget
+        if chunk_size == "auto":
+            chunk_size = self.model.get_auto_chunk_size(self.get_memory_budget(), device)
+        self.model.renderer.set_chunk_size(chunk_size)
+        self.model.renderer.set_occupancy_grid_resolution(occupancy_grid_resolution)
+        self.model.renderer.set_ray_block_size(ray_block_size)
+        self.render_views_per_step = render_views_per_step
+        self.rembg_session = None
+
+    def get_memory_budget(self) -> int:
+        if self.memory_budget is not None:
+            return self.memory_budget
+        return get_available_memory(self.device)
+
+    def estimate_peak_memory(self, job: TSRJob) -> int:
+        peak_memory = max(
+            self.model.estimate_forward_memory(1),
+            self.model.estimate_extract_mesh_memory(job.mc_resolution),
+        )
+        if job.render:
+            peak_memory = max(
+                peak_memory,
+                self.model.estimate_render_memory(
+                    job.n_render_views, views_per_step=self.render_views_per_step
+                ),
+            )
+        if job.bake_texture:
+            peak_memory = max(
+                peak_memory,
+                self.model.renderer.estimate_query_memory(
+                    self.model.decoder, job.texture_resolution**2, keys=["color"]
+                ),
+            )
+        return peak_memory
+
+    def preprocess(
+        self,
+        image: Union[str, PIL.Image.Image],
+        remove_bg: bool,
+        foreground_ratio: float,
+    ) -> PIL.Image.Image:
+        if isinstance(image, str):
+            image = Image.open(image)
+        if not remove_bg:
+            return image.convert("RGB")
+        if self.rembg_session is None:
+            import rembg
+
+            self.rembg_session = rembg.new_session()
+        image = remove_background(image, self.rembg_session)
+        image = resize_foreground(image, foreground_ratio)
+        image = np.array(image).astype(np.float32) / 255.0
+        image = image[:, :, :3] * image[:, :, 3:4] + (1 - image[:, :, 3:4]) * 0.5
+        return Image.fromarray((image * 255.0).astype(np.uint8))
+
+    def run(self, job: TSRJob) -> Dict[str, Any]:
+        # only an explicit budget is enforced, the free memory of a busy device says
+        # little about whether a job fits
+        if self.memory_budget is not None:
+            peak_memory = self.estimate_peak_memory(job)
+            if peak_memory > self.memory_budget:
+                raise MemoryError(
+                    f"The job needs about {peak_memory / 1024**2:.0f}MB, more than the "
+                    f"memory budget of {self.memory_budget / 1024**2:.0f}MB; lower "
+                    "mc_resolution or texture_resolution."
+                )
+
+        os.makedirs(job.output_dir, exist_ok=True)
+        outputs: Dict[str, Any] = {}
+
+        image = self.preprocess(job.image, job.remove_bg, job.foreground_ratio)
+        if job.remove_bg:
+            outputs["input"] = os.path.join(job.output_dir, "input.png")
+            image.save(outputs["input"])
+
+        with torch.no_grad():
+            scene_codes = self.model([image], device=self.device)
+
+        if job.render:
+            outputs["video"] = os.path.join(job.output_dir, "render.mp4")
+            # encodes and saves the frames while the next ones render
+            with VideoWriter(
+                outputs["video"],
+                fps=30,
+                frame_path=os.path.join(job.output_dir, "render_{:03d}.png"),
+            ) as writer:
+                for frames in self.model.render_iter(
+                    scene_codes,
+                    n_views=job.n_render_views,
+                    return_type="pil",
+                    views_per_step=self.render_views_per_step,
+                ):
+                    for frame in frames[0]:
+                        writer.write(frame)
+            outputs["renders"] = writer.frame_paths
+
+        meshes = self.model.extract_mesh(
+            scene_codes, not job.bake_texture, resolution=job.mc_resolution
+        )
+
+        outputs["mesh"] = os.path.join(
+            job.output_dir, f"mesh.{job.model_save_format}"
+        )
+        if job.bake_texture:
+            import xatlas
+
+            from .bake_texture import bake_texture
+
+            bake_output = bake_texture(
+                meshes[0], self.model, scene_codes[0], job.texture_resolution
+            )
+            xatlas.export(
+                outputs["mesh"],
+                meshes[0].vertices[bake_output["vmapping"]],
+                bake_output["indices"],
+                bake_output["uvs"],
+                meshes[0].vertex_normals[bake_output["vmapping"]],
+            )
+            outputs["texture"] = os.path.join(job.output_dir, "texture.png")
+            Image.fromarray(
+                (bake_output["colors"] * 255.0).astype(np.uint8)
+            ).transpose(Image.FLIP_TOP_BOTTOM).save(outputs["texture"])
+        else:
+            meshes[0].export(outputs["mesh"])
+
+        return outputs
+
+
+class TSRService:
+    """
+    A pool of warm TSRWorker threads that take jobs from a shared queue.
+
+    Each worker builds its own TSR instance once, when the service starts, so a
+    submitted job only pays for preprocessing, inference and export.
+    """
+
+    def __init__(self, num_workers: int = 1, **worker_kwargs) -> None:
+        assert num_workers > 0, "num_workers must be a positive integer."
+        self.jobs: "queue.Queue[Optional[tuple]]" = queue.Queue()
+        self.threads = [
+            threading.Thread(
+                target=self._work,
+                args=(worker_kwargs,),
+                name=f"tsr-worker-{i}",
+                daemon=True,
+            )
+            for i in range(num_workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def _work(self, worker_kwargs: Dict[str, Any]) -> None:
+        worker, load_error = None, None
+        try:
+            worker = TSRWorker(**worker_kwargs)
+            logging.info(f"{threading.current_thread().name} ready.")
+        except Exception as e:
+            logging.exception("Failed to initialize TSR worker")
+            load_error = e
+
+        while True:
+            item = self.jobs.get()
+            if item is None:
+                break
+            job, future = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            if worker is None:
+                future.set_exception(load_error)
+                continue
+            try:
+                future.set_result(worker.run(job))
+            except Exception as e:
+                future.set_exception(e)
+
+    def submit(self, job: TSRJob) -> Future:
+        future: Future = Future()
+        self.jobs.put((job, future))
+        return future
+
+    def run(self, job: TSRJob, timeout: Optional[float] = None) -> Dict[str, Any]:
+        return self.submit(job).result(timeout=timeout)
+
+    def shutdown(self, wait: bool = True) -> None:
+        for _ in self.threads:
+            self.jobs.put(None)
+        if wait:
+            for thread in self.threads:
+                thread.join()
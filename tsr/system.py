@@ -1,28 +1,41 @@
+import hashlib
+import logging
 import math
 import os
+import re
+import time
 from dataclasses import dataclass, field
-from typing import List, Union
+from typing import Dict, List, Optional, Union
 
 import numpy as np
 import PIL.Image
 import torch
+import torch.nn as nn
 import torch.nn.functional as F
-import trimesh
 from einops import rearrange
-from huggingface_hub import hf_hub_download
 from omegaconf import OmegaConf
 from PIL import Image
 
+from .cache import CameraRaysCache, SceneCodeCache
 from .models.isosurface import MarchingCubeHelper
 from .utils import (
     BaseModule,
     ImagePreprocessor,
     find_class,
-    get_spherical_cameras,
+    get_pretrained_file,
+    init_empty_weights,
+    load_state_dict_mmap,
     scale_tensor,
 )
 
 
+PRECISIONS = {
+    "fp32": torch.float32,
+    "bf16": torch.bfloat16,
+    "fp16": torch.float16,
+}
+
+
 class TSR(BaseModule):
     @dataclass
     class Config(BaseModule.Config):
@@ -50,24 +63,60 @@ class TSR(BaseModule):
 
     @classmethod
     def from_pretrained(
-        cls, pretrained_model_name_or_path: str, config_name: str, weight_name: str
+        cls,
+        pretrained_model_name_or_path: str,
+        config_name: str,
+        weight_name: str,
+        fuse_qkv_projections: bool = False,
     ):
-        if os.path.isdir(pretrained_model_name_or_path):
-            config_path = os.path.join(pretrained_model_name_or_path, config_name)
-            weight_path = os.path.join(pretrained_model_name_or_path, weight_name)
-        else:
-            config_path = hf_hub_download(
-                repo_id=pretrained_model_name_or_path, filename=config_name
-            )
-            weight_path = hf_hub_download(
-                repo_id=pretrained_model_name_or_path, filename=weight_name
-            )
+        config_path = get_pretrained_file(pretrained_model_name_or_path, config_name)
+        weight_path = get_pretrained_file(pretrained_model_name_or_path, weight_name)
 
         cfg = OmegaConf.load(config_path)
         OmegaConf.resolve(cfg)
-        model = cls(cfg)
-        ckpt = torch.load(weight_path, map_location="cpu")
-        model.load_state_dict(ckpt)
+        try:
+            # build the modules without allocating weights and assign the mapped tensors
+            state_dict = load_state_dict_mmap(weight_path)
+            with init_empty_weights():
+                model = cls(cfg)
+            model.load_state_dict(state_dict, assign=True)
+        except (TypeError, OSError) as e:
+            # torch < 2.1 (no mmap/assign) or the converted checkpoint cannot be written
+            logging.warning(f"Memory-mapped loading failed ({e}), loading in memory.")
+            model = cls(cfg)
+            ckpt = torch.load(weight_path, map_location="cpu")
+            model.load_state_dict(ckpt)
+        if fuse_qkv_projections:
+            model.fuse_qkv_projections()
+        model.precompute_backbone_prefix()
+        # for inference, which also lets the backbone start from the precomputed prefix
+        model.eval()
+        weight_stat = os.stat(weight_path)
+        model.model_id = hashlib.sha256(
+            f"{OmegaConf.to_yaml(cfg)}:{os.path.abspath(weight_path)}:"
+            f"{weight_stat.st_size}:{weight_stat.st_mtime_ns}".encode()
+        ).hexdigest()
+        return model
+
+    @classmethod
+    def from_quantized(cls, path: str):
+        ckpt = torch.load(path, map_location="cpu")
+        model = cls(ckpt["config"])
+        if ckpt["fused_qkv_projections"]:
+            model.fuse_qkv_projections()
+        model.quantize(ckpt["quantization"])
+        state_dict = ckpt["state_dict"]
+        if ckpt["fused_qkv_projections"]:
+            # older checkpoints also hold the projections that fusing replaced
+            # (deleted in place to keep the version metadata of the state dict)
+            expected = model.state_dict().keys()
+            for k in list(state_dict.keys()):
+                if k not in expected and re.search(r"\.to_[qkv]\.", k) is not None:
+                    del state_dict[k]
+        model.load_state_dict(state_dict)
+        model.precompute_backbone_prefix()
+        model.eval()
+        model.model_id = ckpt["model_id"]
         return model
 
     def configure(self):
@@ -83,6 +132,247 @@ class TSR(BaseModule):
         self.renderer = find_class(self.cfg.renderer_cls)(self.cfg.renderer)
         self.image_processor = ImagePreprocessor()
         self.isosurface_helper = None
+        self.model_id = hashlib.sha256(OmegaConf.to_yaml(self.cfg).encode()).hexdigest()
+        self.scene_code_cache: Optional[SceneCodeCache] = None
+        # shared by all renders, most of which use the same cameras
+        self.camera_rays_cache = CameraRaysCache()
+        self.quantization: Optional[str] = None
+        self.fused_qkv_projections = False
+        self.compiled = False
+        self.onnx_engine = None
+        self.precision: Dict[str, torch.dtype] = {
+            stage: torch.float32
+            for stage in ["image_tokenizer", "backbone", "post_processor", "decoder"]
+        }
+
+    def set_precision(
+        self, precision: str = "bf16", overrides: Optional[Dict[str, str]] = None
+    ) -> None:
+        """
+        Run the image tokenizer, backbone, post processor and decoder under autocast with
+        the given precision ("fp32", "bf16" or "fp16"). `overrides` maps a stage name to
+        another precision, e.g. {"decoder": "fp32"}. Density activation and marching
+        cubes thresholding always run in fp32 on the decoder's upcast output.
+        """
+        policy = {stage: precision for stage in self.precision}
+        if overrides is not None:
+            for stage in overrides:
+                if stage not in policy:
+                    raise ValueError(
+                        f"Unknown precision stage: {stage}, should be one of {list(policy)}"
+                    )
+            policy.update(overrides)
+        for stage, stage_precision in policy.items():
+            if stage_precision not in PRECISIONS:
+                raise ValueError(
+                    f"Unknown precision: {stage_precision}, should be one of {list(PRECISIONS)}"
+                )
+            if (
+                self.quantization is not None
+                and stage in ["backbone", "decoder"]
+                and stage_precision != "fp32"
+            ):
+                raise ValueError(
+                    f"The {stage} is quantized to {self.quantization} and has to run in fp32."
+                )
+            self.precision[stage] = PRECISIONS[stage_precision]
+        self.renderer.set_decoder_dtype(self.precision["decoder"])
+
+    def fuse_qkv_projections(self) -> None:
+        if self.fused_qkv_projections:
+            return
+        if self.quantization is not None:
+            raise RuntimeError("Projections have to be fused before quantization.")
+        self.backbone.fuse_qkv_projections()
+        self.fused_qkv_projections = True
+        if self.backbone.has_prefix:
+            self.precompute_backbone_prefix()
+
+    def precompute_backbone_prefix(self) -> None:
+        """
+        The triplane tokens fed to the backbone are learned embeddings that are the same for
+        every image, so the start of the backbone (up to the first cross-attention) is
+        computed once here and shared by all samples. Has to be called again whenever the
+        tokenizer or backbone weights change.
+        """
+        self.backbone.precompute_prefix(self.tokenizer(1))
+
+    def quantize(self, mode: str = "int8") -> None:
+        """
+        Apply dynamic quantization to the linear layers of the backbone transformer
+        blocks and the decoder MLP. Quantized layers only run on CPU.
+        """
+        if mode != "int8":
+            raise ValueError(f"Unknown quantization mode: {mode}, should be 'int8'")
+        if self.quantization is not None:
+            raise RuntimeError(f"The model is already quantized to {self.quantization}.")
+        if any(
+            self.precision[stage] != torch.float32 for stage in ["backbone", "decoder"]
+        ):
+            raise ValueError("The backbone and decoder have to run in fp32 to be quantized.")
+        if self.renderer.fused_decoder is not None:
+            raise RuntimeError("A fused decoder cannot be quantized.")
+
+        from torch.ao.quantization import quantize_dynamic
+
+        quantize_dynamic(
+            self.backbone.transformer_blocks, {nn.Linear}, dtype=torch.qint8, inplace=True
+        )
+        quantize_dynamic(self.decoder.layers, {nn.Linear}, dtype=torch.qint8, inplace=True)
+        self.quantization = mode
+        if self.backbone.has_prefix:
+            self.precompute_backbone_prefix()
+
+    def enable_compile(
+        self, mode: str = "default", cache_dir: Optional[str] = None
+    ) -> None:
+        """
+        Compile the backbone and the decoder with torch.compile for static shapes. The backbone
+        is specialized to the triplane token shape (and recompiled once per batch size), the
+        decoder to the renderer chunk size, padding the last chunk of every query to it.
+
+        Inductor's FX graph cache is enabled and written to `cache_dir` (or the default
+        inductor cache directory), so later processes reuse the compiled kernels. Compilation
+        happens on the first call, see `warmup`.
+        """
+        if not hasattr(torch, "compile"):
+            raise RuntimeError("Compiled inference requires PyTorch 2.0 or newer.")
+        if self.compiled:
+            return
+        if self.renderer.fused_decoder is not None:
+            raise RuntimeError("A fused decoder cannot be compiled.")
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            os.environ["TORCHINDUCTOR_CACHE_DIR"] = cache_dir
+        from torch._inductor import config as inductor_config
+
+        if hasattr(inductor_config, "fx_graph_cache"):
+            inductor_config.fx_graph_cache = True
+
+        # patch the instances, so that state_dict keys and saved checkpoints are unchanged
+        self.backbone.forward = torch.compile(
+            self.backbone.forward, mode=mode, dynamic=False
+        )
+        self.backbone.forward_from_prefix = torch.compile(
+            self.backbone.forward_from_prefix, mode=mode, dynamic=False
+        )
+        self.decoder.forward = torch.compile(
+            self.decoder.forward, mode=mode, dynamic=False
+        )
+        self.decoder.forward_from_first_linear = torch.compile(
+            self.decoder.forward_from_first_linear, mode=mode, dynamic=False
+        )
+        self.renderer.set_pad_last_chunk(True)
+        self.compiled = True
+
+    @torch.no_grad()
+    def warmup(self, device: str, batch_size: int = 1) -> None:
+        """
+        Run the backbone and the decoder once on dummy inputs, which triggers compilation
+        after `enable_compile` and fills the caches before the first real request.
+        """
+        image_size = self.cfg.cond_image_size
+        rgb_cond = torch.full((batch_size, 1, image_size, image_size, 3), 0.5, device=device)
+        scene_codes = self.get_scene_codes(rgb_cond)
+        positions = torch.zeros(max(self.renderer.chunk_size, 1), 3, device=device)
+        self.renderer.query_triplane(self.decoder, positions, scene_codes[0])
+
+    def save_quantized(self, path: str) -> None:
+        assert self.quantization is not None, "Call quantize() before save_quantized()."
+        # write to a temporary file first so that concurrent loaders never see a partial file
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        torch.save(
+            {
+                "config": OmegaConf.to_container(self.cfg),
+                "quantization": self.quantization,
+                "fused_qkv_projections": self.fused_qkv_projections,
+                "model_id": self.model_id,
+                "state_dict": self.state_dict(),
+            },
+            tmp_path,
+        )
+        os.replace(tmp_path, path)
+
+    def autocast(self, stage: str, device: Union[str, torch.device]):
+        dtype = self.precision[stage]
+        return torch.autocast(
+            device_type=torch.device(device).type,
+            dtype=dtype,
+            enabled=dtype != torch.float32,
+        )
+
+    def set_backend(
+        self, backend: str = "torch", onnx_path: Optional[str] = None, **engine_kwargs
+    ) -> None:
+        """
+        Choose what computes the scene codes: "torch" (the modules of this model) or "onnx"
+        (the graph at `onnx_path` in onnxruntime, exported from this model first if the file
+        does not exist). Rendering and mesh extraction always run in PyTorch.
+        """
+        if backend == "torch":
+            self.onnx_engine = None
+            return
+        if backend != "onnx":
+            raise ValueError(f"Unknown backend: {backend}, should be 'torch' or 'onnx'")
+        if onnx_path is None:
+            raise ValueError("The onnx backend needs an onnx_path.")
+        if any(
+            self.precision[stage] != torch.float32
+            for stage in ["image_tokenizer", "backbone", "post_processor"]
+        ):
+            raise ValueError("The onnx backend runs in fp32.")
+
+        from .onnx_backend import OnnxTriplaneEngine, export_onnx
+
+        if not os.path.exists(onnx_path):
+            logging.info(f"Exporting the image-to-triplane graph to {onnx_path} ...")
+            export_onnx(self, onnx_path)
+        self.onnx_engine = OnnxTriplaneEngine(onnx_path, **engine_kwargs)
+
+    def enable_scene_code_cache(
+        self,
+        max_items: int = 32,
+        cache_dir: Optional[str] = None,
+        disk_dtype: torch.dtype = torch.float32,
+    ) -> None:
+        self.scene_code_cache = SceneCodeCache(
+            max_items=max_items, cache_dir=cache_dir, disk_dtype=disk_dtype
+        )
+
+    def disable_scene_code_cache(self) -> None:
+        self.scene_code_cache = None
+
+    def enable_fused_decoder(self, num_threads: int = 1) -> None:
+        """
+        Decode with a FusedNeRFMLP, the inference-only decoder with packed weights and
+        preallocated buffers, when the decoder runs in fp32. `num_threads` > 1 splits large
+        chunks across a thread pool.
+        """
+        if self.quantization is not None:
+            raise RuntimeError("A quantized decoder cannot be fused.")
+        if self.compiled:
+            raise RuntimeError("A compiled decoder cannot be fused.")
+        from .models.network_utils import FusedNeRFMLP
+
+        self.disable_fused_decoder()
+        self.renderer.set_fused_decoder(FusedNeRFMLP(self.decoder, num_threads=num_threads))
+
+    def disable_fused_decoder(self) -> None:
+        if self.renderer.fused_decoder is not None:
+            self.renderer.fused_decoder.close()
+        self.renderer.set_fused_decoder(None)
+
+    def get_cache_identity(self) -> str:
+        # everything that changes the scene codes produced for the same input image
+        identity = self.model_id
+        if self.quantization is not None:
+            identity += f":quantization={self.quantization}"
+        if self.onnx_engine is not None:
+            identity += ":backend=onnx"
+        for stage in ["image_tokenizer", "backbone", "post_processor"]:
+            if self.precision[stage] != torch.float32:
+                identity += f":{stage}={self.precision[stage]}"
+        return identity
 
     def forward(
         self,
@@ -99,25 +389,193 @@ class TSR(BaseModule):
         rgb_cond = self.image_processor(image, self.cfg.cond_image_size)[:, None].to(
             device
         )
-        batch_size = rgb_cond.shape[0]
+        if self.scene_code_cache is None:
+            return self.get_scene_codes(rgb_cond)
 
-        input_image_tokens: torch.Tensor = self.image_tokenizer(
-            rearrange(rgb_cond, "B Nv H W C -> B Nv C H W", Nv=1),
+        identity = self.get_cache_identity()
+        keys = [SceneCodeCache.make_key(x, identity) for x in rgb_cond]
+        scene_codes = [self.scene_code_cache.get(key) for key in keys]
+        missing = [i for i, scene_code in enumerate(scene_codes) if scene_code is None]
+        if len(missing) > 0:
+            new_scene_codes = self.get_scene_codes(rgb_cond[missing])
+            for i, scene_code in zip(missing, new_scene_codes):
+                self.scene_code_cache.put(keys[i], scene_code)
+                scene_codes[i] = scene_code
+        # entries read back from disk keep the dtype of the disk tier
+        return torch.stack(
+            [scene_code.to(rgb_cond.device, torch.float32) for scene_code in scene_codes]
         )
 
+    def get_scene_codes(self, rgb_cond: torch.FloatTensor) -> torch.FloatTensor:
+        if self.onnx_engine is not None:
+            return self.onnx_engine(rgb_cond)
+
+        batch_size = rgb_cond.shape[0]
+
+        with self.autocast("image_tokenizer", rgb_cond.device):
+            input_image_tokens: torch.Tensor = self.image_tokenizer(
+                rearrange(rgb_cond, "B Nv H W C -> B Nv C H W", Nv=1),
+            )
+
         input_image_tokens = rearrange(
             input_image_tokens, "B Nv C Nt -> B (Nv Nt) C", Nv=1
         )
 
-        tokens: torch.Tensor = self.tokenizer(batch_size)
+        with self.autocast("backbone", rgb_cond.device):
+            if self.backbone.has_prefix and not self.training:
+                tokens = self.backbone.forward_from_prefix(input_image_tokens)
+            else:
+                tokens: torch.Tensor = self.tokenizer(batch_size)
+                tokens = self.backbone(
+                    tokens,
+                    encoder_hidden_states=input_image_tokens,
+                )
 
-        tokens = self.backbone(
-            tokens,
-            encoder_hidden_states=input_image_tokens,
+        with self.autocast("post_processor", rgb_cond.device):
+            scene_codes = self.post_processor(self.tokenizer.detokenize(tokens))
+        return scene_codes.float()
+
+    def estimate_forward_memory(self, batch_size: int) -> int:
+        image_size = self.cfg.cond_image_size
+        n_triplane_tokens = 3 * self.tokenizer.cfg.plane_size**2
+        image_tokenizer_memory = self.image_tokenizer.estimate_peak_memory(
+            batch_size, image_size
+        )
+        backbone_memory = self.backbone.estimate_peak_memory(
+            batch_size,
+            n_triplane_tokens,
+            encoder_seq_len=self.image_tokenizer.num_tokens(image_size),
         )
+        # the image tokens stay alive while the backbone runs
+        image_tokens = (
+            batch_size
+            * self.image_tokenizer.num_tokens(image_size)
+            * self.image_tokenizer.model.config.hidden_size
+            * 4
+        )
+        return max(image_tokenizer_memory, backbone_memory + image_tokens)
 
-        scene_codes = self.post_processor(self.tokenizer.detokenize(tokens))
-        return scene_codes
+    def get_max_batch_size(self, memory_budget: int, max_batch_size: int) -> int:
+        batch_size = 1
+        while (
+            batch_size < max_batch_size
+            and self.estimate_forward_memory(batch_size + 1) <= memory_budget
+        ):
+            batch_size += 1
+        return batch_size
+
+    def estimate_render_memory(
+        self,
+        n_views: int,
+        height: int = 256,
+        width: int = 256,
+        batch_size: int = 1,
+        views_per_step: Optional[int] = None,
+    ) -> int:
+        """
+        Rough estimate (in bytes) of the peak memory of `render_iter` for `batch_size` scenes,
+        `views_per_step` views at a time (all views by default, as `render`).
+        """
+        if views_per_step is None:
+            views_per_step = n_views
+        n_pixels = height * width
+        n_rays = batch_size * min(views_per_step, n_views) * n_pixels
+        # the cached rays of all views: origins, directions, intersections and index
+        camera_rays = n_views * n_pixels * (3 + 3 + 1 + 1 + 2) * 4
+        # the frames of a step, in fp32 and converted to uint8
+        frames = n_rays * 3 * (4 + 1)
+        return (
+            camera_rays
+            + frames
+            + self.renderer.estimate_render_memory(self.decoder, n_rays, batch_size)
+        )
+
+    def get_max_views_per_step(
+        self,
+        memory_budget: int,
+        n_views: int,
+        height: int = 256,
+        width: int = 256,
+        batch_size: int = 1,
+    ) -> int:
+        views_per_step = 1
+        while views_per_step < n_views and (
+            self.estimate_render_memory(
+                n_views, height, width, batch_size, views_per_step=views_per_step + 1
+            )
+            <= memory_budget
+        ):
+            views_per_step += 1
+        return views_per_step
+
+    def estimate_extract_mesh_memory(self, resolution: int = 256) -> int:
+        """
+        Rough estimate (in bytes) of the peak memory of `extract_mesh` at the given marching
+        cubes resolution, for one scene at a time.
+        """
+        n_points = resolution**3
+        # the grid vertices and their scaled copy, the density grid and its shifted copy
+        grid = n_points * (3 + 3 + 1 + 1) * 4
+        return grid + self.renderer.estimate_query_memory(
+            self.decoder, n_points, keys=["density_act"]
+        )
+
+    @torch.no_grad()
+    def get_auto_chunk_size(
+        self,
+        memory_budget: int,
+        device: Union[str, torch.device],
+        min_chunk_size: int = 2048,
+        max_chunk_size: int = 131072,
+    ) -> int:
+        """
+        Pick the decoding chunk size of the renderer: of the powers of two between
+        `min_chunk_size` and `max_chunk_size` that decode within `memory_budget`, the
+        smallest one whose measured throughput is within 5% of the best.
+        """
+        candidates = []
+        chunk_size = min_chunk_size
+        while chunk_size <= max_chunk_size:
+            memory = self.renderer.estimate_query_memory(
+                self.decoder, chunk_size, chunk_size=chunk_size
+            )
+            if chunk_size > min_chunk_size and memory > memory_budget:
+                break
+            candidates.append(chunk_size)
+            chunk_size *= 2
+
+        # the values do not matter for the throughput
+        plane_size = 2 * self.tokenizer.cfg.plane_size  # upsampled by the post processor
+        triplane = torch.randn(
+            3, self.post_processor.cfg.out_channels, plane_size, plane_size, device=device
+        )
+        # laid out once, as for the queries of a real scene
+        triplane = self.renderer.prepare_triplane(self.decoder, triplane)
+        radius = self.renderer.cfg.radius
+        positions = (torch.rand(candidates[-1], 3, device=device) * 2 - 1) * radius
+
+        previous_chunk_size = self.renderer.chunk_size
+        throughputs = []
+        try:
+            for chunk_size in [candidates[0]] + candidates:
+                self.renderer.set_chunk_size(chunk_size)
+                if torch.device(device).type == "cuda":
+                    torch.cuda.synchronize(device)
+                start = time.perf_counter()
+                self.renderer.query_triplane(self.decoder, positions, triplane)
+                if torch.device(device).type == "cuda":
+                    torch.cuda.synchronize(device)
+                throughputs.append(positions.shape[0] / (time.perf_counter() - start))
+        finally:
+            self.renderer.set_chunk_size(previous_chunk_size)
+        # the first run only warms up
+        throughputs = throughputs[1:]
+        best = max(throughputs)
+        return next(
+            chunk_size
+            for chunk_size, throughput in zip(candidates, throughputs)
+            if throughput >= 0.95 * best
+        )
 
     def render(
         self,
@@ -130,35 +588,94 @@ class TSR(BaseModule):
         width: int = 256,
         return_type: str = "pil",
     ):
-        rays_o, rays_d = get_spherical_cameras(
-            n_views, elevation_deg, camera_distance, fovy_deg, height, width
+        # all views at once, see render_iter to get them one by one
+        images = [[] for _ in range(scene_codes.shape[0])]
+        for step in self.render_iter(
+            scene_codes,
+            n_views,
+            elevation_deg=elevation_deg,
+            camera_distance=camera_distance,
+            fovy_deg=fovy_deg,
+            height=height,
+            width=width,
+            return_type=return_type,
+            views_per_step=n_views,
+        ):
+            for images_, step_images in zip(images, step):
+                images_.extend(step_images)
+        return images
+
+    def render_iter(
+        self,
+        scene_codes,
+        n_views: int,
+        elevation_deg: float = 0.0,
+        camera_distance: float = 1.9,
+        fovy_deg: float = 40.0,
+        height: int = 256,
+        width: int = 256,
+        return_type: str = "pil",
+        views_per_step: int = 1,
+    ):
+        """
+        Render the views of `render` `views_per_step` at a time and yield the frames of every
+        step as soon as they are ready, a list per scene, so that a consumer can encode them
+        while the next views render and memory does not grow with the number of views.
+        """
+        views_per_step = max(1, views_per_step)
+        rays = self.camera_rays_cache.get(
+            n_views,
+            elevation_deg,
+            camera_distance,
+            fovy_deg,
+            height,
+            width,
+            self.renderer.cfg.radius,
+            scene_codes.device,
         )
-        rays_o, rays_d = rays_o.to(scene_codes.device), rays_d.to(scene_codes.device)
+        n_scenes = scene_codes.shape[0]
+
+        def expand(x):
+            return x.expand(n_scenes, *x.shape)
+
+        with torch.no_grad():
+            # shared by all views of a scene
+            triplane = self.renderer.prepare_triplane(self.decoder, scene_codes)
+            occupancy_grid = self.renderer.build_occupancy_grid(self.decoder, triplane)
+
+        for first_view in range(0, n_views, views_per_step):
+            last_view = min(first_view + views_per_step, n_views)
+            start = rays.view_offsets[first_view]
+            end = rays.view_offsets[last_view]
+            # all views of the step of all scenes in one ray stream, only the rays that hit
+            # the bounding box are rendered
+            with torch.no_grad():
+                colors = self.renderer(
+                    self.decoder,
+                    triplane,
+                    expand(rays.rays_o[start:end]),
+                    expand(rays.rays_d[start:end]),
+                    occupancy_grid=occupancy_grid,
+                    t_near=expand(rays.t_near[start:end]),
+                    t_far=expand(rays.t_far[start:end]),
+                )
+            # the other rays only see the white background
+            n_step_views = last_view - first_view
+            images = colors.new_ones(n_scenes, n_step_views * height * width, 3)
+            images[:, rays.valid_index[start:end] - first_view * height * width] = colors
+            images = images.view(n_scenes, n_step_views, height, width, 3)
 
-        def process_output(image: torch.FloatTensor):
             if return_type == "pt":
-                return image
+                pass
             elif return_type == "np":
-                return image.detach().cpu().numpy()
+                images = images.detach().cpu().numpy()
             elif return_type == "pil":
-                return Image.fromarray(
-                    (image.detach().cpu().numpy() * 255.0).astype(np.uint8)
-                )
+                # convert on the device and transfer all frames of the step at once, as uint8
+                images = (images.detach() * 255.0).to(torch.uint8).cpu().numpy()
+                images = [[Image.fromarray(image) for image in images_] for images_ in images]
             else:
                 raise NotImplementedError
-
-        images = []
-        for scene_code in scene_codes:
-            images_ = []
-            for i in range(n_views):
-                with torch.no_grad():
-                    image = self.renderer(
-                        self.decoder, scene_code, rays_o[i], rays_d[i]
-                    )
-                images_.append(process_output(image))
-            images.append(images_)
-
-        return images
+            yield [list(images_) for images_ in images]
 
     def set_marching_cubes_resolution(self, resolution: int):
         if (
@@ -169,10 +686,14 @@ class TSR(BaseModule):
         self.isosurface_helper = MarchingCubeHelper(resolution)
 
     def extract_mesh(self, scene_codes, has_vertex_color, resolution: int = 256, threshold: float = 25.0):
+        import trimesh
+
         self.set_marching_cubes_resolution(resolution)
         meshes = []
         for scene_code in scene_codes:
             with torch.no_grad():
+                # shared by the density and color queries
+                triplane = self.renderer.prepare_triplane(self.decoder, scene_code)
                 density = self.renderer.query_triplane(
                     self.decoder,
                     scale_tensor(
@@ -180,7 +701,8 @@ class TSR(BaseModule):
                         self.isosurface_helper.points_range,
                         (-self.renderer.cfg.radius, self.renderer.cfg.radius),
                     ),
-                    scene_code,
+                    triplane,
+                    keys=["density_act"],
                 )["density_act"]
             v_pos, t_pos_idx = self.isosurface_helper(-(density - threshold))
             v_pos = scale_tensor(
@@ -194,7 +716,8 @@ class TSR(BaseModule):
                     color = self.renderer.query_triplane(
                         self.decoder,
                         v_pos,
-                        scene_code,
+                        triplane,
+                        keys=["color"],
                     )["color"]
             mesh = trimesh.Trimesh(
                 vertices=v_pos.cpu().numpy(),
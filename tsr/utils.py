@@ -1,17 +1,21 @@
+import functools
+import hashlib
 import importlib
+import logging
 import math
+import os
+import queue
+import threading
 from collections import defaultdict
+from contextlib import contextmanager
 from dataclasses import dataclass
-from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
 
-import imageio
 import numpy as np
 import PIL.Image
-import rembg
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-import trimesh
 from omegaconf import DictConfig, OmegaConf
 from PIL import Image
 
@@ -29,6 +33,116 @@ def find_class(cls_string):
     return cls
 
 
+def get_pretrained_file(pretrained_model_name_or_path: str, filename: str) -> str:
+    """
+    Resolve `filename` from a local directory, or from a huggingface repo id. Files already in
+    the huggingface cache are used without contacting the hub.
+    """
+    if os.path.isdir(pretrained_model_name_or_path):
+        return os.path.join(pretrained_model_name_or_path, filename)
+
+    from huggingface_hub import hf_hub_download, try_to_load_from_cache
+
+    cached_path = try_to_load_from_cache(pretrained_model_name_or_path, filename)
+    if isinstance(cached_path, str):
+        return cached_path
+    return hf_hub_download(repo_id=pretrained_model_name_or_path, filename=filename)
+
+
+# state of init_empty_weights: the patch of nn.Module.register_parameter is installed while
+# any thread is inside the context, and only affects the threads that are inside it
+_empty_weights_lock = threading.Lock()
+_empty_weights_users = 0
+_empty_weights_local = threading.local()
+_register_parameter: Optional[Callable] = None
+
+
+def _register_empty_parameter(module, name, param):
+    _register_parameter(module, name, param)
+    if param is not None and getattr(_empty_weights_local, "enabled", False):
+        param_cls = type(module._parameters[name])
+        kwargs = module._parameters[name].__dict__
+        module._parameters[name] = param_cls(
+            module._parameters[name].to(torch.device("meta")), **kwargs
+        )
+
+
+@contextmanager
+def init_empty_weights():
+    """
+    Create the parameters of all modules built inside this context on the meta device, so
+    nothing is allocated or randomly initialized. Buffers are still created normally since
+    non-persistent ones are never part of a checkpoint. The real weights have to be set with
+    `module.load_state_dict(state_dict, assign=True)` afterwards.
+
+    Only modules built by the calling thread are affected, so other threads can build
+    modules or load models at the same time.
+    """
+    global _empty_weights_users, _register_parameter
+    with _empty_weights_lock:
+        if _empty_weights_users == 0:
+            _register_parameter = nn.Module.register_parameter
+            nn.Module.register_parameter = _register_empty_parameter
+        _empty_weights_users += 1
+    enabled = getattr(_empty_weights_local, "enabled", False)
+    _empty_weights_local.enabled = True
+    try:
+        yield
+    finally:
+        _empty_weights_local.enabled = enabled
+        with _empty_weights_lock:
+            _empty_weights_users -= 1
+            if _empty_weights_users == 0:
+                nn.Module.register_parameter = _register_parameter
+
+
+def get_cache_dir() -> str:
+    # for files derived from the inputs, which may live in read-only or shared locations
+    # such as the Hugging Face cache
+    return os.environ.get(
+        "TSR_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "tsr")
+    )
+
+
+def load_state_dict_mmap(weight_path: str) -> Dict[str, torch.Tensor]:
+    """
+    Load a checkpoint with its tensors memory-mapped from the file instead of read into memory,
+    so processes loading the same file share the page cache. Checkpoints in the legacy
+    (non-zip) serialization format cannot be mapped and are converted once to a copy in
+    `get_cache_dir()`, keyed by the path and modification time of the original file. If that
+    copy cannot be written, the checkpoint is read into memory.
+    """
+    try:
+        return torch.load(weight_path, map_location="cpu", mmap=True)
+    except RuntimeError:
+        # legacy format, fall through to the converted copy
+        pass
+
+    real_path = os.path.realpath(weight_path)
+    stat = os.stat(real_path)
+    key = hashlib.sha256(
+        f"{real_path}:{stat.st_mtime_ns}:{stat.st_size}".encode()
+    ).hexdigest()
+    mmap_path = os.path.join(get_cache_dir(), "mmap", f"{key}.ckpt")
+    if not os.path.exists(mmap_path):
+        logging.info(f"Converting {weight_path} to a memory-mappable checkpoint ...")
+        state_dict = torch.load(weight_path, map_location="cpu")
+        tmp_path = f"{mmap_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(mmap_path), exist_ok=True)
+            torch.save(state_dict, tmp_path)
+            os.replace(tmp_path, mmap_path)
+        except OSError as e:
+            logging.warning(
+                f"Could not write {mmap_path} ({e}), loading {weight_path} into memory."
+            )
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return state_dict
+        del state_dict
+    return torch.load(mmap_path, map_location="cpu", mmap=True)
+
+
 def get_intrinsic_from_fov(fov, H, W, bs=-1):
     focal_length = 0.5 * H / np.tan(0.5 * fov)
     intrinsic = np.identity(3, dtype=np.float32)
@@ -114,6 +228,14 @@ class ImagePreprocessor:
         return image
 
 
+@functools.lru_cache(maxsize=8)
+def _get_bbox_bounds(radius: float, device: torch.device) -> torch.FloatTensor:
+    # shared by all calls with the same radius, must not be modified in place
+    return (1.0 - 1.0e-3) * torch.FloatTensor(
+        [[-radius, radius], [-radius, radius], [-radius, radius]]
+    ).to(device)
+
+
 def rays_intersect_bbox(
     rays_o: torch.Tensor,
     rays_d: torch.Tensor,
@@ -127,12 +249,11 @@ def rays_intersect_bbox(
         rays_d.abs() < 1e-6, torch.full_like(rays_d, 1e-6), rays_d
     )
     if type(radius) in [int, float]:
-        radius = torch.FloatTensor(
-            [[-radius, radius], [-radius, radius], [-radius, radius]]
-        ).to(rays_o.device)
-    radius = (
-        1.0 - 1.0e-3
-    ) * radius  # tighten the radius to make sure the intersection point lies in the bounding box
+        radius = _get_bbox_bounds(float(radius), rays_o.device)
+    else:
+        radius = (
+            1.0 - 1.0e-3
+        ) * radius  # tighten the radius to make sure the intersection point lies in the bounding box
     interx0 = (radius[..., 1] - rays_o) / rays_d_valid
     interx1 = (radius[..., 0] - rays_o) / rays_d_valid
     t_near = torch.minimum(interx0, interx1).amax(dim=-1).clamp_min(near)
@@ -151,6 +272,41 @@ def rays_intersect_bbox(
     return t_near, t_far, rays_valid
 
 
+def sample_pdf(
+    bins: torch.Tensor,
+    weights: torch.Tensor,
+    n_samples: int,
+    randomized: bool = False,
+) -> torch.Tensor:
+    """
+    Inverse transform sampling of `n_samples` values per ray from the piecewise constant
+    distribution given by `weights` (N_rays, N_bins) over the intervals `bins` (N_bins + 1)
+    or (N_rays, N_bins + 1). Without `randomized`, the samples are the centers of
+    `n_samples` equal steps of the CDF, so the result is deterministic.
+    """
+    weights = weights.detach() + 1e-5  # rays with no weight get uniform samples
+    pdf = weights / weights.sum(dim=-1, keepdim=True)
+    cdf = torch.cat([torch.zeros_like(pdf[:, :1]), torch.cumsum(pdf, dim=-1)], dim=-1)
+    if bins.ndim == 1:
+        bins = bins.expand(cdf.shape[0], -1)
+
+    if randomized:
+        u = torch.rand(cdf.shape[0], n_samples, device=cdf.device, dtype=cdf.dtype)
+    else:
+        u = (torch.arange(n_samples, device=cdf.device, dtype=cdf.dtype) + 0.5) / n_samples
+        u = u.expand(cdf.shape[0], -1).contiguous()
+
+    inds = torch.searchsorted(cdf, u, right=True)
+    below = (inds - 1).clamp(0, cdf.shape[-1] - 1)
+    above = inds.clamp(0, cdf.shape[-1] - 1)
+    cdf_below, cdf_above = torch.gather(cdf, 1, below), torch.gather(cdf, 1, above)
+    bins_below, bins_above = torch.gather(bins, 1, below), torch.gather(bins, 1, above)
+
+    denom = cdf_above - cdf_below
+    denom = torch.where(denom < 1e-5, torch.ones_like(denom), denom)
+    return bins_below + (u - cdf_below) / denom * (bins_above - bins_below)
+
+
 def chunk_batch(func: Callable, chunk_size: int, *args, **kwargs) -> Any:
     if chunk_size <= 0:
         return func(*args, **kwargs)
@@ -218,6 +374,102 @@ def chunk_batch(func: Callable, chunk_size: int, *args, **kwargs) -> Any:
         return out_merged
 
 
+def chunk_batch_into(
+    func: Callable,
+    chunk_size: int,
+    *args,
+    keys: Optional[Sequence[Any]] = None,
+    **kwargs,
+) -> Dict[Any, torch.Tensor]:
+    """
+    Same as `chunk_batch` for a `func` returning a dict of tensors, but every chunk is
+    written into output tensors allocated once, when the first chunk is computed, instead
+    of concatenating the chunks at the end, so memory peaks at the size of the output
+    instead of twice that. Only the outputs in `keys` are kept if given.
+    """
+    B = None
+    for arg in list(args) + list(kwargs.values()):
+        if isinstance(arg, torch.Tensor):
+            B = arg.shape[0]
+            break
+    assert (
+        B is not None
+    ), "No tensor found in args or kwargs, cannot determine batch size."
+    if chunk_size <= 0:
+        chunk_size = max(1, B)
+    out: Dict[Any, torch.Tensor] = {}
+    # max(1, B) to support B == 0
+    for i in range(0, max(1, B), chunk_size):
+        out_chunk = func(
+            *[
+                arg[i : i + chunk_size] if isinstance(arg, torch.Tensor) else arg
+                for arg in args
+            ],
+            **{
+                k: arg[i : i + chunk_size] if isinstance(arg, torch.Tensor) else arg
+                for k, arg in kwargs.items()
+            },
+        )
+        if not isinstance(out_chunk, dict):
+            raise TypeError(
+                f"Return value of func must be a dict, get {type(out_chunk)}."
+            )
+        for k in out_chunk.keys() if keys is None else keys:
+            v = out_chunk[k]
+            v = v if torch.is_grad_enabled() else v.detach()
+            if k not in out:
+                out[k] = v.new_empty(B, *v.shape[1:])
+            out[k][i : i + v.shape[0]] = v
+    return out
+
+
+class Workspace:
+    """
+    Scratch tensors reused across calls, e.g. for the temporaries of every chunk of a
+    chunked computation. A buffer only grows, so it should be sized by the chunk size and
+    not by the whole input; the tensor returned by `get` is valid until the next `get` of
+    the same name.
+    """
+
+    def __init__(self) -> None:
+        self.buffers: Dict[str, torch.Tensor] = {}
+
+    def get(
+        self,
+        name: str,
+        shape: Tuple[int, ...],
+        dtype: torch.dtype,
+        device: Union[str, torch.device],
+    ) -> torch.Tensor:
+        numel = math.prod(shape)
+        buffer = self.buffers.get(name)
+        if (
+            buffer is None
+            or buffer.numel() < numel
+            or buffer.dtype != dtype
+            or buffer.device != torch.device(device)
+        ):
+            buffer = torch.empty(numel, dtype=dtype, device=device)
+            self.buffers[name] = buffer
+        return buffer[:numel].view(shape)
+
+    def clear(self) -> None:
+        self.buffers.clear()
+
+
+def get_available_memory(device: Union[str, torch.device]) -> int:
+    device = torch.device(device)
+    if device.type == "cuda":
+        free_memory, _ = torch.cuda.mem_get_info(device)
+        return free_memory
+    if os.path.exists("/proc/meminfo"):
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+
 ValidScale = Union[Tuple[float, float], torch.FloatTensor]
 
 
@@ -338,14 +590,15 @@ def get_rays(
     return rays_o, rays_d
 
 
-def get_spherical_cameras(
+def get_spherical_camera_poses(
     n_views: int,
     elevation_deg: float,
     camera_distance: float,
-    fovy_deg: float,
-    height: int,
-    width: int,
-):
+) -> torch.FloatTensor:
+    """
+    Camera-to-world matrices (n_views, 4, 4) of cameras evenly spaced in azimuth around the
+    origin and looking at it, in the OpenGL convention (x right, y up, looking along -z).
+    """
     azimuth_deg = torch.linspace(0, 360.0, n_views + 1)[:n_views]
     elevation_deg = torch.full_like(azimuth_deg, elevation_deg)
     camera_distances = torch.full_like(elevation_deg, camera_distance)
@@ -370,8 +623,6 @@ def get_spherical_cameras(
     # default camera up direction as +z
     up = torch.as_tensor([0, 0, 1], dtype=torch.float32)[None, :].repeat(n_views, 1)
 
-    fovy = torch.full_like(elevation_deg, fovy_deg) * math.pi / 180
-
     lookat = F.normalize(center - camera_positions, dim=-1)
     right = F.normalize(torch.cross(lookat, up), dim=-1)
     up = F.normalize(torch.cross(right, lookat), dim=-1)
@@ -381,6 +632,19 @@ def get_spherical_cameras(
     )
     c2w = torch.cat([c2w3x4, torch.zeros_like(c2w3x4[:, :1])], dim=1)
     c2w[:, 3, 3] = 1.0
+    return c2w
+
+
+def get_spherical_cameras(
+    n_views: int,
+    elevation_deg: float,
+    camera_distance: float,
+    fovy_deg: float,
+    height: int,
+    width: int,
+):
+    c2w = get_spherical_camera_poses(n_views, elevation_deg, camera_distance)
+    fovy = torch.full((n_views,), fovy_deg) * math.pi / 180
 
     # get directions by dividing directions_unit_focal by focal length
     focal_length = 0.5 * height / torch.tan(0.5 * fovy)
@@ -410,6 +674,8 @@ def remove_background(
         do_remove = False
     do_remove = do_remove or force
     if do_remove:
+        import rembg
+
         image = rembg.remove(image, session=rembg_session, **rembg_kwargs)
     return image
 
@@ -461,6 +727,8 @@ def save_video(
     fps: int = 30,
 ):
     # use imageio to save video
+    import imageio
+
     frames = [np.array(frame) for frame in frames]
     writer = imageio.get_writer(output_path, fps=fps)
     for frame in frames:
@@ -468,7 +736,78 @@ def save_video(
     writer.close()
 
 
+class VideoWriter:
+    """
+    Encodes frames into a video, and optionally saves each of them as an image to
+    `frame_path.format(index)`, on a background thread, so that the next frames can be
+    rendered meanwhile. At most `max_pending` frames wait for the writer, `write` blocks
+    beyond that, which bounds memory for any number of frames. Errors of the writer are
+    raised by `write` or `close`; the paths of the saved frames are in `frame_paths`.
+
+        with VideoWriter("render.mp4", frame_path="render_{:03d}.png") as writer:
+            for frames in model.render_iter(scene_codes, n_views=30):
+                writer.write(frames[0][0])
+    """
+
+    def __init__(
+        self,
+        output_path: str,
+        fps: int = 30,
+        frame_path: Optional[str] = None,
+        max_pending: int = 4,
+    ) -> None:
+        import imageio
+
+        self.writer = imageio.get_writer(output_path, fps=fps)
+        self.frame_path = frame_path
+        self.frame_paths: List[str] = []
+        self.queue: "queue.Queue" = queue.Queue(maxsize=max_pending)
+        self.error: Optional[BaseException] = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self) -> None:
+        while True:
+            frame = self.queue.get()
+            if frame is None:
+                break
+            if self.error is not None:
+                # drain the queue so that write never blocks forever
+                continue
+            try:
+                if self.frame_path is not None:
+                    path = self.frame_path.format(len(self.frame_paths))
+                    frame.save(path)
+                    self.frame_paths.append(path)
+                self.writer.append_data(np.asarray(frame))
+            except BaseException as e:
+                self.error = e
+
+    def _raise_error(self) -> None:
+        if self.error is not None:
+            raise self.error
+
+    def write(self, frame: PIL.Image.Image) -> None:
+        self._raise_error()
+        self.queue.put(frame)
+
+    def close(self) -> None:
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+            self.writer.close()
+        self._raise_error()
+
+    def __enter__(self) -> "VideoWriter":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
 def to_gradio_3d_orientation(mesh):
+    import trimesh
+
     mesh.apply_transform(trimesh.transformations.rotation_matrix(-np.pi/2, [1, 0, 0]))
     mesh.apply_transform(trimesh.transformations.rotation_matrix(np.pi/2, [0, 1, 0]))
     return mesh